@@ -9,19 +9,44 @@ from streamlit_folium import st_folium
 from streamlit_oauth import OAuth2Component
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
 import time
 import requests
 from io import BytesIO
 from openpyxl import Workbook
 from openpyxl.utils.dataframe import dataframe_to_rows
 from openpyxl.styles import Alignment
+from openpyxl.styles.fonts import DEFAULT_FONT
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.worksheet.cell_range import CellRange
+from openpyxl.utils import get_column_letter
+from copy import copy
 import gdown
-import webbrowser
-import matplotlib.pyplot as plt
-import traceback
-from PIL import Image
-import io
+import logging
+import os
+import json
+import uuid
+import functools
+import collections
+import contextlib
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import shapely
+from shapely.geometry import shape, mapping
+from shapely.strtree import STRtree
+from graficos_agro import IndiceProdutos, renderizar_graficos, FORMATOS_GRAFICOS, FORMATO_GRAFICOS
+from excel_imagens import ArmazemImagens, salvar_workbook, ALTURA_LINHA_PX
+from ee_sessao import garantir_ee_inicializado, ee_em_uso, identificar_conta, ultimo_projeto, salvar_ultimo_projeto, sondar_projetos_ee
+from drive_zap import criar_sessao_drive, enviar_arquivos_drive, chave_credencial, resolver_pastas_drive, invalidar_pastas_drive
+from produtos_ee import PRODUTOS, TIPOS_DADO, planejar, Avaliador, grade_exportacao, converter_tipo, tipo_comum, separar_por_tipo
+from fila_jobs import FilaJobs, PoolWorkers, ESTADOS_FINAIS_JOB, caminho_arquivo_job
+from config_zap import CACHE_DIR
+
+logger = logging.getLogger(__name__)
 
 # Configuração de layout
 st.set_page_config(
@@ -35,16 +60,8 @@ st.set_page_config(
     }
 )
 #Configurações para manter a sessão
-if 'processing' not in st.session_state:
-    st.session_state.processing = False
-if 'tasks_remoto' not in st.session_state:
-    st.session_state.tasks_remoto = []
-if 'completed_tasks' not in st.session_state:
-    st.session_state.completed_tasks = 0
-if 'resultados' not in st.session_state:
-    st.session_state.resultados = None
-if 'process_agro' not in st.session_state:
-    st.session_state.process_agro = False
+if 'job_id' not in st.session_state:
+    st.session_state.job_id = None
 if 'select_all' not in st.session_state:
     st.session_state.select_all = False
 if 'select_ibge' not in st.session_state:
@@ -365,6 +382,8 @@ REFRESH_TOKEN_URL = "https://oauth2.googleapis.com/token"
 REVOKE_TOKEN_URL = "https://oauth2.googleapis.com/revoke"
 
 SCOPES = [
+    # Identidade da conta (sub do OpenID Connect): chave do cache de projetos e dona dos jobs
+    "openid",
     "https://www.googleapis.com/auth/earthengine",
     "https://www.googleapis.com/auth/cloud-platform",
     "https://www.googleapis.com/auth/drive.file",
@@ -492,6 +511,9 @@ DICIONARIO_PRODUTOS = {
     'outprod': ('Outros produtos', '#A9A9A9')
 }
 
+# Índice (nome, cor, unidade, divisor) por tabela, montado uma única vez para os gráficos
+INDICE_PRODUTOS = IndiceProdutos(DICIONARIO_PRODUTOS)
+
 # 3. URLs das tabelas (convertidas para links diretos do Google Drive)
 TABELAS_AGRO = {
     'PAM_Quantidade_produzida_14-23': 'https://drive.google.com/uc?id=19BaNA96nXA4gtkmF_nwSQFdxA5UEBmmx',
@@ -507,7 +529,65 @@ TABELAS_AGRO = {
     'IBGE_Municipios_ZAP': 'https://drive.google.com/uc?id=1skVkA0cN3TVlJThvqsilWwO2SGLY-joi'
 }
 
+# Renomeação e ordem das colunas da tabela IBGE (incluindo 'Municípios')
+RENOMEAR_COLUNAS_IBGE = {
+    'População ocupada': 'População ocupada {%}',
+    'Densidade demográfica': 'Densidade demográfica (hab/km²)',
+    'Esgotamento sanitário adequado': 'Esgotamento sanitário adequado {%}',
+    'Mortalidade Infantil': 'Mortalidade Infantil {%}',
+    'Taxa de escolarização de 6 a 14 anos de idade': 'Taxa de escolarização de 6 a 14 anos de idade {%}',
+    'Urbanização de vias públicas': 'Urbanização de vias públicas {%}',
+    'Arborização de vias públicas': 'Arborização de vias públicas {%}'
+}
+
+ORDEM_COLUNAS_IBGE = [
+    'Municípios',
+    'geocodigo',
+    'Gentílico',
+    'Bioma predominante',
+    'Área (km²)',
+    'População no último censo',
+    'População ocupada {%}',
+    'Densidade demográfica (hab/km²)',
+    'PIB per capita',
+    'Salário médio mensal dos trabalhadores formais',
+    'Receitas',
+    'Despesas',
+    'Esgotamento sanitário adequado {%}',
+    'Estabelecimentos de Saúde SUS',
+    'Mortalidade Infantil {%}',
+    'Taxa de escolarização de 6 a 14 anos de idade {%}',
+    'Urbanização de vias públicas {%}',
+    'Arborização de vias públicas {%}',
+    'Índice de Desenvolvimento Humano Municipal (IDHM)'
+]
+
 # 4. Funções auxiliares
+# Fusos UTM (SIRGAS 2000) que cobrem MG, empacotados com o app para evitar a consulta à Earth Engine
+ARQUIVO_FUSOS_MG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dados', 'fusos_mg.geojson')
+
+@functools.lru_cache(maxsize=1)
+def carregar_fusos_mg():
+    """Lê os fusos locais uma única vez e monta o índice espacial (STRtree) com geometrias preparadas."""
+    with open(ARQUIVO_FUSOS_MG, encoding='utf-8') as f:
+        features = json.load(f)['features']
+    geometrias = [shape(feature['geometry']) for feature in features]
+    shapely.prepare(geometrias)
+    return STRtree(geometrias), geometrias, [feature['properties']['epsg'] for feature in features]
+
+def determinar_epsg_local(geometria):
+    """EPSG do fuso com maior sobreposição com a bacia, ou None se a bacia estiver fora dos fusos locais."""
+    try:
+        arvore, geometrias, epsgs = carregar_fusos_mg()
+        candidatos = arvore.query(geometria, predicate='intersects')
+        if len(candidatos) == 0:
+            return None
+        areas = shapely.area(shapely.intersection(np.take(geometrias, candidatos), geometria))
+        return epsgs[candidatos[int(np.argmax(areas))]]
+    except Exception as e:
+        logger.warning("Erro ao determinar o fuso localmente: %s", e)
+        return None
+
 def load_geojson(file):
     try:
         # Verificação de tamanho (1 MB)
@@ -562,6 +642,11 @@ def load_geojson(file):
         st_folium(m, width=600, height=400)
         st.success(f"CRS do arquivo validado: {gdf.crs} (SIRGAS 2000)")
         
+        # Fuso UTM calculado no cliente (process_data consulta a Earth Engine só se não houver)
+        st.session_state["epsg_bacia"] = determinar_epsg_local(gdf.geometry.iloc[0])
+        # Geometria da bacia no cliente, usada pelo cruzamento local com os municípios
+        st.session_state["geometria_bacia"] = gdf.geometry.iloc[0]
+        
         # Retorna geometria no SIRGAS 2000
         return ee.Geometry(gdf.geometry.iloc[0].__geo_interface__), CRS_OBRIGATORIO
         
@@ -569,195 +654,658 @@ def load_geojson(file):
         st.error(f"Erro crítico ao carregar GeoJSON: {str(e)}")
         return None, None
 
-def reprojetarImagem(imagem, epsg, escala):
-    return imagem.reproject(crs=f"EPSG:{epsg}", scale=escala)
+def criarExportacao(imagem, nome_prefixo, nome_sufixo, escala, regiao, nome_bacia_export, pasta="zap", epsg=None,
+                    nodata=None):
+    """Tarefa de exportação para o Drive, em GeoTIFF otimizado para nuvem (COG).
+
+    Com `epsg`, a projeção é aplicada só na exportação (crs + crsTransform), sem
+    reproject() antes: a Earth Engine escolhe a pirâmide e os blocos de cálculo.
+    `nodata` é gravado nos pixels mascarados e declarado no GeoTIFF.
+    """
+    nome_arquivo = f"{nome_prefixo}{nome_bacia_export}{nome_sufixo}"
+    projecao = {"crs": f"EPSG:{epsg}", "crsTransform": grade_exportacao(escala)} if epsg else {"scale": escala}
+    formato = {"cloudOptimized": True}
+    if nodata is not None:
+        formato["noData"] = nodata
+    return ee.batch.Export.image.toDrive(
+        image=imagem,
+        description=nome_arquivo,
+        folder=pasta,
+        fileNamePrefix=nome_arquivo,
+        region=regiao,
+        fileFormat='GeoTIFF',
+        formatOptions=formato,
+        maxPixels=1e13,
+        **projecao,
+    )
 
-def exportarImagem(imagem, nome_prefixo, nome_sufixo, escala, regiao, nome_bacia_export, pasta="zap"):
+def exportarImagens(exportacoes, regiao, nome_bacia_export, pasta="zap", max_workers=16, saida=st, epsg=None):
+    """Inicia várias exportações ao mesmo tempo.
+
+    `exportacoes` é uma lista de (imagem, nome_prefixo, nome_sufixo, escala, nodata). As chamadas
+    task.start() rodam em paralelo; erros de uma tarefa não interrompem as outras. Retorna
+    as tarefas na mesma ordem de `exportacoes`, com None nas que falharam.
+    """
+    def iniciar(exportacao):
+        imagem, nome_prefixo, nome_sufixo, escala, nodata = exportacao
+        task = criarExportacao(imagem, nome_prefixo, nome_sufixo, escala, regiao, nome_bacia_export, pasta, epsg, nodata)
+        task.start()
+        return task
+
+    nomes = [f"{nome_prefixo}{nome_bacia_export}{nome_sufixo}" for _, nome_prefixo, nome_sufixo, *_ in exportacoes]
+    tasks = [None] * len(exportacoes)
+    erros = {}
+    if exportacoes:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(exportacoes))) as executor:
+            futuros = [executor.submit(iniciar, exportacao) for exportacao in exportacoes]
+            for i, futuro in enumerate(futuros):
+                try:
+                    tasks[i] = futuro.result()
+                except Exception as e:
+                    erros[nomes[i]] = e
+
+    # Mensagens na thread de quem chamou, na ordem de exportação
+    for nome_arquivo, task in zip(nomes, tasks):
+        if task is not None:
+            saida.success(f"Exportação {nome_arquivo} iniciada. Verifique seu Google Drive na pasta '{pasta}'.")
+        else:
+            saida.error(f"Erro ao exportar {nome_arquivo} para o Google Drive: {erros[nome_arquivo]}")
+    return tasks
+
+COLUNAS_MANIFESTO = ["arquivo", "banda", "nome_banda", "produto", "escala", "tipo", "fator", "nodata"]
+
+def exportarManifesto(manifesto, nome_bacia_export, pasta="zap", saida=st):
+    """Exporta para o Drive o CSV com as bandas dos GeoTIFFs empilhados (ver montar_exportacoes)."""
+    nome_arquivo = f"{nome_bacia_export}_manifesto_bandas"
     try:
-        nome_arquivo = f"{nome_prefixo}{nome_bacia_export}{nome_sufixo}"
-        task = ee.batch.Export.image.toDrive(
-            image=imagem,
+        features = ee.FeatureCollection([ee.Feature(None, linha) for linha in manifesto])
+        task = ee.batch.Export.table.toDrive(
+            collection=features,
             description=nome_arquivo,
             folder=pasta,
             fileNamePrefix=nome_arquivo,
-            scale=escala,
-            region=regiao,
-            fileFormat='GeoTIFF',
-            maxPixels=1e13,
+            fileFormat='CSV',
+            selectors=COLUNAS_MANIFESTO,
         )
         task.start()
-        st.success(f"Exportação {nome_arquivo} iniciada. Verifique seu Google Drive na pasta '{pasta}'.")
+        saida.success(f"Exportação {nome_arquivo} iniciada. Verifique seu Google Drive na pasta '{pasta}'.")
         return task
     except Exception as e:
-        st.error(f"Erro ao exportar {nome_arquivo} para o Google Drive: {e}")
+        saida.error(f"Erro ao exportar {nome_arquivo} para o Google Drive: {e}")
         return None
 
-def check_task_status(task):
-    try:
-        status = task.status()
-        state = status["state"]
-        if state == "COMPLETED":
-            st.success(f"Tarefa {task.id} concluída com sucesso!")
-        elif state == "RUNNING":
-            st.warning(f"Tarefa {task.id} ainda está em execução.")
-        elif state == "FAILED":
-            st.error(f"Tarefa {task.id} falhou. Motivo: {status['error_message']}")
-        else:
-            st.info(f"Status da tarefa {task.id}: {state}")
-        return state
-    except Exception as e:
-        st.error(f"Erro ao verificar o status da tarefa: {e}")
-        return None
+ESTADOS_FINAIS_TAREFA = {"COMPLETED", "FAILED", "CANCELLED"}
+# Consultas seguidas em que a tarefa não aparece na Earth Engine até ela ser dada como falha
+MAX_CONSULTAS_DESCONHECIDA = 3
+
+class MonitorTarefasEE:
+    """Acompanha as tarefas de exportação da Earth Engine em uma thread de segundo plano.
+
+    Cada consulta é uma única listagem das operações do projeto (ee.data.getTaskList,
+    sobre ee.data.listOperations), filtrada pelas tarefas pendentes; getTaskStatus
+    faria uma requisição por tarefa. O intervalo é adaptativo (volta ao mínimo quando
+    algum estado muda e cresce até o máximo enquanto nada muda). A interface apenas
+    lê o último estado conhecido.
+    `tasks` aceita as tarefas ou os seus ids; com `credenciais` e `projeto`, cada
+    consulta é feita com essa conta (ee_em_uso), para os workers que atendem várias.
+    """
+
+    def __init__(self, tasks, intervalo_inicial=5, intervalo_maximo=60, credenciais=None, projeto=None):
+        self.ids = [getattr(task, "id", task) for task in tasks if task is not None]
+        self.credenciais = credenciais
+        self.projeto = projeto
+        self.intervalo_inicial = intervalo_inicial
+        self.intervalo_maximo = intervalo_maximo
+        self.erro = None
+        self._estados = {task_id: {"id": task_id, "state": "READY"} for task_id in self.ids}
+        self._desconhecidas = {}
+        self._lock = threading.Lock()
+        self._parar = threading.Event()
+        self._thread = threading.Thread(target=self._executar, name="monitor-tarefas-ee", daemon=True)
+
+    def iniciar(self):
+        self._thread.start()
+
+    def parar(self):
+        self._parar.set()
+
+    def status(self):
+        """Cópia do último status conhecido de cada tarefa, na ordem de exportação."""
+        with self._lock:
+            return [dict(self._estados[task_id]) for task_id in self.ids]
+
+    def concluido(self):
+        return all(s["state"] in ESTADOS_FINAIS_TAREFA for s in self.status())
+
+    def cancelar_pendentes(self):
+        """Cancela na Earth Engine as tarefas que ainda não terminaram."""
+        pendentes = [s["id"] for s in self.status() if s["state"] not in ESTADOS_FINAIS_TAREFA]
+        for task_id in pendentes:
+            try:
+                if self.credenciais is not None:
+                    with ee_em_uso(self.credenciais, self.projeto):
+                        ee.data.cancelTask(task_id)
+                else:
+                    ee.data.cancelTask(task_id)
+            except Exception as e:
+                logger.warning("Erro ao cancelar a tarefa %s: %s", task_id, e)
+
+    def _filtrar_pendentes(self, tarefas, pendentes):
+        """Status das tarefas pendentes presentes na listagem da Earth Engine.
+
+        Uma tarefa ausente (ou UNKNOWN) por MAX_CONSULTAS_DESCONHECIDA consultas
+        seguidas é dada como falha: um job retomado com uma tarefa que não existe
+        mais não fica esperando para sempre.
+        """
+        por_id = {tarefa.get("id"): tarefa for tarefa in tarefas}
+        lista_status = []
+        for task_id in pendentes:
+            status = por_id.get(task_id)
+            if status is not None and status.get("state") != "UNKNOWN":
+                self._desconhecidas.pop(task_id, None)
+                lista_status.append(status)
+                continue
+            self._desconhecidas[task_id] = self._desconhecidas.get(task_id, 0) + 1
+            if self._desconhecidas[task_id] >= MAX_CONSULTAS_DESCONHECIDA:
+                lista_status.append({"id": task_id, "state": "FAILED",
+                                     "error_message": "Tarefa não encontrada na Earth Engine"})
+        return lista_status
+
+    def total_concluidas(self):
+        return sum(1 for s in self.status() if s["state"] == "COMPLETED")
+
+    def _executar(self):
+        intervalo = self.intervalo_inicial
+        while not self._parar.is_set():
+            with self._lock:
+                pendentes = [i for i, s in self._estados.items() if s["state"] not in ESTADOS_FINAIS_TAREFA]
+            if not pendentes:
+                return
+
+            mudou = False
+            try:
+                if self.credenciais is not None:
+                    with ee_em_uso(self.credenciais, self.projeto):
+                        tarefas = ee.data.getTaskList()
+                else:
+                    tarefas = ee.data.getTaskList()
+                lista_status = self._filtrar_pendentes(tarefas, pendentes)
+                for status in lista_status:
+                    with self._lock:
+                        anterior = self._estados.get(status["id"])
+                        if anterior is not None and anterior.get("state") != status.get("state"):
+                            mudou = True
+                        self._estados[status["id"]] = status
+                self.erro = None
+            except Exception as e:
+                self.erro = str(e)
+
+            intervalo = self.intervalo_inicial if mudou else min(intervalo * 1.5, self.intervalo_maximo)
+            self._parar.wait(intervalo)
+
+def exibir_status_tarefa(status):
+    task_id = status.get("description") or status["id"]
+    state = status.get("state")
+    if state == "COMPLETED":
+        st.success(f"Tarefa {task_id} concluída com sucesso!")
+    elif state == "RUNNING":
+        st.warning(f"Tarefa {task_id} ainda está em execução.")
+    elif state == "FAILED":
+        st.error(f"Tarefa {task_id} falhou. Motivo: {status.get('error_message')}")
+    else:
+        st.info(f"Status da tarefa {task_id}: {state}")
 
 # 5. Funções para processamento dos dados agro
-def processar_municipios(geometry, nome_bacia_export):
-    try:
-        # Carregar municípios de MG (do Earth Engine)
-        municipios_mg = ee.FeatureCollection("projects/ee-zapmg/assets/mg-municipios")
-        
-        # Calcular área da bacia
-        area_bacia = geometry.area()
-        
-        # Função para calcular interseção
-        def calcular_intersecao(feature):
-            intersecao = feature.geometry().intersection(geometry, 1)
-            area_intersecao = intersecao.area()
-            percentual = area_intersecao.divide(area_bacia).multiply(100)
-            
-            return feature.set({
-                'area_intersecao_ha': area_intersecao.divide(10000),
-                'percentual_na_bacia': percentual,
-                'area_municipio_ha': feature.geometry().area().divide(10000),
-                'area_bacia_ha': area_bacia.divide(10000)
-            })
-        
-        # Processar todos os municípios que intersectam
-        municipios_processados = municipios_mg.filterBounds(geometry).map(calcular_intersecao)
-        
-        # Filtrar municípios com mais de 20% de representatividade
-        municipios_selecionados = municipios_processados.filter(ee.Filter.gte('percentual_na_bacia', 20))
-        
-        # Converter para Pandas DataFrame
-        features = municipios_selecionados.getInfo()['features']
-        dados_municipios = []
-        
-        for feature in features:
-            props = feature['properties']
-            props['geocodigo'] = int(props['geocodigo'])  # Garantir que é inteiro
-            dados_municipios.append(props)
-        
-        df_municipios = pd.DataFrame(dados_municipios)
+def hash_geometria(geometry):
+    """Hash da geometria da bacia (GeoJSON montado no cliente, sem chamada ao servidor)."""
+    return hashlib.sha256(geometry.toGeoJSONString().encode('utf-8')).hexdigest()
+
+# Bacias mantidas no memo de metadados compartilhado pelos jobs do processo
+MAX_BACIAS_MEMO = 64
+
+class MemoBacias(collections.OrderedDict):
+    """Memo de metadados (obter_metadados_bacia) compartilhado entre jobs, limitado às bacias mais recentes.
+
+    As chaves já são (hash da geometria, dia): o período das consultas muda com a data.
+    Só o setdefault usado por obter_metadados_bacia é protegido pelo lock.
+    """
+
+    def __init__(self, maximo=MAX_BACIAS_MEMO):
+        super().__init__()
+        self.maximo = maximo
+        self._lock = threading.Lock()
+
+    def setdefault(self, chave, padrao=None):
+        with self._lock:
+            if chave in self:
+                self.move_to_end(chave)
+                return self[chave]
+            self[chave] = padrao
+            while len(self) > self.maximo:
+                self.popitem(last=False)
+            return padrao
+
+def obter_metadados_bacia(geometry, consultas, memo=None):
+    """Avalia vários valores do servidor em um único getInfo, memoizado por bacia.
+
+    `consultas` é um dicionário nome -> objeto da Earth Engine. Apenas os nomes ainda
+    não calculados para esta geometria (no dia de hoje) vão para o servidor, todos
+    juntos em um ee.Dictionary. `memo` é o dicionário da sessão ou o MemoBacias dos
+    jobs (st.session_state não pode ser lido fora da thread do Streamlit).
+    """
+    if memo is None:
+        memo = st.session_state.setdefault("metadados_bacia", {})
+    chave = (hash_geometria(geometry), datetime.date.today().isoformat())
+    memo = memo.setdefault(chave, {})
+    faltantes = {nome: valor for nome, valor in consultas.items() if nome not in memo}
+    if faltantes:
+        memo.update(ee.Dictionary(faltantes).getInfo())
+    return {nome: memo[nome] for nome in consultas}
+
+def municipios_selecionados_fc(geometry):
+    """Municípios com mais de 20% de área na bacia (FeatureCollection, ainda não avaliada)."""
+    # Carregar municípios de MG (do Earth Engine)
+    municipios_mg = ee.FeatureCollection("projects/ee-zapmg/assets/mg-municipios")
+    
+    # Calcular área da bacia
+    area_bacia = geometry.area()
+    
+    # Função para calcular interseção
+    def calcular_intersecao(feature):
+        intersecao = feature.geometry().intersection(geometry, 1)
+        area_intersecao = intersecao.area()
+        percentual = area_intersecao.divide(area_bacia).multiply(100)
         
-        if not df_municipios.empty:
-            df_municipios = df_municipios.sort_values('percentual_na_bacia', ascending=False)
-            
-            # Formatando as colunas numéricas
-            df_municipios['area_intersecao_ha'] = df_municipios['area_intersecao_ha'].round(2)
-            df_municipios['percentual_na_bacia'] = df_municipios['percentual_na_bacia'].round(2)
-            df_municipios['area_municipio_ha'] = df_municipios['area_municipio_ha'].round(2)
-            
-            # Criando DataFrame para exibição
-            df_display = df_municipios[['nome', 'area_intersecao_ha', 'percentual_na_bacia']].copy()
-            df_display.columns = ['Município', 'Área na Bacia (ha)', 'Representatividade (%)']
-            
-            st.success(f"{len(df_municipios)} município(s) selecionado(s) com mais de 20% de área na bacia")
-            
-            # Mostrar tabela detalhada
-            st.write("### Detalhes dos Municípios")
-            st.dataframe(df_display.sort_values('Representatividade (%)', ascending=False))
-            
-            # Adicionar métricas resumidas
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                st.metric("Municípios selecionados", len(df_municipios))
-            with col2:
-                st.metric("Área total na bacia (ha)", 
-                         round(df_municipios['area_intersecao_ha'].sum(), 2))
-            with col3:
-                st.metric("Representatividade média (%)", 
-                         round(df_municipios['percentual_na_bacia'].mean(), 2))
-            
-            return df_municipios
-        else:
-            st.warning("Nenhum município com mais de 20% de área na bacia foi encontrado.")
-            return None
-            
-    except Exception as e:
-        st.error(f"Erro ao processar municípios: {e}")
+        return feature.set({
+            'area_intersecao_ha': area_intersecao.divide(10000),
+            'percentual_na_bacia': percentual,
+            'area_municipio_ha': feature.geometry().area().divide(10000),
+            'area_bacia_ha': area_bacia.divide(10000)
+        })
+    
+    # Processar todos os municípios que intersectam
+    municipios_processados = municipios_mg.filterBounds(geometry).map(calcular_intersecao)
+    
+    # Filtrar municípios com mais de 20% de representatividade
+    return municipios_processados.filter(ee.Filter.gte('percentual_na_bacia', 20))
+
+# Camada local dos municípios de MG, gerada do asset projects/ee-zapmg/assets/mg-municipios
+# por gerar_municipios_mg.py
+ARQUIVO_MUNICIPIOS_MG = os.environ.get(
+    "ZAP_MUNICIPIOS_MG",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dados', 'mg_municipios.parquet')
+)
+# 'local' (padrão, com a Earth Engine como alternativa), 'ee' ou 'verificar' (calcula nos dois e compara)
+MODO_MUNICIPIOS = os.environ.get("ZAP_MUNICIPIOS_MODO", "local")
+# Albers equivalente (parâmetros do IBGE) para as áreas
+CRS_AREA_IGUAL = '+proj=aea +lat_0=-12 +lon_0=-54 +lat_1=-2 +lat_2=-22 +ellps=GRS80 +units=m +no_defs'
+PERCENTUAL_MINIMO_MUNICIPIO = 20
+
+def carregar_municipios_mg():
+    """Camada local dos municípios: atributos, geometrias em área igual, áreas e STRtree.
+
+    Retorna None se a camada não estiver disponível (o cruzamento volta para a Earth Engine).
+    Só as leituras bem-sucedidas ficam em memória: uma camada gerada com o servidor no ar
+    (ou regravada) é lida na próxima chamada, sem reiniciar.
+    """
+    try:
+        versao = os.stat(ARQUIVO_MUNICIPIOS_MG).st_mtime_ns
+    except OSError:
+        logger.error(
+            "Camada local dos municípios não encontrada em %s: todos os cruzamentos vão para a Earth Engine. "
+            "Gere a camada com `python gerar_municipios_mg.py --projeto PROJETO`.", ARQUIVO_MUNICIPIOS_MG
+        )
+        return None
+    return _ler_municipios_mg(ARQUIVO_MUNICIPIOS_MG, versao)
+
+@functools.lru_cache(maxsize=1)
+def _ler_municipios_mg(caminho, _versao):
+    if caminho.endswith('.parquet'):
+        gdf = gpd.read_parquet(caminho)
+    else:
+        gdf = gpd.read_file(caminho)
+    if gdf.crs is None:
+        gdf = gdf.set_crs('EPSG:4674')
+    geometrias = gdf.geometry.to_crs(CRS_AREA_IGUAL).make_valid().to_numpy()
+    shapely.prepare(geometrias)
+    atributos = pd.DataFrame(gdf.drop(columns=gdf.geometry.name)).reset_index(drop=True)
+    return atributos, geometrias, shapely.area(geometrias), STRtree(geometrias)
+
+def intersecao_municipios_local(geometria_bacia, percentual_minimo=PERCENTUAL_MINIMO_MUNICIPIO):
+    """Municípios com mais de `percentual_minimo`% de área na bacia, calculados no cliente.
+
+    `geometria_bacia` é a geometria shapely em SIRGAS 2000. As colunas são as mesmas das
+    propriedades devolvidas por municipios_selecionados_fc. Retorna None sem a camada local.
+    """
+    camada = carregar_municipios_mg()
+    if camada is None:
+        return None
+    atributos, geometrias, areas_municipios, arvore = camada
+
+    bacia = gpd.GeoSeries([geometria_bacia], crs='EPSG:4674').to_crs(CRS_AREA_IGUAL).make_valid().iloc[0]
+    area_bacia = bacia.area
+    candidatos = arvore.query(bacia, predicate='intersects')
+    areas_intersecao = shapely.area(shapely.intersection(geometrias[candidatos], bacia))
+    percentuais = areas_intersecao / area_bacia * 100
+
+    selecionados = percentuais >= percentual_minimo
+    indices = candidatos[selecionados]
+    df = atributos.iloc[indices].reset_index(drop=True)
+    df['area_intersecao_ha'] = areas_intersecao[selecionados] / 10000
+    df['percentual_na_bacia'] = percentuais[selecionados]
+    df['area_municipio_ha'] = areas_municipios[indices] / 10000
+    df['area_bacia_ha'] = area_bacia / 10000
+    return df
+
+def municipios_locais(geometria_bacia):
+    """Resultado do cruzamento local para a bacia, ou None se o modo/camada não permitir."""
+    if MODO_MUNICIPIOS == 'ee' or geometria_bacia is None:
         return None
+    try:
+        return intersecao_municipios_local(geometria_bacia)
+    except Exception:
+        logger.exception("Erro no cruzamento local dos municípios")
+        return None
+
+def municipios_earth_engine(geometry, memo=None):
+    """Municípios selecionados calculados na Earth Engine (memoizados por bacia)."""
+    municipios = obter_metadados_bacia(geometry, {'municipios': municipios_selecionados_fc(geometry)}, memo)['municipios']
+    return pd.DataFrame([feature['properties'] for feature in municipios['features']])
+
+def comparar_municipios(df_local, df_ee, saida=st):
+    """Modo de verificação: mostra as diferenças entre o cálculo local e o da Earth Engine."""
+    geocodigos_local = set(df_local['geocodigo'].astype(int)) if not df_local.empty else set()
+    geocodigos_ee = set(df_ee['geocodigo'].astype(int)) if not df_ee.empty else set()
+    if geocodigos_local != geocodigos_ee:
+        saida.warning(
+            f"Verificação: municípios divergentes entre o cálculo local e a Earth Engine "
+            f"(só local: {sorted(geocodigos_local - geocodigos_ee)}, só EE: {sorted(geocodigos_ee - geocodigos_local)})"
+        )
+        return
+    if geocodigos_local:
+        percentuais = pd.merge(
+            df_local.assign(geocodigo=df_local['geocodigo'].astype(int))[['geocodigo', 'percentual_na_bacia']],
+            df_ee.assign(geocodigo=df_ee['geocodigo'].astype(int))[['geocodigo', 'percentual_na_bacia']],
+            on='geocodigo', suffixes=('_local', '_ee')
+        )
+        diferenca = (percentuais['percentual_na_bacia_local'] - percentuais['percentual_na_bacia_ee']).abs().max()
+        saida.info(f"Verificação: mesmos municípios no cálculo local e na Earth Engine (maior diferença: {diferenca:.3f} p.p.)")
+
+def selecionar_municipios(geometry, geometria_bacia, memo=None, saida=st, conta_ee=None):
+    """Municípios com mais de 20% de área na bacia, ordenados pela representatividade (sem exibir nada).
+
+    Com `conta_ee` (credencial, projeto), o cruzamento na Earth Engine usa essa conta (ee_em_uso).
+    """
+    # Cruzamento local (camada em disco); a Earth Engine fica como alternativa e como verificação
+    df_municipios = municipios_locais(geometria_bacia)
+    if df_municipios is None and MODO_MUNICIPIOS != 'ee':
+        logger.warning("Cruzamento dos municípios feito na Earth Engine (alternativa): o cálculo local não está disponível")
+    if df_municipios is None or MODO_MUNICIPIOS == 'verificar':
+        with ee_em_uso(*conta_ee) if conta_ee else contextlib.nullcontext():
+            df_ee = municipios_earth_engine(geometry, memo)
+        if df_municipios is not None:
+            comparar_municipios(df_municipios, df_ee, saida)
+        df_municipios = df_ee
+    
+    if not df_municipios.empty:
+        df_municipios['geocodigo'] = df_municipios['geocodigo'].astype(int)  # Garantir que é inteiro
+        df_municipios = df_municipios.sort_values('percentual_na_bacia', ascending=False)
+        
+        # Formatando as colunas numéricas
+        df_municipios['area_intersecao_ha'] = df_municipios['area_intersecao_ha'].round(2)
+        df_municipios['percentual_na_bacia'] = df_municipios['percentual_na_bacia'].round(2)
+        df_municipios['area_municipio_ha'] = df_municipios['area_municipio_ha'].round(2)
+    
+    return df_municipios
 
-def baixar_tabela(url):
+def exibir_municipios(df_municipios):
+    # Criando DataFrame para exibição
+    df_display = df_municipios[['nome', 'area_intersecao_ha', 'percentual_na_bacia']].copy()
+    df_display.columns = ['Município', 'Área na Bacia (ha)', 'Representatividade (%)']
+    
+    st.success(f"{len(df_municipios)} município(s) selecionado(s) com mais de 20% de área na bacia")
+    
+    # Mostrar tabela detalhada
+    st.write("### Detalhes dos Municípios")
+    st.dataframe(df_display.sort_values('Representatividade (%)', ascending=False))
+    
+    # Adicionar métricas resumidas
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Municípios selecionados", len(df_municipios))
+    with col2:
+        st.metric("Área total na bacia (ha)", 
+                 round(df_municipios['area_intersecao_ha'].sum(), 2))
+    with col3:
+        st.metric("Representatividade média (%)", 
+                 round(df_municipios['percentual_na_bacia'].mean(), 2))
+
+def baixar_tabela(url, saida=st):
     try:
         output = BytesIO()
         gdown.download(url, output, quiet=True)
         output.seek(0)
         return pd.read_csv(output)
     except Exception as e:
-        st.error(f"Erro ao baixar tabela: {e}")
+        saida.error(f"Erro ao baixar tabela: {e}")
         return None
 
-def processar_tabelas_agro(geocodigos):
+# Cache local das tabelas agro (Arrow/Feather em disco, chaveado pelo id do arquivo no Drive)
+CACHE_TABELAS_DIR = os.path.join(CACHE_DIR, "tabelas")
+CACHE_TABELAS_MAX_IDADE = 7 * 24 * 3600  # Revalidar com o Drive após 7 dias
+CACHE_TABELAS_MAX_BYTES = 512 * 1024 * 1024  # Limite total do cache (LRU)
+
+CHAVE_INDICE_GEOCODIGO = b'zap:indice_geocodigo'
+
+# Um lock por tabela (file_id), preso só para trocar o arquivo e os metadados; o global
+# protege o dicionário dos locks e a limpeza do cache (LRU), que passa por todas as tabelas
+_cache_tabelas_lock = threading.Lock()
+_locks_tabelas = {}
+
+def _lock_tabela(file_id):
+    with _cache_tabelas_lock:
+        return _locks_tabelas.setdefault(file_id, threading.Lock())
+
+def extrair_id_drive(url):
+    """Extrai o id do arquivo de um link do Google Drive (uc?id=...)."""
+    ids = parse_qs(urlparse(url).query).get('id')
+    return ids[0] if ids else url.rstrip('/').split('/')[-1]
+
+def _caminhos_cache_tabela(file_id):
+    return (os.path.join(CACHE_TABELAS_DIR, f"{file_id}.arrow"),
+            os.path.join(CACHE_TABELAS_DIR, f"{file_id}.json"))
+
+def _ler_meta_cache(caminho_meta):
+    try:
+        with open(caminho_meta, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _gravar_meta_cache(caminho_meta, meta):
+    tmp = f"{caminho_meta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp, caminho_meta)
+
+def obter_etag_drive(url):
+    """Consulta apenas os cabeçalhos do arquivo no Drive (ETag ou Last-Modified)."""
+    try:
+        resposta = requests.head(url, allow_redirects=True, timeout=10)
+        if resposta.ok:
+            return resposta.headers.get('ETag') or resposta.headers.get('Last-Modified')
+    except requests.RequestException:
+        pass
+    return None
+
+def _aplicar_limite_cache(manter=None):
+    """Remove as tabelas usadas há mais tempo até o cache caber em CACHE_TABELAS_MAX_BYTES."""
+    entradas = []
+    for nome in os.listdir(CACHE_TABELAS_DIR):
+        if not nome.endswith('.arrow'):
+            continue
+        file_id = nome[:-len('.arrow')]
+        caminho, caminho_meta = _caminhos_cache_tabela(file_id)
+        meta = _ler_meta_cache(caminho_meta) or {}
+        entradas.append((meta.get('ultimo_acesso', 0), os.path.getsize(caminho), file_id))
+
+    total = sum(tamanho for _, tamanho, _ in entradas)
+    for _, tamanho, file_id in sorted(entradas):
+        if total <= CACHE_TABELAS_MAX_BYTES:
+            break
+        if file_id == manter:
+            continue
+        for caminho in _caminhos_cache_tabela(file_id):
+            try:
+                os.remove(caminho)
+            except OSError:
+                pass
+        total -= tamanho
+
+def atualizar_cache_tabela(url, saida=st):
+    """Garante uma cópia local (Arrow) da tabela e retorna o caminho, ou None se indisponível.
+
+    O download e a conversão vão para um arquivo temporário sem lock; o lock da
+    tabela só é preso para trocar o arquivo e os metadados, então leituras de outras
+    tabelas (e acertos no cache) não esperam um download lento.
+    """
+    file_id = extrair_id_drive(url)
+    caminho, caminho_meta = _caminhos_cache_tabela(file_id)
+    os.makedirs(CACHE_TABELAS_DIR, exist_ok=True)
+    # Os metadados e o arquivo são trocados com os.replace: a leitura sem lock é consistente
+    meta = _ler_meta_cache(caminho_meta)
+    agora = time.time()
+
+    if meta and os.path.exists(caminho):
+        if agora - meta.get('baixado_em', 0) < CACHE_TABELAS_MAX_IDADE:
+            return caminho
+        # Cache expirado: revalidar pelo ETag antes de baixar novamente
+        etag = obter_etag_drive(url)
+        if etag and etag == meta.get('etag'):
+            with _lock_tabela(file_id):
+                meta = _ler_meta_cache(caminho_meta) or meta
+                meta['baixado_em'] = agora
+                _gravar_meta_cache(caminho_meta, meta)
+            return caminho
+    else:
+        etag = obter_etag_drive(url)
+
+    df = baixar_tabela(url, saida)
+    if df is None:
+        # Sem acesso ao Drive: usar a cópia antiga, se houver
+        return caminho if os.path.exists(caminho) else None
+
+    df['geocodigo'] = df['geocodigo'].astype(int)
+    tabela = pa.Table.from_pandas(df, preserve_index=False)
+    # Índice geocodigo -> posições das linhas, gravado no próprio arquivo
+    indice = {}
+    for posicao, geocodigo in enumerate(df['geocodigo'].tolist()):
+        indice.setdefault(str(geocodigo), []).append(posicao)
+    tabela = tabela.replace_schema_metadata({
+        **(tabela.schema.metadata or {}),
+        CHAVE_INDICE_GEOCODIGO: json.dumps(indice).encode('utf-8'),
+    })
+    tmp = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+    # Sem compressão para permitir leitura via memory-map
+    feather.write_feather(tabela, tmp, compression='uncompressed')
+
+    with _lock_tabela(file_id):
+        os.replace(tmp, caminho)
+        _gravar_meta_cache(caminho_meta, {
+            'url': url,
+            'etag': etag,
+            'baixado_em': agora,
+            'ultimo_acesso': agora,
+        })
+    with _cache_tabelas_lock:
+        _aplicar_limite_cache(manter=file_id)
+    return caminho
+
+@functools.lru_cache(maxsize=64)
+def _esquema_tabela(caminho, _versao):
+    with pa.memory_map(caminho) as fonte:
+        return pa.ipc.open_file(fonte).schema
+
+def esquema_tabela(caminho):
+    """Lê apenas o esquema (rodapé) do arquivo em cache; a versão invalida o memo ao regravar."""
+    return _esquema_tabela(caminho, os.stat(caminho).st_mtime_ns)
+
+def colunas_tabela(caminho):
+    """Lista as colunas da tabela em cache sem carregar os dados."""
+    return esquema_tabela(caminho).names
+
+@functools.lru_cache(maxsize=64)
+def _indice_geocodigo(caminho, _versao):
+    metadados = esquema_tabela(caminho).metadata or {}
+    if CHAVE_INDICE_GEOCODIGO not in metadados:
+        return None
+    return {int(geocodigo): posicoes for geocodigo, posicoes in json.loads(metadados[CHAVE_INDICE_GEOCODIGO]).items()}
+
+def indice_geocodigo(caminho):
+    """Retorna o índice geocodigo -> posições das linhas, ou None para arquivos sem índice."""
+    return _indice_geocodigo(caminho, os.stat(caminho).st_mtime_ns)
+
+def carregar_tabela(url, geocodigos=None, colunas=None, saida=st):
+    """Carrega do cache local apenas as colunas e os municípios pedidos.
+
+    `colunas` pode ser uma lista de nomes ou uma função que recebe as colunas disponíveis.
+    Os erros vão para `saida` (um RegistroMensagens fora da thread do Streamlit).
+    """
+    try:
+        caminho = atualizar_cache_tabela(url, saida)
+        if caminho is None:
+            return None
+
+        if callable(colunas):
+            colunas = colunas(colunas_tabela(caminho))
+        tabela = feather.read_table(caminho, columns=colunas, memory_map=True)
+        if geocodigos is not None:
+            indice = indice_geocodigo(caminho)
+            if indice is not None:
+                # Busca direta pelas posições dos municípios (mantendo a ordem original das linhas)
+                posicoes = sorted(p for geocodigo in set(geocodigos) for p in indice.get(int(geocodigo), []))
+                tabela = tabela.take(pa.array(posicoes, type=pa.int64()))
+            else:
+                filtro = pc.is_in(tabela['geocodigo'], value_set=pa.array(geocodigos, type=tabela['geocodigo'].type))
+                tabela = tabela.filter(filtro)
+        df = tabela.to_pandas()
+
+        file_id = extrair_id_drive(url)
+        _, caminho_meta = _caminhos_cache_tabela(file_id)
+        with _lock_tabela(file_id):
+            meta = _ler_meta_cache(caminho_meta)
+            if meta:
+                meta['ultimo_acesso'] = time.time()
+                _gravar_meta_cache(caminho_meta, meta)
+        return df
+    except Exception as e:
+        saida.error(f"Erro ao carregar tabela do cache: {e}")
+        return None
+
+def processar_tabelas_agro(geocodigos, saida=st, cancelamento=None):
+    """Tabelas agro dos municípios; None se `cancelamento` (threading.Event) for acionado no meio."""
     resultados = {}
     
     # Processar todas as tabelas, incluindo IBGE
     for nome_tabela, url in TABELAS_AGRO.items():
-        df = baixar_tabela(url)
-        if df is None:
-            continue
-            
-        # Converter geocodigo para inteiro
-        df['geocodigo'] = df['geocodigo'].astype(int)
-        
-        # Filtrar municípios selecionados
-        df_filtrado = df[df['geocodigo'].isin(geocodigos)]
-        
-        if df_filtrado.empty:
+        if cancelamento is not None and cancelamento.is_set():
+            return None
+        # Carregar do cache local apenas os municípios e colunas utilizados
+        if nome_tabela == 'IBGE_Municipios_ZAP':
+            colunas = lambda disponiveis: [col for col in disponiveis if RENOMEAR_COLUNAS_IBGE.get(col, col) in ORDEM_COLUNAS_IBGE]
+        else:
+            colunas = lambda disponiveis: [col for col in disponiveis if col in ('geocodigo', 'nome') or col[-2:].isdigit()]
+        df_filtrado = carregar_tabela(url, geocodigos=geocodigos, colunas=colunas, saida=saida)
+        if df_filtrado is None or df_filtrado.empty:
             continue
             
         # Tratamento especial para tabela IBGE
         if nome_tabela == 'IBGE_Municipios_ZAP':
-            # Remover colunas indesejadas (mas manter 'Municípios')
-            colunas_remover = [col for col in ['.geo', 'system:index'] if col in df_filtrado.columns]
-            if colunas_remover:
-                df_filtrado = df_filtrado.drop(columns=colunas_remover)
-            
             # Renomear colunas conforme solicitado
-            renomear = {
-                'População ocupada': 'População ocupada {%}',
-                'Densidade demográfica': 'Densidade demográfica (hab/km²)',
-                'Esgotamento sanitário adequado': 'Esgotamento sanitário adequado {%}',
-                'Mortalidade Infantil': 'Mortalidade Infantil {%}',
-                'Taxa de escolarização de 6 a 14 anos de idade': 'Taxa de escolarização de 6 a 14 anos de idade {%}',
-                'Urbanização de vias públicas': 'Urbanização de vias públicas {%}',
-                'Arborização de vias públicas': 'Arborização de vias públicas {%}'
-            }
-            df_filtrado = df_filtrado.rename(columns=renomear)
-            
-            # Definir a ordem das colunas (incluindo 'Municípios')
-            ordem_colunas = [
-                'Municípios',
-                'geocodigo',
-                'Gentílico',
-                'Bioma predominante',
-                'Área (km²)',
-                'População no último censo',
-                'População ocupada {%}',
-                'Densidade demográfica (hab/km²)',
-                'PIB per capita',
-                'Salário médio mensal dos trabalhadores formais',
-                'Receitas',
-                'Despesas',
-                'Esgotamento sanitário adequado {%}',
-                'Estabelecimentos de Saúde SUS',
-                'Mortalidade Infantil {%}',
-                'Taxa de escolarização de 6 a 14 anos de idade {%}',
-                'Urbanização de vias públicas {%}',
-                'Arborização de vias públicas {%}',
-                'Índice de Desenvolvimento Humano Municipal (IDHM)'
-            ]
+            df_filtrado = df_filtrado.rename(columns=RENOMEAR_COLUNAS_IBGE)
             
             # Manter apenas as colunas que existem no DataFrame
-            ordem_colunas = [col for col in ordem_colunas if col in df_filtrado.columns]
+            ordem_colunas = [col for col in ORDEM_COLUNAS_IBGE if col in df_filtrado.columns]
             
             # Reordenar as colunas e transpor
             df_final = df_filtrado[ordem_colunas].set_index('Municípios').T
@@ -766,42 +1314,38 @@ def processar_tabelas_agro(geocodigos):
             continue
             
         # Para outras tabelas, criar uma planilha com top 10 produtos por município
+        # Interpretar os nomes das colunas de anos (terminadas com 2 dígitos) uma única vez em (produto, ano)
+        colunas_ano = [col for col in df_filtrado.columns if col[-2:].isdigit() and col not in ['geocodigo', 'nome']]
+        anos_por_produto = {}
+        for col in colunas_ano:
+            anos_por_produto.setdefault(col[:-2], []).append(col[-2:])
+        anos = list(dict.fromkeys(ano for anos_produto in anos_por_produto.values() for ano in anos_produto))
+        # Mesma ordem de linhas que DataFrame.from_dict(orient='index') produzia (união dos produtos ano a ano)
+        produtos = list(dict.fromkeys(
+            produto for ano in anos for produto, anos_produto in anos_por_produto.items() if ano in anos_produto
+        ))
+        
+        # Reorganizar a tabela larga em um bloco município x produto x ano de uma só vez
+        largo = df_filtrado[colunas_ano]
+        largo.columns = pd.MultiIndex.from_tuples([(col[:-2], col[-2:]) for col in colunas_ano])
+        blocos = largo.reindex(columns=pd.MultiIndex.from_product([produtos, anos])) \
+            .to_numpy(dtype=object) \
+            .reshape(len(largo), len(produtos), len(anos))
+        
+        # Ordenar por 2023 (se existir) ou pelo último ano disponível
+        ano_ordem = '23' if '23' in anos else sorted(anos)[-1]
+        colunas_saida = ['Produto'] + [f'20{ano}' for ano in anos]
+        
         municipios_dfs = {}
-        for _, row in df_filtrado.iterrows():
-            municipio = row['nome']
-            geocodigo = row['geocodigo']
-            
-            # Identificar colunas de anos (terminadas com 2 dígitos)
-            colunas_ano = [col for col in row.index if col[-2:].isdigit() and col not in ['geocodigo', 'nome']]
-            
-            # Agrupar por produto (prefixo antes do ano)
-            produtos = {}
-            for col in colunas_ano:
-                produto = col[:-2]
-                ano = col[-2:]
-                valor = row[col]
-                
-                if produto not in produtos:
-                    produtos[produto] = {}
-                produtos[produto][ano] = valor
+        for municipio, bloco in zip(df_filtrado['nome'].tolist(), blocos):
+            # Mesma ordenação (e desempate) da versão anterior, aplicada ao bloco já montado
+            df_produtos = pd.DataFrame(bloco, index=produtos, columns=anos).infer_objects()
+            top_10 = df_produtos.sort_values(ano_ordem, ascending=False).head(10)
             
-            # Converter para DataFrame e pegar top 10 produtos com maior valor em 2023
-            df_produtos = pd.DataFrame.from_dict(produtos, orient='index')
-            
-            # Ordenar por 2023 (se existir) ou pelo último ano disponível
-            if '23' in df_produtos.columns:
-                df_produtos = df_produtos.sort_values('23', ascending=False)
-            else:
-                ultimo_ano = sorted(df_produtos.columns)[-1]
-                df_produtos = df_produtos.sort_values(ultimo_ano, ascending=False)
-            
-            # Pegar top 10 e traduzir nomes
-            top_10 = df_produtos.head(10)
+            # Traduzir nomes e adicionar produto como coluna
             top_10.index = [DICIONARIO_PRODUTOS.get(p, p) for p in top_10.index]
-            
-            # Adicionar município como coluna
             top_10 = top_10.reset_index()
-            top_10.columns = ['Produto'] + [f'20{ano}' for ano in top_10.columns[1:]]
+            top_10.columns = colunas_saida
             
             municipios_dfs[municipio] = top_10
         
@@ -809,221 +1353,72 @@ def processar_tabelas_agro(geocodigos):
     
     return resultados
 
-def criar_grafico_unico_municipio(df_municipio, municipio, tipo_dado, tabela_origem):
-    """Cria gráficos com a evolução dos produtos para um município, com formatação específica."""
-    try:
-        if len(df_municipio) == 0:
-            return None
-
-        # Dicionário de títulos personalizados
-        titulos_por_tabela = {
-            'PAM_Quantidade_produzida_14-23': 'PAM - Evolução da Quantidade Produzida',
-            'PAM_Valor_da_producao_14-23': 'PAM - Evolução do Valor da Produção',
-            'PPM_Efetivo_dos_rebanhos_14-23': 'PPM - Evolução do Efetivo dos Rebanhos',
-            'PPM_Prod_origem_animal_14-23': 'PPM - Evolução da Quantidade de Produtos de Origem Animal',
-            'PPM_Valor_da_producao_prod_anim': 'PPM - Evolução do Valor/Receita dos Produtos de Origem Animal',
-            'PPM_Producao_aquicultura_14-23': 'PPM - Evolução da Quantidade Produzida na Aquicultura',
-            'PPM_Valor_producao_aquicultura_': 'PPM - Evolução do Valor/Receita da Produção na Aquicultura',
-            'PEVS_Area_silv_14-23': 'PEVS - Evolução da Área de Silvicultura',
-            'PEVS_Qnt_prod_silv_14-23': 'PEVS - Evolução da Quantidade Produzida na Silvicultura',
-            'PEVS_Valor_prod_silv_14-23': 'PEVS - Evolução do Valor da Produção na Silvicultura'
-        }
-
-        # Dicionário de unidades e ajustes de escala
-        unidades_config = {
-            'PAM_Quantidade_produzida_14-23': {'unidade': 'Mil Toneladas', 'divisor': 1000},
-            'PAM_Valor_da_producao_14-23': {'unidade': 'Mil Reais', 'divisor': 1},
-            'PPM_Efetivo_dos_rebanhos_14-23': {'unidade': 'Cabeças', 'divisor': 1},
-            'PPM_Prod_origem_animal_14-23': {
-                'unidades_especificas': {
-                    'leite': {'unidade': 'Mil Litros', 'divisor': 1},
-                    'ovogal': {'unidade': 'Mil Dúzias', 'divisor': 1},
-                    'ovocod': {'unidade': 'Mil Dúzias', 'divisor': 1},
-                    'mel': {'unidade': 'Quilogramas', 'divisor': 1},
-                    'bichsed': {'unidade': 'Quilogramas', 'divisor': 1}
-                },
-                'default': {'unidade': 'Unidade', 'divisor': 1}
-            },
-            'PPM_Valor_da_producao_prod_anim': {'unidade': 'Mil Reais', 'divisor': 1},
-            'PPM_Producao_aquicultura_14-23': {'unidade': 'Quilogramas', 'divisor': 1},
-            'PPM_Valor_producao_aquicultura_': {'unidade': 'Mil Reais', 'divisor': 1},
-            'PEVS_Area_silv_14-23': {'unidade': 'Hectares', 'divisor': 1, 'ylabel': 'Área'},
-            'PEVS_Qnt_prod_silv_14-23': {
-                'unidades_especificas': {
-                    'carveg': {'unidade': 'Toneladas', 'divisor': 1},
-                    'outprod': {'unidade': 'Toneladas', 'divisor': 1},
-                    'lenha': {'unidade': 'Metros Cúbicos', 'divisor': 1},
-                    'madtor': {'unidade': 'Metros Cúbicos', 'divisor': 1}
-                },
-                'default': {'unidade': 'Unidade', 'divisor': 1}
-            },
-            'PEVS_Valor_prod_silv_14-23': {'unidade': 'Mil Reais', 'divisor': 1}
-        }
-
-        # Lista de tabelas com gráficos únicos (que precisam de altura maior)
-        tabelas_com_grafico_unico = [
-            'PAM_Quantidade_produzida_14-23',
-            'PAM_Valor_da_producao_14-23',
-            'PPM_Efetivo_dos_rebanhos_14-23',
-            'PPM_Valor_da_producao_prod_anim',
-            'PPM_Producao_aquicultura_14-23',
-            'PPM_Valor_producao_aquicultura_',
-            'PEVS_Area_silv_14-23',
-            'PEVS_Valor_prod_silv_14-23'
-        ]
-
-        # Obter configurações da tabela
-        config = unidades_config.get(tabela_origem, {'unidade': 'Unidade', 'divisor': 1})
-        titulo_base = titulos_por_tabela.get(tabela_origem, f"Evolução {tipo_dado}")
-
-        # Função para extrair o nome e chave do produto
-        def get_produto_info(produto_info):
-            if isinstance(produto_info, tuple):
-                produto_nome = produto_info[0]
-                produto_key = produto_nome.lower().replace(' ', '').replace('-', '').replace('_', '')
-                cor = produto_info[1]
-            else:
-                produto_nome = produto_info
-                produto_key = produto_nome.lower().replace(' ', '').replace('-', '').replace('_', '')
-                cor_info = DICIONARIO_PRODUTOS.get(produto_key, ('', '#A9A9A9'))
-                cor = cor_info[1] if isinstance(cor_info, tuple) else '#A9A9A9'
-            return produto_nome, produto_key, cor
-
-        # Função para determinar a unidade de cada produto
-        def get_unidade_produto(produto_key):
-            if 'unidades_especificas' in config:
-                for k, v in config['unidades_especificas'].items():
-                    if produto_key.startswith(k):
-                        return v['unidade'], v['divisor']
-            return config.get('unidade', 'Unidade'), config.get('divisor', 1)
-
-        # Agrupar produtos por unidade de medida
-        grupos = {}
-        for _, row in df_municipio.iterrows():
-            produto_info = row['Produto']
-            produto_nome, produto_key, _ = get_produto_info(produto_info)
-            unidade, divisor = get_unidade_produto(produto_key)
-            
-            if unidade not in grupos:
-                grupos[unidade] = {
-                    'dados': [],
-                    'divisor': divisor
-                }
-            grupos[unidade]['dados'].append(row)
-
-        # Definir altura da figura baseado no tipo de gráfico
-        n_grupos = len(grupos)
-        
-        # Ajustar altura para gráficos únicos (maior) e múltiplos (padrão)
-        if tabela_origem in tabelas_com_grafico_unico:
-            figsize = (14, 10)  # Altura maior para gráficos únicos (1000px)
-        else:
-            figsize = (14, 6 * n_grupos)  # Altura padrão para múltiplos gráficos
-
-        # Criar figura com o tamanho apropriado
-        fig, axs = plt.subplots(n_grupos, 1, figsize=figsize)
-        if n_grupos == 1:
-            axs = [axs]  # Garantir que axs seja sempre uma lista
-
-        # Extrair anos uma única vez (assumindo que todos os produtos têm os mesmos anos)
-        anos_colunas = [col for col in df_municipio.columns if isinstance(col, str) and col.startswith('20')]
-        anos_colunas = sorted(anos_colunas, key=lambda x: int(x[-2:]))
-        anos_int = [int(ano[-2:]) for ano in anos_colunas]
-
-        # Plotar cada grupo em um subplot
-        for i, (unidade, grupo) in enumerate(grupos.items()):
-            ax = axs[i]
-            dados_grupo = grupo['dados']
-            divisor = grupo['divisor']
-            
-            for row in dados_grupo:
-                produto_info = row['Produto']
-                produto_nome, _, cor = get_produto_info(produto_info)
-                
-                valores = [row[ano]/divisor if pd.notna(row[ano]) else None for ano in anos_colunas]
-                
-                if all(pd.isna(valores)):
-                    continue
-                
-                # Converter para arrays numpy
-                valores_arr = np.array(valores)
-                anos_arr = np.array(anos_int)
-                mask = ~pd.isna(valores_arr)
-                
-                # Plotar linha
-                ax.plot(anos_arr[mask], valores_arr[mask], 
-                       marker='o', 
-                       linestyle='-',
-                       color=cor,
-                       label=produto_nome,
-                       linewidth=2.5,
-                       markersize=8,
-                       markeredgecolor='white',
-                       markeredgewidth=1)
-            
-            # Configurações do gráfico
-            titulo_grupo = f"{titulo_base} - {municipio}" if i == 0 else ""
-            ax.set_title(titulo_grupo, fontsize=16, pad=20, fontweight='bold')
-            
-            # Label do eixo Y personalizado
-            ylabel = config.get('ylabel', tipo_dado) if i == 0 and 'ylabel' in config else tipo_dado
-            ax.set_ylabel(f"{ylabel} ({unidade})", fontsize=12)
-            
-            ax.set_xlabel('Ano', fontsize=12)
-            ax.set_xticks(anos_int)
-            ax.set_xticklabels([f"20{ano}" for ano in anos_int], rotation=45 if len(anos_int) > 5 else 0)
-            
-            # Grid e fundo branco
-            ax.grid(True, linestyle=':', alpha=0.6)
-            ax.set_facecolor('white')
-            
-            # Legenda na parte inferior
-            handles, labels = ax.get_legend_handles_labels()
-            ax.legend(handles, labels,
-                     loc='upper center',
-                     bbox_to_anchor=(0.5, -0.15),  # Ajustado para melhor posicionamento
-                     fontsize=10,
-                     framealpha=0.9,
-                     ncol=2)
-        
-        # Ajustar layout para acomodar a legenda
-        plt.tight_layout()
-        if tabela_origem in tabelas_com_grafico_unico:
-            plt.subplots_adjust(bottom=0.25)  # Mais espaço para legenda em gráficos únicos
-        else:
-            plt.subplots_adjust(bottom=0.1 + 0.05 * n_grupos)  # Espaço proporcional para múltiplos gráficos
-        
-        fig.patch.set_facecolor('white')
-        
-        # Salvar para buffer
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png', dpi=150, bbox_inches='tight', facecolor=fig.get_facecolor())
-        buf.seek(0)
-        img = Image.open(buf)
-        plt.close()
-        return img
-            
-    except Exception as e:
-        print(f"Erro ao criar gráfico para {municipio}: {str(e)}")
-        plt.close()
-        return None
-
-def gerar_excel_agro(dados_agro, nome_bacia_export):
+# Estilos do Excel criados uma única vez e compartilhados por todas as células (mesma fonte padrão, em negrito)
+FONTE_NEGRITO = copy(DEFAULT_FONT)
+FONTE_NEGRITO.bold = True
+ALINHAMENTO_CENTRO = Alignment(horizontal='center', vertical='center')
+
+def celula_excel(ws, valor, font=None, alignment=None):
+    """Célula para planilha write-only, com os estilos compartilhados."""
+    cell = WriteOnlyCell(ws, value=valor)
+    if font is not None:
+        cell.font = font
+    if alignment is not None:
+        cell.alignment = alignment
+    return cell
+
+# Largura (px) dos gráficos incorporados à planilha
+LARGURA_GRAFICO_EXCEL = 640
+
+def tipo_dado_tabela(nome_tabela):
+    """Tipo de dado da tabela, usado no título do gráfico."""
+    return "Quantidade Produzida" if "Quantidade" in nome_tabela else \
+           "Valor da Produção" if "Valor" in nome_tabela else \
+           "Efetivo" if "Efetivo" in nome_tabela else "Dados"
+
+def gerar_excel_agro(dados_agro, nome_bacia_export, graficos_na_planilha=False, credenciais=None, saida=st,
+                     cancelamento=None, conta=None):
+    """Gera o Excel dos dados agro e envia Excel e gráficos para o Drive.
+
+    Com `graficos_na_planilha`, cada gráfico é ancorado ao lado do bloco do seu
+    município e só o Excel vai para o Drive (em vez de um PNG por gráfico).
+    `credenciais` e `saida` (mensagens e progresso) permitem rodar fora da thread
+    do Streamlit, com um RegistroMensagens no lugar do st. Se `cancelamento`
+    (threading.Event) for acionado, para antes de montar o Excel ou de enviá-lo.
+    `conta` (sub do OpenID Connect) separa o cache das pastas do Drive por conta
+    (padrão: a da sessão; sem ela, o hash da credencial).
+    """
+    if conta is None:
+        conta = st.session_state.get("conta") if credenciais is None else None
+    if credenciais is None:
+        credenciais = st.session_state["ee_credentials"]
     try:
         output = BytesIO()
-        workbook = Workbook()
-        workbook.remove(workbook.active)
-        
-        graficos_por_municipio = {}
+        # Planilhas em modo write-only: as linhas vão direto para o arquivo, sem manter as células em memória
+        workbook = Workbook(write_only=True)
         
         def get_nome_produto(valor):
             return valor[0] if isinstance(valor, tuple) else valor
+        
+        # Renderizar todos os gráficos em paralelo (arquivos em bytes), antes de escrever as planilhas
+        tarefas_graficos = [
+            ((nome_tabela, municipio), df, municipio, tipo_dado_tabela(nome_tabela), nome_tabela)
+            for nome_tabela, dados in dados_agro.items()
+            if nome_tabela != 'IBGE_Municipios_ZAP' and isinstance(dados, dict)
+            for municipio, df in dados.items()
+            if not df.empty
+        ]
+        # Gráficos incorporados ao Excel precisam ser PNG; para o Drive vale o formato configurado
+        formato_graficos = 'png' if graficos_na_planilha else FORMATO_GRAFICOS
+        graficos_por_municipio = renderizar_graficos(tarefas_graficos, INDICE_PRODUTOS, formato_graficos)
+        if cancelamento is not None and cancelamento.is_set():
+            return None
+        armazem_imagens = ArmazemImagens()
             
         for nome_tabela, dados in dados_agro.items():
             if nome_tabela == 'IBGE_Municipios_ZAP':
                 ws = workbook.create_sheet(title='IBGE_Municipios')
                 for r in dataframe_to_rows(dados, index=True, header=True):
-                    r = [get_nome_produto(cell) if isinstance(cell, str) and cell in DICIONARIO_PRODUTOS else cell for cell in r]
                     ws.append(r)
                 continue
             
@@ -1032,168 +1427,235 @@ def gerar_excel_agro(dados_agro, nome_bacia_export):
                 ws = workbook.create_sheet(title=sheet_name)
                 current_row = 1
                 
-                # Determinar o tipo de dado para o título do gráfico
-                tipo_dado = "Quantidade Produzida" if "Quantidade" in nome_tabela else \
-                           "Valor da Produção" if "Valor" in nome_tabela else \
-                           "Efetivo" if "Efetivo" in nome_tabela else "Dados"
-                
                 for municipio, df in dados.items():
                     if not df.empty:
                         df_display = df.copy()
                         df_display['Produto'] = df_display['Produto'].apply(get_nome_produto)
+                        num_colunas = len(df_display.columns)
+                        inicio_bloco = current_row
                         
-                        ws.append([municipio] + ['']*(len(df_display.columns)-1))
-                        ws.merge_cells(start_row=current_row, start_column=1, 
-                                      end_row=current_row, end_column=len(df_display.columns))
-                        cell = ws.cell(row=current_row, column=1)
-                        from copy import copy
-                        font = copy(cell.font)
-                        font.bold = True
-                        cell.font = font
-                        cell.alignment = Alignment(horizontal='center', vertical='center')
+                        # Título do município mesclado sobre as colunas do bloco
+                        ws.append([celula_excel(ws, municipio, FONTE_NEGRITO, ALINHAMENTO_CENTRO)] + [None]*(num_colunas-1))
+                        ws.merged_cells.add(CellRange(min_col=1, min_row=current_row, max_col=num_colunas, max_row=current_row))
                         current_row += 1
                         
                         header = ['Produto'] + [str(col)[-4:] if str(col).startswith('20') else col for col in df_display.columns[1:]]
-                        ws.append(header)
-                        
-                        for col in range(1, len(header)+1):
-                            cell = ws.cell(row=current_row, column=col)
-                            font = copy(cell.font)
-                            font.bold = True
-                            cell.font = font
-                        
+                        ws.append([celula_excel(ws, valor, FONTE_NEGRITO) for valor in header])
                         current_row += 1
                         
-                        for _, row in df_display.iterrows():
-                            ws.append(row.tolist())
+                        for row in df_display.itertuples(index=False, name=None):
+                            ws.append(row)
                             current_row += 1
                         
-                        ws.append(['']*len(df_display.columns))
+                        ws.append(['']*num_colunas)
                         current_row += 1
                         
-                        img = criar_grafico_unico_municipio(df, municipio, tipo_dado, nome_tabela)
-                        if img:
-                            graficos_por_municipio[(nome_tabela, municipio)] = img
+                        png = graficos_por_municipio.get((nome_tabela, municipio))
+                        if graficos_na_planilha and png:
+                            # Gráfico ao lado do bloco (uma coluna de intervalo); o bloco cresce até a altura da imagem
+                            imagem = armazem_imagens.imagem(png, LARGURA_GRAFICO_EXCEL)
+                            ws.add_image(imagem, f"{get_column_letter(num_colunas + 2)}{inicio_bloco}")
+                            linhas_imagem = -(-imagem.height // ALTURA_LINHA_PX) + 1
+                            while current_row - inicio_bloco < linhas_imagem:
+                                ws.append([])
+                                current_row += 1
         
-        workbook.save(output)
+        salvar_workbook(workbook, output)
         output.seek(0)
+        if cancelamento is not None and cancelamento.is_set():
+            return None
         
         # Exportar para o Google Drive
         try:
-            drive_service = build('drive', 'v3', credentials=st.session_state["ee_credentials"])
-            
-            # 1. Verificar/Criar pasta ZAP
-            query = "name='ZAP' and mimeType='application/vnd.google-apps.folder' and trashed=false and 'root' in parents"
-            results = drive_service.files().list(q=query, fields="files(id, name)").execute()
-            items = results.get('files', [])
-            
-            if items:
-                zap_folder_id = items[0]['id']
-                st.info(f"Pasta ZAP encontrada: {zap_folder_id}")
-            else:
-                file_metadata = {
-                    'name': 'ZAP',
-                    'mimeType': 'application/vnd.google-apps.folder',
-                    'parents': []
-                }
-                folder = drive_service.files().create(body=file_metadata, fields='id').execute()
-                zap_folder_id = folder.get('id')
-                st.success(f"Pasta ZAP criada com ID: {zap_folder_id}")
+            sessao_drive = criar_sessao_drive(credenciais)
+            chave_drive = conta or chave_credencial(credenciais)
             
-            # 2. Criar subpasta para os gráficos
+            # 1. Resolver (ou criar) a pasta ZAP e a subpasta dos gráficos de uma vez, com cache dos ids
             subfolder_name = f"{nome_bacia_export}_graficos"
-            query = f"name='{subfolder_name}' and mimeType='application/vnd.google-apps.folder' and '{zap_folder_id}' in parents and trashed=false"
-            results = drive_service.files().list(q=query, fields="files(id, name)").execute()
-            items = results.get('files', [])
-            
-            if items:
-                graficos_folder_id = items[0]['id']
+            if graficos_na_planilha:
+                zap_folder_id, = resolver_pastas_drive(sessao_drive, ['ZAP'], chave_drive)
             else:
-                file_metadata = {
-                    'name': subfolder_name,
-                    'mimeType': 'application/vnd.google-apps.folder',
-                    'parents': [zap_folder_id]
-                }
-                folder = drive_service.files().create(body=file_metadata, fields='id').execute()
-                graficos_folder_id = folder.get('id')
-            
-            # 3. Upload dos gráficos
-            uploaded_graphs = 0
-            for (tabela, municipio), img in graficos_por_municipio.items():
-                try:
-                    img_bytes = io.BytesIO()
-                    img.save(img_bytes, format='PNG')
-                    img_bytes.seek(0)
-                    
-                    nome_arquivo = f"{tabela[:20]}_{municipio[:30]}.png".replace("/", "_").replace("\\", "_")
-                    
-                    file_metadata = {
-                        'name': nome_arquivo,
-                        'parents': [graficos_folder_id],
-                        'mimeType': 'image/png'
-                    }
-                    
-                    media = MediaIoBaseUpload(img_bytes, mimetype='image/png')
-                    
-                    drive_service.files().create(
-                        body=file_metadata,
-                        media_body=media,
-                        fields='id'
-                    ).execute()
-                    
-                    uploaded_graphs += 1
-                except Exception as e:
-                    print(f"Erro ao enviar gráfico {nome_arquivo}: {e}")
+                zap_folder_id, graficos_folder_id = resolver_pastas_drive(sessao_drive, ['ZAP', subfolder_name], chave_drive)
+            saida.info(f"Pasta ZAP: {zap_folder_id}")
             
-            st.success(f"✅ {uploaded_graphs} gráficos salvos na pasta '{subfolder_name}' no Google Drive")
+            # 2. Upload dos gráficos e do arquivo Excel em paralelo, na mesma sessão HTTP autorizada
+            nome_excel = f"{nome_bacia_export}_dados_agro.xlsx"
+            mimetype_excel = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            arquivos = [(nome_excel, output.getvalue(), mimetype_excel, zap_folder_id)]
+            if not graficos_na_planilha:
+                for (tabela, municipio), grafico in graficos_por_municipio.items():
+                    nome_arquivo = f"{tabela[:20]}_{municipio[:30]}.{formato_graficos}".replace("/", "_").replace("\\", "_")
+                    arquivos.append((nome_arquivo, grafico, FORMATOS_GRAFICOS[formato_graficos], graficos_folder_id))
             
-            # 4. Upload do arquivo Excel
-            file_metadata = {
-                'name': f"{nome_bacia_export}_dados_agro.xlsx",
-                'parents': [zap_folder_id],
-                'mimeType': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-            }
+            barra_upload = saida.progress(0.0, text="Enviando arquivos para o Google Drive...")
+            def progresso_upload(concluidos, total, nome_arquivo, erro):
+                if erro:
+                    logger.warning("Erro ao enviar %s para o Google Drive: %s", nome_arquivo, erro)
+                barra_upload.progress(concluidos / total, text=f"Enviando para o Google Drive: {concluidos}/{total} ({nome_arquivo})")
             
-            media = MediaIoBaseUpload(output, 
-                                    mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                                    resumable=True)
+            enviados, falhas = enviar_arquivos_drive(sessao_drive, arquivos, progresso=progresso_upload)
+            barra_upload.empty()
             
-            drive_service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id'
-            ).execute()
+            if graficos_na_planilha:
+                if nome_excel in enviados:
+                    saida.success(f"✅ Excel com {len(graficos_por_municipio)} gráficos incorporados salvo na pasta 'ZAP' no Google Drive")
+            else:
+                uploaded_graphs = len(enviados) - (1 if nome_excel in enviados else 0)
+                saida.success(f"✅ {uploaded_graphs} gráficos salvos na pasta '{subfolder_name}' no Google Drive")
+            if nome_excel in falhas:
+                saida.error(f"❌ Erro ao enviar {nome_excel} para o Google Drive: {falhas[nome_excel]}")
+            if any(isinstance(erro, requests.HTTPError) and erro.response is not None and erro.response.status_code == 404
+                   for erro in falhas.values()):
+                # Pasta apagada ou movida no Drive: resolver o caminho de novo na próxima exportação
+                invalidar_pastas_drive(chave_drive)
             
-        except HttpError as http_err:
-            if http_err.resp.status == 404:
-                st.error("Erro 404: Pasta não encontrada. Verifique as permissões do Google Drive.")
+        except requests.HTTPError as http_err:
+            if http_err.response is not None and http_err.response.status_code == 404:
+                saida.error("Erro 404: Pasta não encontrada. Verifique as permissões do Google Drive.")
             else:
-                st.error(f"Erro HTTP ao acessar Google Drive: {http_err}")
+                saida.error(f"Erro HTTP ao acessar Google Drive: {http_err}")
         except Exception as e:
-            st.error(f"❌ Erro ao exportar para o Google Drive: {str(e)}")
-            print(f"Erro detalhado: {traceback.format_exc()}")
+            saida.error(f"❌ Erro ao exportar para o Google Drive: {str(e)}")
+            logger.exception("Erro ao exportar para o Google Drive")
         
         return output
         
     except Exception as e:
-        st.error(f"Erro ao gerar Excel: {e}")
-        print(f"Erro detalhado: {traceback.format_exc()}")
+        saida.error(f"Erro ao gerar Excel: {e}")
+        logger.exception("Erro ao gerar o Excel dos dados agro")
         return None
 
-# 6. Processamento principal
-def process_data(geometry, crs, nome_bacia_export="bacia", process_type="all"):
-    try:
-        # Verificar se o Earth Engine está inicializado com o projeto correto
-        if "selected_project" not in st.session_state or "ee_credentials" not in st.session_state:
-            st.error("Earth Engine não foi inicializado corretamente. Por favor, reconecte-se.")
-            return None
-            
-        # Garantir que o Earth Engine está inicializado com o projeto selecionado
+class RegistroMensagens:
+    """Substitui o st nas funções executadas fora da thread do Streamlit.
+
+    Guarda as mensagens (info/success/warning/error) e o último progresso, para a
+    interface exibir depois, na thread do script.
+    """
+
+    def __init__(self):
+        self.mensagens = []
+        self.progresso = None
+        self._lock = threading.Lock()
+
+    def _registrar(self, tipo, texto):
+        with self._lock:
+            self.mensagens.append((tipo, texto))
+
+    def info(self, texto, **kwargs):
+        self._registrar("info", texto)
+
+    def success(self, texto, **kwargs):
+        self._registrar("success", texto)
+
+    def warning(self, texto, **kwargs):
+        self._registrar("warning", texto)
+
+    def error(self, texto, **kwargs):
+        self._registrar("error", texto)
+
+    def progress(self, valor, text=None):
+        self.progresso = (valor, text)
+        return self
+
+    def empty(self):
+        self.progresso = None
+
+    def copiar(self):
+        with self._lock:
+            return list(self.mensagens)
+
+    def exibir(self):
+        exibir_mensagens(self.copiar())
+
+def exibir_mensagens(mensagens):
+    """Exibe mensagens (tipo, texto) gravadas por um RegistroMensagens."""
+    for tipo, texto in mensagens:
+        getattr(st, tipo)(texto)
+
+class ProcessamentoAgro:
+    """Executa a cadeia agro (municípios -> tabelas -> Excel/Drive) em uma thread de segundo plano.
+
+    Não depende das exportações da Earth Engine, então começa junto com elas; os
+    resultados ficam no objeto até o job que o criou gravá-los. Com `projeto`, as
+    consultas à Earth Engine são feitas com essa conta (ee_em_uso); `conta` (dona do
+    job) identifica a conta no cache das pastas do Drive. `cancelar()`
+    interrompe a cadeia na próxima etapa (tabelas, gráficos, Excel, envio ao Drive).
+    """
+
+    def __init__(self, geometry, geometria_bacia, nome_bacia_export, credenciais, graficos_na_planilha, memo, projeto=None,
+                 conta=None):
+        self.geometry = geometry
+        self.geometria_bacia = geometria_bacia
+        self.nome_bacia_export = nome_bacia_export
+        self.credenciais = credenciais
+        self.graficos_na_planilha = graficos_na_planilha
+        self.memo = memo
+        self.projeto = projeto
+        self.conta = conta
+        self.registro = RegistroMensagens()
+        self.etapa = "Aguardando"
+        self.municipios_df = None
+        self.dados_agro = None
+        self.excel = None
+        self._cancelamento = threading.Event()
+        self._thread = threading.Thread(target=self._executar, name="processamento-agro", daemon=True)
+
+    def iniciar(self):
+        self._thread.start()
+
+    def cancelar(self):
+        self._cancelamento.set()
+
+    def cancelado(self):
+        return self._cancelamento.is_set()
+
+    def concluido(self):
+        return self._thread.ident is not None and not self._thread.is_alive()
+
+    def _executar(self):
         try:
-            ee.Initialize(st.session_state["ee_credentials"], project=st.session_state["selected_project"])
+            self.etapa = "Selecionando os municípios da bacia"
+            conta_ee = (self.credenciais, self.projeto) if self.projeto is not None else None
+            df_municipios = selecionar_municipios(self.geometry, self.geometria_bacia, self.memo, self.registro, conta_ee)
+            if df_municipios.empty:
+                self.registro.warning("Nenhum município com mais de 20% de área na bacia foi encontrado.")
+                return
+            self.municipios_df = df_municipios
+            if self.cancelado():
+                return
+            
+            self.etapa = "Processando as tabelas do IBGE"
+            self.dados_agro = processar_tabelas_agro(df_municipios['geocodigo'].tolist(), self.registro, self._cancelamento)
+            if not self.dados_agro or self.cancelado():
+                return
+            
+            self.etapa = "Gerando o Excel e enviando para o Google Drive"
+            self.excel = gerar_excel_agro(self.dados_agro, self.nome_bacia_export, self.graficos_na_planilha,
+                                          self.credenciais, self.registro, self._cancelamento, self.conta)
         except Exception as e:
-            st.error(f"Erro ao reinicializar Earth Engine: {e}")
-            return None
+            self.registro.error(f"Erro ao processar dados agro: {e}")
+            logger.exception("Erro ao processar dados agro")
+        finally:
+            self.etapa = "Concluído"
+
+# 6. Processamento principal
+def process_data(geometry, crs, nome_bacia_export="bacia", selecao=None,
+                 credenciais=None, projeto=None, memo=None, saida=st):
+    """Prepara os produtos de sensoriamento remoto selecionados (os dados agro ficam no ProcessamentoAgro).
+
+    `selecao` tem as opções exportar_* e o epsg_bacia (padrão: st.session_state).
+    Fora da thread do Streamlit, informar também `credenciais`, `projeto`, `memo`
+    (metadados da bacia) e `saida` (mensagens).
+    """
+    try:
+        if selecao is None:
+            selecao = st.session_state
+        if credenciais is None:
+            # Verificar se o Earth Engine está inicializado com o projeto correto
+            if "selected_project" not in st.session_state or "ee_credentials" not in st.session_state:
+                saida.error("Earth Engine não foi inicializado corretamente. Por favor, reconecte-se.")
+                return None
+            credenciais, projeto = st.session_state["ee_credentials"], st.session_state["selected_project"]
         
         data_atual = datetime.datetime.now()
         mes_formatado = data_atual.strftime("%b")  # Ex: "Jan"
@@ -1208,158 +1670,358 @@ def process_data(geometry, crs, nome_bacia_export="bacia", process_type="all"):
             "ano_anterior": ano_anterior,
         }
         
-        # Processar apenas dados agro se especificado
-        if process_type == "agro":
-            st.info("Processando dados agro e socioeconômicos...")
-            municipios_df = processar_municipios(geometry, nome_bacia_export)
-            
-            if municipios_df is not None:
-                geocodigos = municipios_df['geocodigo'].tolist()
-                dados_agro = processar_tabelas_agro(geocodigos)
-                return dados_agro
-            
-            return None
-        
-        # Processar apenas sensoriamento remoto
-        elif process_type == "remoto":
-            # Calcular o bounding box da geometria
-            bbox = geometry.bounds()
-            bacia = bbox.buffer(1000)  # 1000 metros = 1 km
-            periodo_fim = ee.Date(data_atual.strftime("%Y-%m-%d"))
-            periodo_inicio = periodo_fim.advance(-365, 'day')
-
-            # Carregar imagens Sentinel-2 se selecionado
-            if st.session_state.get("exportar_sentinel_composite"):
-                sentinel = ee.ImageCollection("COPERNICUS/S2_SR_HARMONIZED") \
-                    .select(['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B8A', 'B9', 'B11', 'B12']) \
-                    .filterMetadata('CLOUDY_PIXEL_PERCENTAGE', 'less_than', 10) \
-                    .filterBounds(bacia) \
-                    .filterDate(periodo_inicio, periodo_fim)
-
-                num_imagens = sentinel.size().getInfo()
-                if num_imagens == 0:
-                    st.error("Nenhuma imagem Sentinel-2 encontrada para o período especificado.")
-                else:
-                    st.success(f"Imagens Sentinel-2 encontradas: {num_imagens}")
-                    sentinel_median = sentinel.median().clip(bacia)
-                    sentinel_composite = sentinel_median.select(['B2', 'B3', 'B4', 'B8']).rename(['B2', 'B3', 'B4', 'B8'])
-                    
-                    try:
-                        # Criar uma FeatureCollection com as informações das imagens
-                        sentinel_list = sentinel.toList(sentinel.size())
-                        features = ee.FeatureCollection(sentinel_list.map(lambda img: ee.Feature(None, {
-                            'id': ee.Image(img).id(),
-                            'date': ee.Image(img).date().format('YYYY-MM-dd'),
-                            'cloud_cover': ee.Image(img).get('CLOUDY_PIXEL_PERCENTAGE')
-                        })))
-
-                        # Exportar a lista de imagens para um arquivo CSV
-                        export_task = ee.batch.Export.table.toDrive(
-                            collection=features,
-                            folder='zap',
-                            description='lista_imagens_sentinel-2',
-                            fileFormat='CSV'
-                        )
-                        export_task.start()
-                        st.success("Exportação da lista de imagens Sentinel-2 iniciada. Verifique seu Google Drive na pasta 'zap'.")
-                    except Exception as e:
-                        st.error(f"Erro ao exportar a lista de imagens Sentinel-2: {e}")
-
-            # Gerar índices se selecionados
-            indices = {}
-            if st.session_state.get("exportar_ndvi"):
-                indices["NDVI"] = sentinel_median.normalizedDifference(['B8', 'B4'])
-            if st.session_state.get("exportar_gndvi"):
-                indices["GNDVI"] = sentinel_median.normalizedDifference(['B8', 'B3'])
-            if st.session_state.get("exportar_ndwi"):
-                indices["NDWI"] = sentinel_median.normalizedDifference(['B3', 'B8'])
-            if st.session_state.get("exportar_ndmi"):
-                indices["NDMI"] = sentinel_median.normalizedDifference(['B8', 'B11'])
-
-            # Carregar MDE e Declividade se selecionados
-            if st.session_state.get("exportar_srtm_mde") or st.session_state.get("exportar_declividade"):
-                mde_proj = ee.ImageCollection("JAXA/ALOS/AW3D30/V3_2").filterBounds(bacia).first().select(0).projection()
-                mde = ee.ImageCollection("JAXA/ALOS/AW3D30/V3_2").filterBounds(bacia).mosaic().clip(bacia).setDefaultProjection(mde_proj)
-                elevation = mde.select('DSM')
-
-                if st.session_state.get("exportar_declividade"):
-                    declividade_graus = ee.Terrain.slope(elevation)
-                    declividade = declividade_graus.divide(180).multiply(3.14159).tan().multiply(100)
-                    declividade_reclass = declividade.expression(
-                        "b(0) == 0 ? 1 : " + 
-                        "b(0) <= 3 ? 1 : " + 
-                        "(b(0) > 3 && b(0) <= 8) ? 2 : " + 
-                        "(b(0) > 8 && b(0) <= 20) ? 3 : " + 
-                        "(b(0) > 20 && b(0) <= 45) ? 4 : " + 
-                        "(b(0) > 45 && b(0) <= 75) ? 5 : " + 
-                        "(b(0) > 75) ? 6 : -1"
-                    )
-
-            # Carregar MapBiomas 2023 se selecionado
-            if st.session_state.get("exportar_mapbiomas"):
-                mapbiomas = ee.Image("projects/mapbiomas-public/assets/brazil/lulc/collection9/mapbiomas_collection90_integration_v1") \
-                    .select('classification_2023') \
-                    .clip(bacia)
-
-            # Carregar Qualidade de Pastagens se selecionado
-            if st.session_state.get("exportar_pasture_quality"):
-                pasture_quality = ee.Image("projects/mapbiomas-public/assets/brazil/lulc/collection9/mapbiomas_collection90_pasture_quality_v1") \
-                    .select('pasture_quality_2023') \
-                    .clip(bacia)
-
-            # Carregar PUC (UFV, IBGE, Embrapa) se selecionados
-            if st.session_state.get("exportar_puc_ufv"):
-                puc_ufv = ee.ImageCollection('users/zap/puc_ufv').filterBounds(bacia).mosaic().clip(bacia)
-            if st.session_state.get("exportar_puc_ibge"):
-                puc_ibge = ee.ImageCollection('users/zap/puc_ibge').filterBounds(bacia).mosaic().clip(bacia)
-            if st.session_state.get("exportar_puc_embrapa"):
-                puc_embrapa = ee.ImageCollection('users/zap/puc_embrapa').filterBounds(bacia).mosaic().clip(bacia)
-
-            # Carregar Landforms se selecionado
-            if st.session_state.get("exportar_landforms"):
-                landforms = ee.Image('CSP/ERGo/1_0/Global/SRTM_landforms').clip(bacia)
-
-            # Determinar o EPSG com base no fuso
+        # Plano mínimo: só as camadas que os produtos selecionados usam, cada uma montada uma vez
+        plano = planejar(selecao)
+        avaliador = Avaliador(plano, geometry, data_atual)
+        bacia = avaliador.obter("bacia")
+
+        # Determinar o EPSG com base no fuso (localmente; a Earth Engine fica como alternativa)
+        consultas = {}
+        epsg = selecao.get("epsg_bacia")
+        if epsg is None:
+            # Mesmo critério do cálculo local: o fuso com a maior área de interseção com a bacia
             fusos_mg = ee.FeatureCollection('users/zap/fusos_mg')
-            fuso_maior_area = fusos_mg.filterBounds(bacia).map(lambda f: f.set('area', f.area())).sort('area', False).first()
-            epsg = fuso_maior_area.get('epsg').getInfo()
-
-            # Reprojetar todas as imagens selecionadas
-            if st.session_state.get("exportar_srtm_mde"):
-                resultados["utm_elevation"] = reprojetarImagem(elevation, epsg, 30)
-            if st.session_state.get("exportar_declividade"):
-                resultados["utm_declividade"] = reprojetarImagem(declividade_reclass, epsg, 30).float()
-            if st.session_state.get("exportar_ndvi"):
-                resultados["utm_ndvi"] = reprojetarImagem(indices["NDVI"], epsg, 10)
-            if st.session_state.get("exportar_gndvi"):
-                resultados["utm_gndvi"] = reprojetarImagem(indices["GNDVI"], epsg, 10)
-            if st.session_state.get("exportar_ndwi"):
-                resultados["utm_ndwi"] = reprojetarImagem(indices["NDWI"], epsg, 10)
-            if st.session_state.get("exportar_ndmi"):
-                resultados["utm_ndmi"] = reprojetarImagem(indices["NDMI"], epsg, 10)
-            if st.session_state.get("exportar_sentinel_composite"):
-                resultados["utm_sentinel2"] = reprojetarImagem(sentinel_composite, epsg, 10).float()
-            if st.session_state.get("exportar_mapbiomas"):
-                resultados["utm_mapbiomas"] = reprojetarImagem(mapbiomas, epsg, 30)
-            if st.session_state.get("exportar_pasture_quality"):
-                resultados["utm_pasture_quality"] = reprojetarImagem(pasture_quality, epsg, 30).float()
-            if st.session_state.get("exportar_landforms"):
-                resultados["utm_landforms"] = reprojetarImagem(landforms, epsg, 30)
-            if st.session_state.get("exportar_puc_ufv"):
-                resultados["utm_puc_ufv"] = reprojetarImagem(puc_ufv, epsg, 30).float()
-            if st.session_state.get("exportar_puc_ibge"):
-                resultados["utm_puc_ibge"] = reprojetarImagem(puc_ibge, epsg, 30).float()
-            if st.session_state.get("exportar_puc_embrapa"):
-                resultados["utm_puc_embrapa"] = reprojetarImagem(puc_embrapa, epsg, 30).float()
-            
-            return resultados
+            fuso_maior_area = fusos_mg.filterBounds(bacia).map(
+                lambda f: f.set('area', f.geometry().intersection(geometry, 1).area(1))
+            ).sort('area', False).first()
+            consultas['epsg'] = fuso_maior_area.get('epsg')
+
+        if plano.usa("sentinel"):
+            sentinel = avaliador.obter("sentinel")
+            consultas['num_imagens'] = sentinel.size()
+
+        # Todos os valores do servidor em um único getInfo (memoizado por bacia)
+        with ee_em_uso(credenciais, projeto):
+            metadados = obter_metadados_bacia(geometry, consultas, memo)
+        if epsg is None:
+            epsg = metadados['epsg']
+
+        # Imagens Sentinel-2 (para a composição e para os índices)
+        if plano.usa("sentinel"):
+            num_imagens = metadados['num_imagens']
+            if num_imagens == 0:
+                saida.error("Nenhuma imagem Sentinel-2 encontrada para o período especificado.")
+                plano = plano.sem_dependentes("sentinel")
+            else:
+                saida.success(f"Imagens Sentinel-2 encontradas: {num_imagens}")
+                
+                try:
+                    # Criar uma FeatureCollection com as informações das imagens
+                    sentinel_list = sentinel.toList(sentinel.size())
+                    features = ee.FeatureCollection(sentinel_list.map(lambda img: ee.Feature(None, {
+                        'id': ee.Image(img).id(),
+                        'date': ee.Image(img).date().format('YYYY-MM-dd'),
+                        'cloud_cover': ee.Image(img).get('CLOUDY_PIXEL_PERCENTAGE')
+                    })))
+
+                    # Exportar a lista de imagens para um arquivo CSV
+                    export_task = ee.batch.Export.table.toDrive(
+                        collection=features,
+                        folder='zap',
+                        description='lista_imagens_sentinel-2',
+                        fileFormat='CSV'
+                    )
+                    with ee_em_uso(credenciais, projeto):
+                        export_task.start()
+                    saida.success("Exportação da lista de imagens Sentinel-2 iniciada. Verifique seu Google Drive na pasta 'zap'.")
+                except Exception as e:
+                    saida.error(f"Erro ao exportar a lista de imagens Sentinel-2: {e}")
+
+        # Produtos selecionados (as camadas compartilhadas são montadas uma única vez); a
+        # projeção UTM da bacia é aplicada na exportação (criarExportacao), sem reproject(),
+        # e cada produto sai no tipo de dado da sua política (TIPOS_DADO)
+        resultados["epsg"] = epsg
+        for produto in plano.produtos:
+            resultados[produto.nome] = converter_tipo(avaliador.obter(produto.fonte), produto.tipo)
         
-        return None
+        return resultados
         
     except Exception as e:
-        st.error(f"Erro ao processar dados: {e}")
+        saida.error(f"Erro ao processar dados: {e}")
         return None
 
+# Opções de produtos de sensoriamento remoto (chaves do formulário e da especificação do job)
+PRODUTOS_REMOTO = [produto.opcao for produto in PRODUTOS]
+
+# Grupos de produtos (Produto.grupo) na mesma grade e escala, calculados a partir do mesmo
+# intermediário (mediana do Sentinel-2; MDE), que a exportação empilhada grava em um GeoTIFF por
+# tipo de dado; `{tipo}` só é preenchido (ex.: "_int16") quando o grupo sai em mais de uma pilha
+GRUPOS_EMPILHAMENTO = {
+    "sentinel2": {"prefixo": "06_", "sufixo": "_S2_empilhado{tipo}_{periodo}", "escala": 10},
+    "terreno": {"prefixo": "06_", "sufixo": "_Terreno_empilhado{tipo}", "escala": 30},
+}
+
+def montar_exportacoes(resultados, selecao, empilhar=False):
+    """Lista (imagem, nome_prefixo, nome_sufixo, escala, nodata) das imagens preparadas por process_data.
+
+    Com `empilhar`, os produtos de cada grupo de GRUPOS_EMPILHAMENTO são separados em
+    pilhas que não alargam o tipo de dado (separar_por_tipo); cada pilha com mais de
+    um produto vira uma imagem multibanda no tipo comum (tipo_comum), e os produtos
+    que ficam sozinhos saem como na exportação individual. Retorna também o manifesto das bandas empilhadas:
+    lista de dicionários com arquivo, banda (a partir de 1), nome_banda, produto
+    (nome do arquivo individual), escala e o tipo, o fator e o nodata do produto.
+    """
+    periodo = f"{resultados['mes_formatado']}{resultados['ano_anterior']}-{resultados['ano_atual']}"
+    nome_bacia_export = resultados["nome_bacia_export"]
+    selecionados = [produto for produto in PRODUTOS if selecao.get(produto.opcao) and produto.nome in resultados]
+    
+    pilhas = []  # (grupo, membros, tipo comum, sufixo do arquivo)
+    if empilhar:
+        for grupo, config in GRUPOS_EMPILHAMENTO.items():
+            membros = [produto for produto in selecionados if produto.grupo == grupo]
+            pilhas_grupo = [pilha for pilha in separar_por_tipo(membros) if len(pilha) > 1]
+            for membros_pilha in pilhas_grupo:
+                tipo = tipo_comum([produto.tipo for produto in membros_pilha])
+                sufixo_tipo = f"_{TIPOS_DADO[tipo]['base']}" if len(pilhas_grupo) > 1 else ""
+                pilhas.append((grupo, membros_pilha, tipo, config["sufixo"].format(tipo=sufixo_tipo, periodo=periodo)))
+    empilhados = {produto.nome for _, membros, _, _ in pilhas for produto in membros}
+    
+    exportacoes = [
+        (resultados[produto.nome], produto.prefixo, produto.sufixo.format(periodo=periodo), produto.escala,
+         TIPOS_DADO[produto.tipo]["nodata"] if produto.tipo else None)
+        for produto in selecionados
+        if produto.nome not in empilhados
+    ]
+    manifesto = []
+    for grupo, membros, tipo, sufixo_grupo in pilhas:
+        config = GRUPOS_EMPILHAMENTO[grupo]
+        arquivo = f"{config['prefixo']}{nome_bacia_export}{sufixo_grupo}"
+        imagens, banda = [], 0
+        for produto in membros:
+            imagens.append(resultados[produto.nome].rename(produto.bandas))
+            for nome_banda in produto.bandas:
+                banda += 1
+                manifesto.append({
+                    "arquivo": arquivo,
+                    "banda": banda,
+                    "nome_banda": nome_banda,
+                    "produto": f"{produto.prefixo}{nome_bacia_export}{produto.sufixo.format(periodo=periodo)}",
+                    "escala": config["escala"],
+                    "tipo": produto.tipo or "",
+                    "fator": TIPOS_DADO[produto.tipo]["fator"] if produto.tipo else 1,
+                    "nodata": TIPOS_DADO[produto.tipo]["nodata"] if produto.tipo else "",
+                })
+        exportacoes.append((converter_tipo(ee.Image.cat(imagens), tipo), config["prefixo"], sufixo_grupo,
+                            config["escala"], TIPOS_DADO[tipo]["nodata"]))
+    return exportacoes, manifesto
+
+# 6.1 Jobs: o processamento roda nos workers da fila; a interface só consulta o estado
+INTERVALO_JOB = 5  # segundos entre as atualizações do progresso de um job
+
+def serializar_credenciais(credenciais, projeto):
+    """Dados para recriar a credencial no worker (o job pode ser retomado depois de uma queda).
+
+    O refresh token vai junto: o acompanhamento das tarefas da Earth Engine costuma
+    durar mais que a validade do token de acesso (1 h). A fila grava tudo cifrado.
+    """
+    return {
+        "token": credenciais.token,
+        "refresh_token": credenciais.refresh_token,
+        "expiry": credenciais.expiry.isoformat() if credenciais.expiry else None,
+        "projeto": projeto,
+    }
+
+def credenciais_job(dados):
+    return Credentials(
+        token=dados["token"],
+        refresh_token=dados.get("refresh_token"),
+        token_uri=TOKEN_URL,
+        client_id=CLIENT_ID,
+        client_secret=CLIENT_SECRET,
+        scopes=SCOPES,
+        expiry=datetime.datetime.fromisoformat(dados["expiry"]) if dados.get("expiry") else None
+    )
+
+def resultado_agro(agro, job_id):
+    """Resultado do ProcessamentoAgro em forma serializável (o Excel vai para um arquivo do job)."""
+    resultado = {"mensagens": agro.registro.copiar(), "municipios": None, "arquivo_excel": None}
+    if agro.municipios_df is not None:
+        resultado["municipios"] = agro.municipios_df.to_dict("records")
+    if agro.excel:
+        caminho = caminho_arquivo_job(job_id, f"{agro.nome_bacia_export}_dados_agro.xlsx")
+        with open(caminho, "wb") as f:
+            f.write(agro.excel.getvalue())
+        resultado["arquivo_excel"] = caminho
+    return resultado
+
+def interromper_job(contexto, agro=None, monitor=None):
+    """Para o job que não está mais com este worker (retorna None, como o executor).
+
+    O processamento agro sempre para; as tarefas da Earth Engine só são canceladas se
+    o usuário cancelou o job (um job retomado por outro worker continua acompanhando-as).
+    """
+    if agro is not None:
+        agro.cancelar()
+    if monitor is not None and contexto.cancelado():
+        monitor.cancelar_pendentes()
+    return None
+
+def executar_job(job, contexto, memo=None):
+    """Executa um job da fila na thread de um worker (nada aqui usa st.session_state).
+
+    `memo` é o memo de metadados das bacias compartilhado pelos jobs (MemoBacias), para
+    que outra execução da mesma bacia no mesmo dia não repita o getInfo.
+
+    Sensoriamento remoto e dados agro rodam em paralelo. Os ids das tarefas da Earth
+    Engine e o resultado agro ficam no progresso do job: um job retomado depois de
+    uma queda volta a acompanhar as tarefas, sem exportar nem processar de novo.
+    """
+    spec = job["spec"]
+    produtos = spec["produtos"]
+    nome_bacia_export = spec["nome_bacia_export"]
+    projeto = job["credenciais"]["projeto"]
+    credenciais = credenciais_job(job["credenciais"])
+    geometry = ee.Geometry(spec["geometria"])
+    selecao = dict(produtos, epsg_bacia=spec.get("epsg_bacia"))
+    if memo is None:
+        memo = {}
+    registro = RegistroMensagens()
+    registro.mensagens = [tuple(mensagem) for mensagem in contexto.progresso.get("mensagens", [])]
+    
+    agro = None
+    if produtos.get("exportar_dados_agro") and "agro" not in contexto.progresso:
+        agro = ProcessamentoAgro(geometry, shape(spec["geometria"]), nome_bacia_export, credenciais,
+                                 spec.get("graficos_na_planilha", False), memo, projeto, job["conta"])
+        agro.iniciar()
+    
+    # Preparar e iniciar as exportações da Earth Engine (uma única vez por job)
+    ids_tarefas = contexto.progresso.get("tarefas_ee")
+    if ids_tarefas is None and any(produtos.get(chave) for chave in PRODUTOS_REMOTO):
+        if not contexto.atualizar("Preparando os produtos de sensoriamento remoto"):
+            return interromper_job(contexto, agro)
+        tasks = []
+        # A conta só fica presa (ee_em_uso) durante as chamadas ao servidor, não na montagem
+        resultados = process_data(geometry, spec["crs"], nome_bacia_export, selecao,
+                                  credenciais, projeto, memo, registro)
+        if resultados:
+            exportacoes, manifesto = montar_exportacoes(resultados, selecao, spec.get("exportacao_empilhada", False))
+            with ee_em_uso(credenciais, projeto):
+                tasks = exportarImagens(exportacoes, geometry, nome_bacia_export, saida=registro, epsg=resultados["epsg"])
+                if manifesto:
+                    tasks.append(exportarManifesto(manifesto, nome_bacia_export, saida=registro))
+        ids_tarefas = [task.id for task in tasks if task is not None]
+        if not contexto.atualizar(tarefas_ee=ids_tarefas, mensagens=registro.copiar()):
+            return interromper_job(contexto, agro, MonitorTarefasEE(ids_tarefas, credenciais=credenciais, projeto=projeto))
+    
+    monitor = None
+    if ids_tarefas:
+        monitor = MonitorTarefasEE(ids_tarefas, credenciais=credenciais, projeto=projeto)
+        monitor.iniciar()
+    try:
+        while True:
+            remoto_pronto = monitor is None or monitor.concluido()
+            agro_pronto = agro is None or agro.concluido()
+            progresso = {}
+            if monitor is not None:
+                progresso.update(status_tarefas=monitor.status(), erro_monitor=monitor.erro)
+            if agro is not None:
+                if agro_pronto:
+                    progresso.update(agro=resultado_agro(agro, job["id"]), etapa_agro=None, progresso_agro=None)
+                    agro = None
+                else:
+                    progresso.update(etapa_agro=agro.etapa, progresso_agro=agro.registro.progresso)
+            
+            if not remoto_pronto:
+                etapa = "Processando produtos de sensoriamento remoto na Earth Engine"
+            elif not agro_pronto:
+                etapa = "Processando dados agro e socioeconômicos"
+            else:
+                etapa = "Finalizando"
+            if not contexto.atualizar(etapa, **progresso):
+                return interromper_job(contexto, agro, monitor)
+            if remoto_pronto and agro_pronto:
+                return contexto.progresso
+            time.sleep(INTERVALO_JOB)
+    finally:
+        if monitor is not None:
+            monitor.parar()
+
+def chave_credenciais_jobs():
+    """Chave Fernet das credenciais gravadas na fila ([jobs] chave_credenciais nos secrets, ou ZAP_JOBS_CHAVE)."""
+    if "jobs" in st.secrets and "chave_credenciais" in st.secrets["jobs"]:
+        return st.secrets["jobs"]["chave_credenciais"]
+    return os.environ.get("ZAP_JOBS_CHAVE")
+
+@st.cache_resource
+def fila_jobs():
+    """Fila de jobs e pool de workers deste processo do servidor, compartilhados por todas as sessões."""
+    fila = FilaJobs(chave=chave_credenciais_jobs())
+    fila.limpar()
+    PoolWorkers(fila, functools.partial(executar_job, memo=MemoBacias())).iniciar()
+    return fila
+
+def exibir_progresso_tarefas(status_tarefas, erro_monitor=None):
+    total = len(status_tarefas)
+    concluidas = sum(1 for s in status_tarefas if s["state"] == "COMPLETED")
+    st.progress(concluidas / total if total else 1.0)
+    for status in status_tarefas:
+        exibir_status_tarefa(status)
+    if erro_monitor:
+        st.warning(f"Erro ao consultar o status das tarefas (nova tentativa em instantes): {erro_monitor}")
+    st.warning(f"⌛ Progresso: {concluidas}/{total} tarefas concluídas")
+
+@st.fragment(run_every=5)
+def painel_job(job_id):
+    """Atualiza só o painel do job (lendo a fila); a página inteira roda de novo apenas no fim."""
+    job = fila_jobs().obter(job_id)
+    if job is None or job["estado"] in ESTADOS_FINAIS_JOB:
+        st.rerun()
+    
+    progresso = job["progresso"] or {}
+    if job["estado"] == "pendente":
+        st.info("⏳ Processamento na fila, aguardando um worker disponível...")
+    else:
+        st.write(f"⏳ {job['etapa']}...")
+    if progresso.get("status_tarefas"):
+        exibir_progresso_tarefas(progresso["status_tarefas"], progresso.get("erro_monitor"))
+    if progresso.get("etapa_agro"):
+        st.info(f"⏳ Dados agro/socioeconômicos: {progresso['etapa_agro']}...")
+        if progresso.get("progresso_agro"):
+            valor, texto = progresso["progresso_agro"]
+            st.progress(valor, text=texto)
+
+def exibir_resultado_job(job):
+    """Resultado final do job (concluído, cancelado ou falho)."""
+    dados = job["resultado"] or job["progresso"] or {}
+    nome_bacia_export = job["spec"]["nome_bacia_export"]
+    
+    exibir_mensagens(dados.get("mensagens", []))
+    status_tarefas = dados.get("status_tarefas") or []
+    for status in status_tarefas:
+        exibir_status_tarefa(status)
+    if status_tarefas:
+        concluidas = sum(1 for s in status_tarefas if s["state"] == "COMPLETED")
+        if concluidas == len(status_tarefas):
+            st.success("✅ Todos os produtos de sensoriamento foram processados!")
+        else:
+            st.warning(f"⚠️ {concluidas}/{len(status_tarefas)} produtos de sensoriamento foram concluídos.")
+    
+    agro = dados.get("agro")
+    if agro:
+        exibir_mensagens(agro["mensagens"])
+        if agro["municipios"]:
+            exibir_municipios(pd.DataFrame(agro["municipios"]))
+        if agro["arquivo_excel"] and os.path.exists(agro["arquivo_excel"]):
+            with open(agro["arquivo_excel"], "rb") as f:
+                st.download_button(
+                    label="📥 Baixar Dados Agro e Socioeconômicos",
+                    data=f.read(),
+                    file_name=f"{nome_bacia_export}_dados_agro.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    key=f"download_agro_{job['id']}"
+                )
+    
+    if job["estado"] == "cancelado":
+        st.warning("Processamento cancelado pelo usuário")
+    elif job["estado"] == "falhou":
+        st.error(f"Erro ao processar dados: {job['erro']}")
+    else:
+        st.success("Todos os processamentos foram concluídos com sucesso!")
+        st.info("ℹ️ Os dados estão disponíveis em: (1) Seu download local e (2) Pasta 'zap' no Google Drive")
+        st.markdown(
+            f"[Abrir pasta 'zap' no Google Drive](https://drive.google.com/drive/)",
+            unsafe_allow_html=True)
+
 # 7. Interface do usuário (modificar apenas a parte do processamento)
 if 'token' not in st.session_state:
     st.write("Para começar, conecte-se à sua conta Google:")
@@ -1385,9 +2047,13 @@ else:
                 token_uri=TOKEN_URL,
                 client_id=CLIENT_ID,
                 client_secret=CLIENT_SECRET,
-                scopes=SCOPES
+                scopes=SCOPES,
+                # Expiração informada pelo OAuth (UTC sem fuso, como o google-auth espera)
+                expiry=datetime.datetime.fromtimestamp(token['expires_at'], datetime.timezone.utc).replace(tzinfo=None) if token.get('expires_at') else None
             )
             st.session_state["ee_credentials"] = credentials
+            # Conta Google (None com um token sem o escopo openid: sem cache de projeto)
+            st.session_state["conta"] = identificar_conta(credentials)
             
             # Obter lista de projetos
             service = build('cloudresourcemanager', 'v1', credentials=credentials)
@@ -1404,7 +2070,7 @@ else:
             if "selected_project" in st.session_state:
                 try:
                     # Testar se o projeto armazenado ainda é válido
-                    ee.Initialize(credentials, project=st.session_state["selected_project"])
+                    garantir_ee_inicializado(credentials, st.session_state["selected_project"])
                     st.session_state["ee_initialized"] = True
                     st.success(f"Earth Engine reinicializado no projeto: {st.session_state['selected_project']}")
                 except Exception as e:
@@ -1415,18 +2081,31 @@ else:
             if "selected_project" not in st.session_state:
                 # Ordenar projetos por nome para consistência
                 project_ids_sorted = sorted(project_ids)
+                conta = st.session_state["conta"]
                 
-                # Procurar um projeto com EE ativado
+                # Primeiro o último projeto que funcionou para esta conta
                 selected_project = None
-                for project in project_ids_sorted:
+                projeto_salvo = ultimo_projeto(conta)
+                if projeto_salvo in project_ids:
                     try:
-                        ee.Initialize(credentials, project=project)
-                        selected_project = project
-                        break
+                        garantir_ee_inicializado(credentials, projeto_salvo)
+                        selected_project = projeto_salvo
                     except Exception as e:
-                        continue
+                        project_ids_sorted.remove(projeto_salvo)
+                
+                # Procurar um projeto com EE ativado (sondagens em paralelo; vale o primeiro que responder)
+                if selected_project is None:
+                    with st.spinner("Procurando um projeto com Earth Engine ativado..."):
+                        for project in sondar_projetos_ee(credentials, project_ids_sorted):
+                            try:
+                                garantir_ee_inicializado(credentials, project)
+                                selected_project = project
+                                break
+                            except Exception as e:
+                                continue
                 
                 if selected_project:
+                    salvar_ultimo_projeto(conta, selected_project)
                     st.session_state["selected_project"] = selected_project
                     st.session_state["ee_initialized"] = True
                     st.success(f"Earth Engine inicializado com sucesso no projeto: {selected_project}")
@@ -1440,7 +2119,8 @@ else:
                     )
                     if st.button("Confirmar Projeto"):
                         try:
-                            ee.Initialize(credentials, project=selected_project)
+                            garantir_ee_inicializado(credentials, selected_project)
+                            salvar_ultimo_projeto(conta, selected_project)
                             st.session_state["selected_project"] = selected_project
                             st.session_state["ee_initialized"] = True
                             st.success(f"Earth Engine inicializado com sucesso no projeto: {selected_project}")
@@ -1454,6 +2134,18 @@ else:
             st.stop()
 
     if st.session_state.get("ee_initialized"):
+        fila = fila_jobs()
+        # Dono dos jobs: a conta Google (sub do OpenID Connect). Sem identidade (login
+        # antigo, sem o escopo openid), os jobs ficam presos a esta sessão
+        conta = st.session_state.get("conta")
+        if conta is None:
+            st.session_state.setdefault("conta_sessao", f"sessao:{uuid.uuid4().hex}")
+        # Processamento desta conta ainda em andamento (ex.: aba fechada e aberta de novo)
+        if conta is not None and st.session_state.job_id is None:
+            em_andamento = [job for job in fila.listar(conta) if job["estado"] not in ESTADOS_FINAIS_JOB]
+            if em_andamento:
+                st.session_state.job_id = em_andamento[0]["id"]
+        
         uploaded_file = st.file_uploader(
             "Carregue o arquivo GeoJSON da bacia (apenas 1 polígono/multipolígono, SIRGAS 2000 (4674), máximo 1 MB)",
             type=["geojson"],
@@ -1509,11 +2201,19 @@ else:
                             st.markdown("**Geomorfologia**")
                             exportar_landforms = st.checkbox("Landforms (30m)", value=st.session_state.get('select_all', False))
                         
+                        exportacao_empilhada = st.checkbox(
+                            "Exportar os produtos do Sentinel-2 (10m) e do MDE (30m) empilhados, em um GeoTIFF multibanda por grupo (e tipo de dado)",
+                            value=st.session_state.get('exportacao_empilhada', False),
+                            help="A mediana do Sentinel-2 e o MDE são calculados uma única vez por grupo, em vez de uma vez por produto. "
+                                 "Um CSV (manifesto) indica o produto de cada banda; use o script dividir_empilhado.py para separar os arquivos."
+                        )
+                        
                         st.markdown("---")
                         
                         st.subheader("📊 Dados Agro e Socioeconômicos")
                         st.caption("Municípios com representatividade >20% na bacia hidrográfica")
                         exportar_dados_agro = st.checkbox("Ativar processamento de dados do IBGE", value=st.session_state.get('select_ibge', False))
+                        graficos_na_planilha = st.checkbox("Incorporar os gráficos no Excel (um único arquivo no Drive)", value=st.session_state.get('graficos_na_planilha', False))
                         
                         st.markdown("---")                    
                         submit_button = st.form_submit_button(label='✅ Confirmar Seleção')
@@ -1533,157 +2233,40 @@ else:
                             "exportar_puc_ibge": exportar_puc_ibge,
                             "exportar_puc_embrapa": exportar_puc_embrapa,
                             "exportar_landforms": exportar_landforms,
-                            "exportar_dados_agro": exportar_dados_agro
+                            "exportar_dados_agro": exportar_dados_agro,
+                            "graficos_na_planilha": graficos_na_planilha,
+                            "exportacao_empilhada": exportacao_empilhada
                         })
                         st.success("Seleção de produtos confirmada!")
                                     
                     if st.session_state.get("exportar_srtm_mde") is not None and nome_bacia_export:
-                        if not st.session_state.processing:
+                        job = fila.obter(st.session_state.job_id) if st.session_state.job_id else None
+                        if job is None or job["estado"] in ESTADOS_FINAIS_JOB:
                             if st.button("Processar Dados"):
-                                st.session_state.processing = True
-                                st.session_state.tasks_remoto = []
-                                st.session_state.completed_tasks = 0
-                                st.session_state.resultados = None
+                                # Especificação do job: tudo o que o worker precisa, sem st.session_state
+                                spec = {
+                                    "geometria": mapping(st.session_state["geometria_bacia"]),
+                                    "crs": crs,
+                                    "epsg_bacia": st.session_state.get("epsg_bacia"),
+                                    "nome_bacia_export": nome_bacia_export,
+                                    "produtos": {chave: bool(st.session_state.get(chave)) for chave in PRODUTOS_REMOTO + ["exportar_dados_agro"]},
+                                    "graficos_na_planilha": bool(st.session_state.get("graficos_na_planilha")),
+                                    "exportacao_empilhada": bool(st.session_state.get("exportacao_empilhada")),
+                                }
+                                st.session_state.job_id = fila.enfileirar(
+                                    spec, conta or st.session_state["conta_sessao"],
+                                    serializar_credenciais(st.session_state["ee_credentials"], st.session_state["selected_project"])
+                                )
                                 st.rerun()
-                        else:
-                            if st.button("❌ Cancelar Processamento"):
-                                st.session_state.processing = False
-                                st.warning("Processamento cancelado pelo usuário")
-                                st.rerun()
-
-                        if st.session_state.processing:
-                            with st.spinner("Processando dados, por favor aguarde..."):
-                                # Verificar se deve processar sensoriamento remoto
-                                process_remoto = any([
-                                    st.session_state.get("exportar_srtm_mde"),
-                                    st.session_state.get("exportar_declividade"), 
-                                    st.session_state.get("exportar_ndvi"),
-                                    st.session_state.get("exportar_gndvi"),
-                                    st.session_state.get("exportar_ndwi"),
-                                    st.session_state.get("exportar_ndmi"),
-                                    st.session_state.get("exportar_sentinel_composite"),
-                                    st.session_state.get("exportar_mapbiomas"),
-                                    st.session_state.get("exportar_pasture_quality"),
-                                    st.session_state.get("exportar_landforms"),
-                                    st.session_state.get("exportar_puc_ufv"),
-                                    st.session_state.get("exportar_puc_ibge"),
-                                    st.session_state.get("exportar_puc_embrapa")
-                                ])
-                                
-                                # Verificar se deve processar dados agro
-                                st.session_state.process_agro = st.session_state.get("exportar_dados_agro")
-                                
-                                # Processar apenas agro se for o único selecionado
-                                if not process_remoto and st.session_state.process_agro:
-                                    dados_agro = process_data(geometry, crs, nome_bacia_export, "agro")
-                                    if dados_agro:
-                                        excel_agro = gerar_excel_agro(dados_agro, nome_bacia_export)
-                                        if excel_agro:
-                                            st.download_button(
-                                                label="📥 Baixar Dados Agro e Socioeconômicos",
-                                                data=excel_agro,
-                                                file_name=f"{nome_bacia_export}_dados_agro.xlsx",
-                                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                                key=f"download_agro_{int(time.time())}"
-                                            )
-                                            st.success("✅ Os dados também foram enviados automaticamente para a pasta **'zap'** no seu Google Drive")
-                                            st.session_state.processing = False
-                                
-                                # Processar sensoriamento remoto (e agro depois, se selecionado)
-                                elif process_remoto:
-                                    if st.session_state.resultados is None:  # Primeira execução
-                                        st.session_state.resultados = process_data(geometry, crs, nome_bacia_export, "remoto")
-                                    
-                                    if st.session_state.resultados:
-                                        if not st.session_state.tasks_remoto:  # Iniciar exportação das imagens
-                                            # Exportar produtos de sensoriamento remoto
-                                            resultados = st.session_state.resultados
-                                            tasks = []
-                                            if st.session_state.get("exportar_srtm_mde") and "utm_elevation" in resultados:
-                                                tasks.append(exportarImagem(resultados["utm_elevation"], "06_", "_SRTM_MDE", 30, geometry, nome_bacia_export))
-                                            if st.session_state.get("exportar_declividade") and "utm_declividade" in resultados:
-                                                tasks.append(exportarImagem(resultados["utm_declividade"], "02_", "_Declividade", 30, geometry, nome_bacia_export))
-                                            if st.session_state.get("exportar_ndvi") and "utm_ndvi" in resultados:
-                                                tasks.append(exportarImagem(resultados["utm_ndvi"], "06_", f"_NDVImediana_{resultados['mes_formatado']}{resultados['ano_anterior']}-{resultados['ano_atual']}", 10, geometry, nome_bacia_export))
-                                            if st.session_state.get("exportar_gndvi") and "utm_gndvi" in resultados:
-                                                tasks.append(exportarImagem(resultados["utm_gndvi"], "06_", f"_GNDVI_{resultados['mes_formatado']}{resultados['ano_anterior']}-{resultados['ano_atual']}", 10, geometry, nome_bacia_export))
-                                            if st.session_state.get("exportar_ndwi") and "utm_ndwi" in resultados:
-                                                tasks.append(exportarImagem(resultados["utm_ndwi"], "06_", f"_NDWI_{resultados['mes_formatado']}{resultados['ano_anterior']}-{resultados['ano_atual']}", 10, geometry, nome_bacia_export))
-                                            if st.session_state.get("exportar_ndmi") and "utm_ndmi" in resultados:
-                                                tasks.append(exportarImagem(resultados["utm_ndmi"], "06_", f"_NDMI_{resultados['mes_formatado']}{resultados['ano_anterior']}-{resultados['ano_atual']}", 10, geometry, nome_bacia_export))
-                                            if st.session_state.get("exportar_sentinel_composite") and "utm_sentinel2" in resultados:
-                                                tasks.append(exportarImagem(resultados["utm_sentinel2"], "06_", f"_S2_B2B3B4B8_{resultados['mes_formatado']}{resultados['ano_anterior']}-{resultados['ano_atual']}", 10, geometry, nome_bacia_export))
-                                            if st.session_state.get("exportar_mapbiomas") and "utm_mapbiomas" in resultados:
-                                                tasks.append(exportarImagem(resultados["utm_mapbiomas"], "06_", "_MapBiomas_col9_2023", 30, geometry, nome_bacia_export))
-                                            if st.session_state.get("exportar_pasture_quality") and "utm_pasture_quality" in resultados:
-                                                tasks.append(exportarImagem(resultados["utm_pasture_quality"], "06_", "_Vigor_Pastagem_col9_2023", 30, geometry, nome_bacia_export))
-                                            if st.session_state.get("exportar_landforms") and "utm_landforms" in resultados:
-                                                tasks.append(exportarImagem(resultados["utm_landforms"], "06_", "_Landforms", 30, geometry, nome_bacia_export))
-                                            if st.session_state.get("exportar_puc_ufv") and "utm_puc_ufv" in resultados:
-                                                tasks.append(exportarImagem(resultados["utm_puc_ufv"], "02_", "_PUC_UFV", 30, geometry, nome_bacia_export))
-                                            if st.session_state.get("exportar_puc_ibge") and "utm_puc_ibge" in resultados:
-                                                tasks.append(exportarImagem(resultados["utm_puc_ibge"], "02_", "_PUC_IBGE", 30, geometry, nome_bacia_export))
-                                            if st.session_state.get("exportar_puc_embrapa") and "utm_puc_embrapa" in resultados:
-                                                tasks.append(exportarImagem(resultados["utm_puc_embrapa"], "02_", "_PUC_Embrapa", 30, geometry, nome_bacia_export))
-                                            
-                                            st.session_state.tasks_remoto = tasks
-                                            st.success("Tarefas de exportação iniciadas na Earth Engine!")
-                                    
-                                    # Verificação do status das tarefas
-                                    if st.session_state.tasks_remoto:
-                                        status_container = st.empty()
-                                        
-                                        with status_container:
-                                            st.write("⏳ Processando produtos de sensoriamento remoto na Earth Engine...")
-                                            progress_bar = st.progress(st.session_state.completed_tasks / len(st.session_state.tasks_remoto))
-                                            status_text = st.empty()
-                                            
-                                            todas_concluidas = True
-                                            completed = 0
-                                            
-                                            for i, task in enumerate(st.session_state.tasks_remoto):
-                                                state = check_task_status(task)
-                                                status_text.write(f"Tarefa {i+1}/{len(st.session_state.tasks_remoto)}: {state}")
-                                                
-                                                if state == "COMPLETED":
-                                                    completed += 1
-                                                else:
-                                                    todas_concluidas = False
-                                            
-                                            st.session_state.completed_tasks = completed
-                                            progress_bar.progress(completed / len(st.session_state.tasks_remoto))
-                                            
-                                            if todas_concluidas:
-                                                st.success("✅ Todos os produtos de sensoriamento foram processados!")
-                                                
-                                                # Processar dados agro APÓS o sensoriamento, se selecionado
-                                                if st.session_state.process_agro:
-                                                    st.write("Iniciando processamento de dados agro/socioeconômicos...")
-                                                    municipios_df = processar_municipios(geometry, nome_bacia_export)
-                                                    
-                                                    if municipios_df is not None:
-                                                        dados_agro = processar_tabelas_agro([int(x) for x in municipios_df['geocodigo'].tolist()])
-                                                        
-                                                        if dados_agro:
-                                                            excel_agro = gerar_excel_agro(dados_agro, nome_bacia_export)
-                                                            if excel_agro:
-                                                                st.download_button(
-                                                                    label="📥 Baixar Dados Agro e Socioeconômicos",
-                                                                    data=excel_agro,
-                                                                    file_name=f"{nome_bacia_export}_dados_agro.xlsx",
-                                                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                                                    key=f"download_agro_{int(time.time())}"
-                                                                )
-                                                
-                                                st.session_state.processing = False
-                                                st.success("Todos os processamentos foram concluídos com sucesso!")
-                                                st.info("ℹ️ Os dados estão disponíveis em: (1) Seu download local e (2) Pasta 'zap' no Google Drive")
-                                                st.markdown(
-                                                    f"[Abrir pasta 'zap' no Google Drive](https://drive.google.com/drive/)",
-                                                    unsafe_allow_html=True)
-                                            else:
-                                                st.warning(f"⌛ Progresso: {completed}/{len(st.session_state.tasks_remoto)} tarefas concluídas")
-                                                time.sleep(30)  # Espera 30 segundos antes de atualizar
-                                                st.rerun()
                     else:
-                        st.warning("Por favor, preencha o nome para exportação antes de selecionar os produtos.")
\ No newline at end of file
+                        st.warning("Por favor, preencha o nome para exportação antes de selecionar os produtos.")        
+        # Processamento da sessão (ou retomado): a interface só consulta o job na fila
+        job = fila.obter(st.session_state.job_id) if st.session_state.job_id else None
+        if job is not None:
+            if job["estado"] not in ESTADOS_FINAIS_JOB:
+                if st.button("❌ Cancelar Processamento"):
+                    fila.cancelar(job["id"])
+                    st.rerun()
+                painel_job(job["id"])
+            else:
+                exibir_resultado_job(job)
@@ -0,0 +1,142 @@
+"""Compara a projeção antiga (reproject() antes da exportação) com a da exportação (crs/crsTransform).
+
+Para cada bacia de amostra e cada produto, inicia as duas exportações para o
+Drive (pasta PASTA_COMPARACAO) e acompanha as tarefas até o fim, informando o
+tempo de execução e o uso de EECU de cada uma. A igualdade das saídas é
+verificada no servidor, na grade da exportação: a maior diferença absoluta entre
+as duas imagens e a quantidade de pixels com máscara diferente devem ser 0.
+
+Uso (depois de `earthengine authenticate`):
+    python comparar_projecao.py --projeto PROJETO --epsg 31983 bacia1.geojson [bacia2.geojson ...]
+        [--produtos utm_ndvi utm_elevation ...]
+
+As bacias são GeoJSON em SIRGAS 2000 com um único polígono, como no app.
+"""
+import os
+import json
+import time
+import argparse
+import datetime
+
+import ee
+
+from produtos_ee import PRODUTOS, planejar, Avaliador, grade_exportacao, converter_tipo
+
+PASTA_COMPARACAO = "zap_comparacao_projecao"
+INTERVALO_CONSULTA = 15
+ESTADOS_FINAIS = {"COMPLETED", "FAILED", "CANCELLED"}
+
+
+def carregar_geometria(caminho):
+    with open(caminho, encoding="utf-8") as f:
+        dados = json.load(f)
+    if dados.get("type") == "FeatureCollection":
+        dados = dados["features"][0]
+    if dados.get("type") == "Feature":
+        dados = dados["geometry"]
+    return ee.Geometry(dados)
+
+
+def _exportar(imagem, nome, regiao, **projecao):
+    task = ee.batch.Export.image.toDrive(
+        image=imagem,
+        description=nome,
+        folder=PASTA_COMPARACAO,
+        fileNamePrefix=nome,
+        region=regiao,
+        fileFormat='GeoTIFF',
+        maxPixels=1e13,
+        **projecao,
+    )
+    task.start()
+    return task.id
+
+
+def diferencas(antiga, nova, regiao, crs, transformacao):
+    """Maior diferença absoluta e pixels com máscara diferente, na grade da exportação."""
+    nova = nova.reproject(crs=crs, crsTransform=transformacao)
+    diferenca = antiga.subtract(nova).abs().reduce(ee.Reducer.max()).rename('diferenca_maxima')
+    mascara = antiga.mask().reduce(ee.Reducer.min()).neq(nova.mask().reduce(ee.Reducer.min())).rename('pixels_mascara_diferente')
+    return ee.Dictionary({
+        'diferenca_maxima': diferenca.reduceRegion(
+            reducer=ee.Reducer.max(), geometry=regiao, crs=crs, crsTransform=transformacao, maxPixels=1e13
+        ).get('diferenca_maxima'),
+        'pixels_mascara_diferente': mascara.unmask(0).reduceRegion(
+            reducer=ee.Reducer.sum(), geometry=regiao, crs=crs, crsTransform=transformacao, maxPixels=1e13
+        ).get('pixels_mascara_diferente'),
+    })
+
+
+def iniciar_comparacao(caminho_bacia, produtos, epsg, data_atual):
+    """Inicia as exportações nos dois modos; retorna as linhas da comparação (ainda sem os tempos)."""
+    geometria = carregar_geometria(caminho_bacia)
+    nome_bacia = os.path.splitext(os.path.basename(caminho_bacia))[0]
+    plano = planejar({produto.opcao: True for produto in produtos})
+    avaliador = Avaliador(plano, geometria, data_atual)
+    crs = f"EPSG:{epsg}"
+
+    linhas = []
+    for produto in plano.produtos:
+        imagem = converter_tipo(avaliador.obter(produto.fonte), produto.tipo)
+        transformacao = grade_exportacao(produto.escala)
+        # Como antes: reproject() no grafo e a escala repetida na exportação
+        antiga = imagem.reproject(crs=crs, scale=produto.escala)
+        linhas.append({
+            "bacia": nome_bacia,
+            "produto": produto.nome,
+            "reproject": _exportar(antiga, f"{nome_bacia}_{produto.nome}_reproject", geometria, scale=produto.escala),
+            "exportacao": _exportar(imagem, f"{nome_bacia}_{produto.nome}_exportacao", geometria,
+                                    crs=crs, crsTransform=transformacao),
+            "diferencas": diferencas(antiga, imagem, geometria, crs, transformacao),
+        })
+    return linhas
+
+
+def aguardar_tarefas(ids):
+    """Status final de cada tarefa: {id: status}."""
+    status = {}
+    while True:
+        pendentes = [task_id for task_id in ids if status.get(task_id, {}).get("state") not in ESTADOS_FINAIS]
+        if not pendentes:
+            return status
+        for item in ee.data.getTaskStatus(pendentes):
+            status[item["id"]] = item
+        time.sleep(INTERVALO_CONSULTA)
+
+
+def _tempo(status):
+    if status.get("state") != "COMPLETED":
+        return status.get("state")
+    return f"{(int(status['update_timestamp_ms']) - int(status['start_timestamp_ms'])) / 1000:.0f} s"
+
+
+def _eecu(status):
+    valor = status.get("batch_eecu_usage_seconds")
+    return f"{float(valor):.0f}" if valor is not None else "-"
+
+
+def comparar(bacias, nomes_produtos, epsg):
+    produtos = [produto for produto in PRODUTOS if not nomes_produtos or produto.nome in nomes_produtos]
+    data_atual = datetime.datetime.now()
+    linhas = [linha for bacia in bacias for linha in iniciar_comparacao(bacia, produtos, epsg, data_atual)]
+    # As diferenças são calculadas (em um único getInfo) enquanto as exportações rodam
+    diferencas_por_linha = ee.List([linha["diferencas"] for linha in linhas]).getInfo()
+    status = aguardar_tarefas([linha[modo] for linha in linhas for modo in ("reproject", "exportacao")])
+
+    print(f"{'bacia':<20} {'produto':<22} {'tempo reproject':>16} {'tempo exportação':>17} "
+          f"{'EECU-s antes':>12} {'EECU-s agora':>12} {'dif. máx.':>10} {'máscara':>8}")
+    for linha, dif in zip(linhas, diferencas_por_linha):
+        antes, agora = status[linha["reproject"]], status[linha["exportacao"]]
+        print(f"{linha['bacia']:<20} {linha['produto']:<22} {_tempo(antes):>16} {_tempo(agora):>17} "
+              f"{_eecu(antes):>12} {_eecu(agora):>12} {str(dif['diferenca_maxima']):>10} {str(dif['pixels_mascara_diferente']):>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("bacias", nargs="+", help="arquivos GeoJSON das bacias de amostra")
+    parser.add_argument("--projeto", required=True, help="projeto do Cloud com a Earth Engine ativada")
+    parser.add_argument("--epsg", required=True, type=int, help="EPSG do fuso UTM das bacias (ex.: 31983)")
+    parser.add_argument("--produtos", nargs="*", help="nomes dos produtos (padrão: todos)")
+    argumentos = parser.parse_args()
+    ee.Initialize(project=argumentos.projeto)
+    comparar(argumentos.bacias, argumentos.produtos, argumentos.epsg)
@@ -0,0 +1,5 @@
+"""Configuração compartilhada pelos módulos do app (lida do ambiente uma única vez)."""
+import os
+
+# Pasta dos arquivos locais: tabelas e gráficos em cache, fila de jobs, projetos da Earth Engine
+CACHE_DIR = os.environ.get("ZAP_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "zap_mg"))
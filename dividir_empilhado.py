@@ -0,0 +1,89 @@
+"""Separa um GeoTIFF empilhado (exportação empilhada do ZAP) nos arquivos de cada produto.
+
+Usa o manifesto de bandas exportado junto (CSV com arquivo, banda, nome_banda,
+produto, escala, tipo, fator e nodata). Cada produto vira um GeoTIFF com as suas
+bandas, no mesmo nome, tipo de dado e nodata que teria na exportação individual
+(o empilhado usa um tipo comum aos produtos da pilha). Os índices continuam
+multiplicados pelo `fator` do manifesto. Quando a Earth Engine divide a
+exportação em blocos (arquivo-0000000000-0000000000.tif), cada bloco é
+separado à parte e mantém o sufixo do bloco.
+
+Uso:
+    python dividir_empilhado.py ARQUIVO.tif MANIFESTO.csv [PASTA_DESTINO]
+
+Requer o rasterio (não faz parte das dependências do app).
+"""
+import os
+import sys
+import csv
+
+
+def _tipo_geotiff(tipo):
+    """Tipo de dado do GeoTIFF para a política de tipo do manifesto ('int16_x10000' -> 'int16')."""
+    base = tipo.split("_")[0] if tipo else None
+    return "float32" if base == "float" else base
+
+
+def ler_manifesto(caminho_manifesto):
+    """{arquivo empilhado: {produto: {"bandas": [(banda, nome_banda), ...], "tipo": ..., "nodata": ...}}}.
+
+    As bandas ficam na ordem do empilhado; `tipo` é o tipo de dado do GeoTIFF do
+    produto (ex.: 'int16' para a política 'int16_x10000') e `nodata` o seu valor
+    sem dado (None quando o manifesto não informa, como nos manifestos antigos).
+    """
+    arquivos = {}
+    with open(caminho_manifesto, newline="", encoding="utf-8") as f:
+        for linha in csv.DictReader(f):
+            produtos = arquivos.setdefault(linha["arquivo"], {})
+            produto = produtos.setdefault(linha["produto"], {
+                "bandas": [],
+                "tipo": _tipo_geotiff(linha.get("tipo")),
+                "nodata": float(linha["nodata"]) if linha.get("nodata") else None,
+            })
+            produto["bandas"].append((int(linha["banda"]), linha["nome_banda"]))
+    for produtos in arquivos.values():
+        for produto in produtos.values():
+            produto["bandas"].sort()
+    return arquivos
+
+
+def dividir_geotiff(caminho_tif, manifesto, destino=None):
+    """Grava um GeoTIFF por produto a partir do empilhado; retorna os caminhos gravados."""
+    import rasterio
+
+    nome = os.path.splitext(os.path.basename(caminho_tif))[0]
+    arquivo = next((a for a in sorted(manifesto, key=len, reverse=True) if nome.startswith(a)), None)
+    if arquivo is None:
+        raise ValueError(f"{nome} não está no manifesto de bandas")
+    sufixo_bloco = nome[len(arquivo):]
+    destino = destino or os.path.dirname(os.path.abspath(caminho_tif))
+    os.makedirs(destino, exist_ok=True)
+
+    gravados = []
+    with rasterio.open(caminho_tif) as origem:
+        perfil = origem.profile
+        for produto, config in manifesto[arquivo].items():
+            bandas = config["bandas"]
+            tipo = config["tipo"] or perfil["dtype"]
+            nodata = config["nodata"] if config["nodata"] is not None else origem.nodata
+            caminho_saida = os.path.join(destino, f"{produto}{sufixo_bloco}.tif")
+            with rasterio.open(caminho_saida, "w", **dict(perfil, count=len(bandas), dtype=tipo, nodata=nodata)) as saida:
+                for indice, (banda, nome_banda) in enumerate(bandas, start=1):
+                    dados = origem.read(banda)
+                    # O nodata do empilhado vira o nodata do produto
+                    sem_dado = dados == origem.nodata if origem.nodata is not None else None
+                    dados = dados.astype(tipo)
+                    if sem_dado is not None and nodata is not None:
+                        dados[sem_dado] = nodata
+                    saida.write(dados, indice)
+                    saida.set_band_description(indice, nome_banda)
+            gravados.append(caminho_saida)
+    return gravados
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        print(__doc__)
+        sys.exit(1)
+    for caminho in dividir_geotiff(sys.argv[1], ler_manifesto(sys.argv[2]), sys.argv[3] if len(sys.argv) == 4 else None):
+        print(caminho)
@@ -0,0 +1,244 @@
+"""Envio de arquivos para o Google Drive do usuário.
+
+Os ids das pastas do ZAP ficam em cache por conta, e o caminho inteiro é
+resolvido em uma única consulta. Os uploads usam a API REST do Drive v3 diretamente sobre uma única sessão HTTP
+autorizada (google.auth AuthorizedSession), em um pool limitado de threads e
+com novas tentativas com backoff exponencial em 429/5xx. O endereço base da API
+é configurável para permitir testes contra um servidor local que imita o Drive.
+"""
+import json
+import time
+import random
+import uuid
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from google.auth.transport.requests import AuthorizedSession
+
+DRIVE_BASE_URL = "https://www.googleapis.com"
+
+# Acima deste tamanho o arquivo é enviado em upload resumable (recomendação da API: 5 MB)
+LIMITE_UPLOAD_MULTIPART = 5 * 1024 * 1024
+
+MAX_WORKERS_UPLOAD = 4
+MAX_TENTATIVAS = 5
+ESPERA_INICIAL = 1.0
+ESPERA_MAXIMA = 32.0
+
+STATUS_REPETIR = {429, 500, 502, 503, 504}
+
+MIME_PASTA = "application/vnd.google-apps.folder"
+
+logger = logging.getLogger(__name__)
+
+# Cache de ids de pastas: {(chave da conta, caminho): (id, expira_em)}; a chave é o sub do
+# OpenID Connect quando conhecido (ou chave_credencial), para sessões da mesma conta dividirem o lock
+TTL_CACHE_PASTAS = 6 * 3600
+_cache_pastas = {}
+_locks_pastas = {}
+_cache_pastas_lock = threading.Lock()
+
+
+def criar_sessao_drive(credentials, max_conexoes=MAX_WORKERS_UPLOAD):
+    """Cria uma sessão HTTP autorizada, reaproveitada por todas as threads de upload."""
+    sessao = AuthorizedSession(credentials)
+    adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=max_conexoes)
+    sessao.mount("https://", adaptador)
+    sessao.mount("http://", adaptador)
+    return sessao
+
+
+def _requisicao_com_repeticao(sessao, metodo, url, tentativas=MAX_TENTATIVAS, **kwargs):
+    """Executa a requisição repetindo em 429/5xx e falhas de conexão, com backoff exponencial."""
+    espera = ESPERA_INICIAL
+    for tentativa in range(1, tentativas + 1):
+        try:
+            resposta = sessao.request(metodo, url, timeout=(10, 120), **kwargs)
+            if resposta.status_code not in STATUS_REPETIR:
+                resposta.raise_for_status()
+                return resposta
+            if tentativa == tentativas:
+                resposta.raise_for_status()
+            # Respeitar o Retry-After quando o servidor informar
+            retry_after = resposta.headers.get("Retry-After")
+            atraso = float(retry_after) if retry_after and retry_after.isdigit() else espera
+        except (requests.ConnectionError, requests.Timeout):
+            if tentativa == tentativas:
+                raise
+            atraso = espera
+        time.sleep(min(atraso, ESPERA_MAXIMA) + random.uniform(0, atraso / 2))
+        espera = min(espera * 2, ESPERA_MAXIMA)
+
+
+def enviar_arquivo_drive(sessao, nome, conteudo, mimetype, pasta_id, base_url=DRIVE_BASE_URL):
+    """Envia um arquivo (bytes) para a pasta do Drive e retorna o id criado."""
+    metadados = {"name": nome, "parents": [pasta_id], "mimeType": mimetype}
+    url = f"{base_url}/upload/drive/v3/files"
+
+    if len(conteudo) <= LIMITE_UPLOAD_MULTIPART:
+        fronteira = uuid.uuid4().hex
+        corpo = b"".join([
+            f"--{fronteira}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n".encode(),
+            json.dumps(metadados).encode("utf-8"),
+            f"\r\n--{fronteira}\r\nContent-Type: {mimetype}\r\n\r\n".encode(),
+            conteudo,
+            f"\r\n--{fronteira}--".encode(),
+        ])
+        resposta = _requisicao_com_repeticao(
+            sessao, "POST", url,
+            params={"uploadType": "multipart", "fields": "id"},
+            data=corpo,
+            headers={"Content-Type": f"multipart/related; boundary={fronteira}"},
+        )
+        return resposta.json()["id"]
+
+    # Arquivos grandes: abrir sessão resumable e enviar o conteúdo de uma vez
+    resposta = _requisicao_com_repeticao(
+        sessao, "POST", url,
+        params={"uploadType": "resumable", "fields": "id"},
+        json=metadados,
+        headers={"X-Upload-Content-Type": mimetype, "X-Upload-Content-Length": str(len(conteudo))},
+    )
+    resposta = _requisicao_com_repeticao(
+        sessao, "PUT", resposta.headers["Location"],
+        data=conteudo,
+        headers={"Content-Type": mimetype},
+    )
+    return resposta.json()["id"]
+
+
+def enviar_arquivos_drive(sessao, arquivos, max_workers=MAX_WORKERS_UPLOAD, progresso=None, base_url=DRIVE_BASE_URL):
+    """Envia vários arquivos em paralelo.
+
+    `arquivos` é uma lista de (nome, conteudo, mimetype, pasta_id). `progresso`, se
+    informado, é chamado na thread de quem chamou a função (seguro para o Streamlit)
+    como progresso(concluidos, total, nome, erro) a cada arquivo finalizado.
+    Retorna {nome: id} dos arquivos enviados e {nome: erro} das falhas.
+    """
+    enviados, falhas = {}, {}
+    if not arquivos:
+        return enviados, falhas
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futuros = {
+            executor.submit(enviar_arquivo_drive, sessao, nome, conteudo, mimetype, pasta_id, base_url): nome
+            for nome, conteudo, mimetype, pasta_id in arquivos
+        }
+        for concluidos, futuro in enumerate(as_completed(futuros), start=1):
+            nome = futuros[futuro]
+            erro = None
+            try:
+                enviados[nome] = futuro.result()
+            except Exception as e:
+                erro = e
+                falhas[nome] = e
+            if progresso:
+                progresso(concluidos, len(arquivos), nome, erro)
+
+    return enviados, falhas
+
+
+def chave_credencial(credentials):
+    """Identificador estável (hash) da credencial, usado para separar o cache por conta."""
+    segredo = getattr(credentials, "refresh_token", None) or getattr(credentials, "token", "") or ""
+    return hashlib.sha256(segredo.encode("utf-8")).hexdigest()[:16]
+
+
+def _escapar_consulta(nome):
+    return nome.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def _lock_credencial(chave):
+    with _cache_pastas_lock:
+        return _locks_pastas.setdefault(chave, threading.Lock())
+
+
+def _listar_pastas(sessao, condicoes, base_url):
+    """Lista, em uma única consulta (paginada), as pastas que atendem a qualquer das condições."""
+    pastas = []
+    params = {
+        "q": f"mimeType='{MIME_PASTA}' and trashed=false and ({' or '.join(condicoes)})",
+        "fields": "nextPageToken, files(id, name, parents, createdTime)",
+        "orderBy": "createdTime",
+        "pageSize": 1000,
+        "spaces": "drive",
+    }
+    while True:
+        resposta = _requisicao_com_repeticao(sessao, "GET", f"{base_url}/drive/v3/files", params=params).json()
+        pastas.extend(resposta.get("files", []))
+        if not resposta.get("nextPageToken"):
+            return pastas
+        params["pageToken"] = resposta["nextPageToken"]
+
+
+def _criar_pasta(sessao, nome, pai_id, base_url):
+    metadados = {"name": nome, "mimeType": MIME_PASTA}
+    if pai_id:
+        metadados["parents"] = [pai_id]
+    criada = _requisicao_com_repeticao(sessao, "POST", f"{base_url}/drive/v3/files", params={"fields": "id"}, json=metadados).json()
+
+    # Se outra instância criou a mesma pasta ao mesmo tempo, todas passam a usar a mais
+    # antiga, e a que acabou de ser criada é apagada para não ficar uma duplicata vazia
+    condicao_pai = f"'{pai_id}' in parents" if pai_id else "'root' in parents"
+    pastas = _listar_pastas(sessao, [f"(name='{_escapar_consulta(nome)}' and {condicao_pai})"], base_url)
+    if not pastas or pastas[0]["id"] == criada["id"]:
+        return criada["id"]
+    try:
+        _requisicao_com_repeticao(sessao, "DELETE", f"{base_url}/drive/v3/files/{criada['id']}")
+    except requests.RequestException as e:
+        logger.warning("Não foi possível apagar a pasta duplicada %s (%s): %s", nome, criada["id"], e)
+    return pastas[0]["id"]
+
+
+def resolver_pastas_drive(sessao, caminho, chave, ttl=TTL_CACHE_PASTAS, base_url=DRIVE_BASE_URL):
+    """Resolve (criando se preciso) o caminho de pastas a partir da raiz do Drive.
+
+    `caminho` é uma lista de nomes, ex.: ['ZAP', 'Bacia_graficos']. Retorna a lista de
+    ids na mesma ordem. Os ids ficam em cache por conta (`chave`) durante `ttl`
+    segundos; as partes que faltam são buscadas em uma única consulta ao Drive.
+    """
+    caminho = tuple(caminho)
+    agora = time.time()
+
+    # Serializa a resolução por conta: duas sessões não criam a mesma pasta em duplicidade
+    with _lock_credencial(chave):
+        ids = []
+        for i in range(1, len(caminho) + 1):
+            entrada = _cache_pastas.get((chave, caminho[:i]))
+            if not entrada or entrada[1] < agora:
+                break
+            ids.append(entrada[0])
+
+        faltantes = caminho[len(ids):]
+        if faltantes:
+            pai_id = ids[-1] if ids else None
+            condicoes = [
+                f"(name='{_escapar_consulta(faltantes[0])}' and "
+                + (f"'{pai_id}' in parents)" if pai_id else "'root' in parents)")
+            ] + [f"name='{_escapar_consulta(nome)}'" for nome in faltantes[1:]]
+            pastas = _listar_pastas(sessao, condicoes, base_url)
+
+            for nome in faltantes:
+                # Sem pai conhecido (raiz), a própria consulta já restringiu a primeira parte à raiz
+                candidatas = [
+                    p for p in pastas
+                    if p["name"] == nome and (pai_id is None or pai_id in p.get("parents", []))
+                ]
+                pasta_id = candidatas[0]["id"] if candidatas else _criar_pasta(sessao, nome, pai_id, base_url)
+                ids.append(pasta_id)
+                pai_id = pasta_id
+
+        for i, pasta_id in enumerate(ids, start=1):
+            _cache_pastas[(chave, caminho[:i])] = (pasta_id, agora + ttl)
+        return ids
+
+
+def invalidar_pastas_drive(chave):
+    """Descarta os ids em cache da conta (ex.: pasta apagada pelo usuário)."""
+    with _lock_credencial(chave):
+        for entrada in [e for e in _cache_pastas if e[0] == chave]:
+            del _cache_pastas[entrada]
@@ -0,0 +1,209 @@
+"""Descoberta do projeto e inicialização da Earth Engine de cada conta Google.
+
+Os projetos do Cloud são sondados em paralelo direto na API REST da Earth Engine
+(sem ee.Initialize, que altera o estado global do processo), com tempo limite por
+sondagem. O último projeto que funcionou fica salvo em disco por conta Google
+(identificada pelo `sub` do OpenID Connect), para que o próximo login tente esse
+projeto primeiro.
+
+ee.Initialize configura um estado global do processo, compartilhado por todas as
+sessões do Streamlit do mesmo worker. garantir_ee_inicializado registra qual par
+(credencial, projeto) está ativo e só inicializa de novo quando o par muda,
+renovando o token OAuth apenas quando ele está perto de expirar.
+
+Os blocos ee_em_uso funcionam como uma trava compartilhada: vários blocos da mesma
+conta rodam ao mesmo tempo, e a troca de conta espera todos terminarem (o lock só
+fica preso durante a inicialização). Enquanto uma troca espera, novos blocos
+também esperam, para que a troca não fique adiada indefinidamente.
+"""
+import os
+import json
+import datetime
+import threading
+import logging
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import ee
+from google.auth.transport.requests import AuthorizedSession, Request
+
+from drive_zap import chave_credencial
+from config_zap import CACHE_DIR
+
+EE_API_URL = "https://earthengine.googleapis.com/v1"
+USERINFO_URL = "https://openidconnect.googleapis.com/v1/userinfo"
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS_SONDAGEM = 8
+TIMEOUT_SONDAGEM = (5, 10)  # (conexão, leitura) em segundos
+
+ARQUIVO_PROJETOS = os.path.join(CACHE_DIR, "projetos_ee.json")
+_projetos_lock = threading.Lock()
+
+# Renovar o token quando faltar menos que isto para expirar
+MARGEM_RENOVACAO_TOKEN = datetime.timedelta(minutes=5)
+
+# Par (credencial, projeto) com que a Earth Engine está inicializada neste processo
+# (a sessão é da conta, identificada pelo hash do refresh token: objetos de credencial
+# diferentes da mesma conta, como os de cada job e o da interface, compartilham a sessão)
+_ee_ativo = {"credenciais": None, "chave": None}
+_ee_lock = threading.RLock()
+_ee_condicao = threading.Condition(_ee_lock)
+# Blocos ee_em_uso em andamento (todos com a conta de _ee_ativo) e trocas de conta aguardando
+_ee_uso = {"blocos": 0, "trocas_pendentes": 0}
+# Profundidade dos blocos ee_em_uso da thread (blocos aninhados não esperam as trocas)
+_ee_local = threading.local()
+
+
+def identificar_conta(credentials):
+    """Identificador estável da conta Google (`sub` do OpenID Connect), ou None.
+
+    Requer o escopo openid no login; tokens antigos, sem ele, retornam None.
+    """
+    try:
+        resposta = AuthorizedSession(credentials).get(USERINFO_URL, timeout=TIMEOUT_SONDAGEM)
+        if resposta.status_code == 200:
+            return resposta.json().get("sub")
+        logger.warning("Erro ao identificar a conta Google: HTTP %s", resposta.status_code)
+    except Exception as e:
+        logger.warning("Erro ao identificar a conta Google: %s", e)
+    return None
+
+
+def _ler_projetos():
+    try:
+        with open(ARQUIVO_PROJETOS, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def ultimo_projeto(chave):
+    """Último projeto que funcionou para a conta, ou None (também sem conta identificada)."""
+    if chave is None:
+        return None
+    with _projetos_lock:
+        return _ler_projetos().get(chave)
+
+
+def salvar_ultimo_projeto(chave, projeto):
+    """Guarda o projeto que funcionou para a conta (gravação atômica do arquivo)."""
+    if chave is None:
+        return
+    with _projetos_lock:
+        projetos = _ler_projetos()
+        if projetos.get(chave) == projeto:
+            return
+        projetos[chave] = projeto
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            temporario = f"{ARQUIVO_PROJETOS}.{os.getpid()}.tmp"
+            with open(temporario, "w", encoding="utf-8") as f:
+                json.dump(projetos, f)
+            os.replace(temporario, ARQUIVO_PROJETOS)
+        except OSError as e:
+            logger.warning("Erro ao salvar o projeto da Earth Engine: %s", e)
+
+
+def _sondar_projeto(sessao, projeto, base_url):
+    """True se a conta consegue usar a Earth Engine no projeto (API ativada e conta registrada)."""
+    resposta = sessao.get(
+        f"{base_url}/projects/{projeto}/algorithms",
+        params={"fields": "algorithms.name"},
+        timeout=TIMEOUT_SONDAGEM,
+    )
+    return resposta.status_code == 200
+
+
+def sondar_projetos_ee(credentials, project_ids, max_workers=MAX_WORKERS_SONDAGEM, base_url=EE_API_URL):
+    """Gera os projetos com Earth Engine utilizável, na ordem em que as sondagens terminam.
+
+    As sondagens rodam em paralelo; quem consome o gerador pode parar no primeiro
+    projeto que servir, e as sondagens ainda pendentes são canceladas.
+    """
+    if not project_ids:
+        return
+    sessao = AuthorizedSession(credentials)
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(project_ids)))
+    try:
+        futuros = {executor.submit(_sondar_projeto, sessao, projeto, base_url): projeto for projeto in project_ids}
+        for futuro in as_completed(futuros):
+            try:
+                if futuro.result():
+                    yield futuros[futuro]
+            except Exception:
+                continue
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _token_expirando(credentials):
+    if not credentials.token:
+        return True
+    if credentials.expiry is None:
+        return False
+    # google-auth guarda a expiração como UTC sem fuso
+    agora = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return credentials.expiry - agora < MARGEM_RENOVACAO_TOKEN
+
+
+def _renovar_se_expirando(credentials):
+    if credentials.refresh_token and _token_expirando(credentials):
+        credentials.refresh(Request())
+
+
+def garantir_ee_inicializado(credentials, projeto):
+    """Inicializa a Earth Engine com a credencial e o projeto, apenas se ainda não estiver assim.
+
+    A sessão ativa é comparada pela conta (chave_credencial) e pelo projeto, não pelo
+    objeto da credencial. O token do objeto que a Earth Engine referencia é renovado
+    antes, se estiver perto de expirar. A troca de conta espera os blocos ee_em_uso
+    de outras threads terminarem. Erros do ee.Initialize são propagados.
+    """
+    chave = (chave_credencial(credentials), projeto)
+    with _ee_condicao:
+        if _ee_ativo["chave"] == chave:
+            _renovar_se_expirando(_ee_ativo["credenciais"])
+            return False
+        if getattr(_ee_local, "blocos", 0):
+            raise RuntimeError("Troca de conta da Earth Engine dentro de um bloco ee_em_uso de outra conta")
+        _ee_uso["trocas_pendentes"] += 1
+        try:
+            _ee_condicao.wait_for(lambda: _ee_uso["blocos"] == 0)
+        finally:
+            _ee_uso["trocas_pendentes"] -= 1
+            _ee_condicao.notify_all()
+        if _ee_ativo["chave"] == chave:
+            _renovar_se_expirando(_ee_ativo["credenciais"])
+            return False
+        _renovar_se_expirando(credentials)
+        _ee_ativo["credenciais"], _ee_ativo["chave"] = None, None
+        ee.Initialize(credentials, project=projeto)
+        _ee_ativo["credenciais"], _ee_ativo["chave"] = credentials, chave
+        return True
+
+
+@contextlib.contextmanager
+def ee_em_uso(credentials, projeto):
+    """Mantém a Earth Engine com a credencial e o projeto durante o bloco.
+
+    Para threads de segundo plano que atendem contas diferentes no mesmo processo:
+    enquanto o bloco roda, ninguém troca a conta, mas outros blocos da mesma conta
+    rodam junto. Use blocos curtos, só em volta das chamadas ao servidor (getInfo,
+    task.start...): uma conta diferente espera todos os blocos em andamento.
+    """
+    profundidade = getattr(_ee_local, "blocos", 0)
+    with _ee_condicao:
+        if not profundidade:
+            _ee_condicao.wait_for(lambda: _ee_uso["trocas_pendentes"] == 0)
+        garantir_ee_inicializado(credentials, projeto)
+        _ee_uso["blocos"] += 1
+    _ee_local.blocos = profundidade + 1
+    try:
+        yield
+    finally:
+        _ee_local.blocos = profundidade
+        with _ee_condicao:
+            _ee_uso["blocos"] -= 1
+            _ee_condicao.notify_all()
@@ -0,0 +1,75 @@
+"""Gráficos incorporados às planilhas do Excel, com armazenamento único por conteúdo.
+
+Os PNGs chegam já codificados (graficos_agro) e são gravados no arquivo como estão,
+sem passar pelo PIL de novo. Imagens idênticas (mesmo hash SHA-256) ocupam um único
+arquivo em xl/media, referenciado por todas as âncoras que as usam.
+"""
+import struct
+import hashlib
+import datetime
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from openpyxl.drawing.image import Image
+from openpyxl.writer.excel import ExcelWriter
+
+# Altura padrão de uma linha do Excel (15 pt) em pixels
+ALTURA_LINHA_PX = 20
+
+
+def dimensoes_png(png):
+    """Largura e altura lidas do cabeçalho IHDR do PNG."""
+    return struct.unpack(">II", png[16:24])
+
+
+class ImagemExcel(Image):
+    """PNG pronto ancorado na planilha; o arquivo de mídia é o do armazém (compartilhado)."""
+
+    def __init__(self, png, caminho, largura, altura):
+        self.ref = png
+        self.format = "png"
+        self._caminho = caminho
+        self.width, self.height = largura, altura
+
+    def _data(self):
+        return self.ref
+
+    @property
+    def path(self):
+        return self._caminho
+
+
+class ArmazemImagens:
+    """Guarda cada PNG distinto uma única vez, pelo hash do conteúdo."""
+
+    def __init__(self):
+        self._caminhos = {}
+
+    def __len__(self):
+        return len(self._caminhos)
+
+    def imagem(self, png, largura_max=None):
+        """Nova âncora (ImagemExcel) para o PNG, reduzida a `largura_max` pixels se informado."""
+        chave = hashlib.sha256(png).hexdigest()
+        caminho = self._caminhos.setdefault(chave, f"/xl/media/grafico{len(self._caminhos) + 1}.png")
+        largura, altura = dimensoes_png(png)
+        if largura_max and largura > largura_max:
+            largura, altura = largura_max, round(altura * largura_max / largura)
+        return ImagemExcel(png, caminho, largura, altura)
+
+
+class _ExcelWriterImagensUnicas(ExcelWriter):
+    """ExcelWriter que grava cada arquivo de mídia uma única vez."""
+
+    def _write_images(self):
+        gravadas = set()
+        for img in self._images:
+            if img.path not in gravadas:
+                gravadas.add(img.path)
+                self._archive.writestr(img.path[1:], img._data())
+
+
+def salvar_workbook(workbook, destino):
+    """Equivalente a workbook.save(destino), sem duplicar as imagens do ArmazemImagens."""
+    workbook.properties.modified = datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+    with ZipFile(destino, "w", ZIP_DEFLATED, allowZip64=True) as arquivo:
+        _ExcelWriterImagensUnicas(workbook, arquivo).save()
@@ -0,0 +1,351 @@
+"""Fila persistente de processamentos (SQLite) e pool de workers.
+
+Cada processamento vira um job: a especificação (geometria, nome da bacia,
+produtos selecionados...) é gravada em JSON em um banco SQLite local. Workers em
+threads de segundo plano reservam os jobs pendentes de forma atômica, executam e
+gravam a etapa, o progresso e o resultado; a interface apenas consulta o job.
+Como tudo fica no banco, o processamento continua se a aba for fechada ou se a
+página rodar de novo, e vários processos do servidor que usem o mesmo arquivo
+dividem a fila entre si.
+
+As credenciais do usuário ficam no banco apenas enquanto o job não termina,
+cifradas (Fernet) com a chave informada à FilaJobs; só `reservar` as decifra, para
+o worker que vai executar o job. Ao concluir, falhar ou cancelar, a coluna é zerada.
+
+O worker renova o heartbeat dos jobs em execução. Se o processo que executava um
+job morrer, o job volta a ser reservado por outro worker depois de
+TEMPO_HEARTBEAT_EXPIRADO segundos, com o progresso salvo até então (o executor
+decide o que pode ser retomado, ex.: tarefas já iniciadas na Earth Engine).
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+import logging
+import contextlib
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from config_zap import CACHE_DIR
+
+ARQUIVO_JOBS = os.environ.get("ZAP_JOBS_DB", os.path.join(CACHE_DIR, "jobs.sqlite3"))
+# Arquivos gerados pelos jobs (ex.: Excel dos dados agro), apagados junto com o job
+ARQUIVOS_JOBS_DIR = os.path.join(CACHE_DIR, "jobs")
+
+MAX_WORKERS_JOBS = int(os.environ.get("ZAP_JOBS_WORKERS", "2"))
+INTERVALO_FILA = 2  # espera (s) entre consultas à fila vazia
+INTERVALO_HEARTBEAT = 15
+TEMPO_HEARTBEAT_EXPIRADO = 120
+MAX_TENTATIVAS_JOB = 3
+DIAS_RETENCAO_JOBS = 7
+
+ESTADOS_FINAIS_JOB = {"concluido", "falhou", "cancelado"}
+
+logger = logging.getLogger(__name__)
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    conta TEXT NOT NULL,
+    estado TEXT NOT NULL,
+    spec TEXT NOT NULL,
+    credenciais TEXT,
+    etapa TEXT,
+    progresso TEXT,
+    resultado TEXT,
+    erro TEXT,
+    worker TEXT,
+    tentativas INTEGER NOT NULL DEFAULT 0,
+    criado_em REAL NOT NULL,
+    atualizado_em REAL NOT NULL,
+    heartbeat REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_estado ON jobs (estado, criado_em);
+CREATE INDEX IF NOT EXISTS jobs_conta ON jobs (conta, criado_em);
+"""
+
+_CAMPOS_JSON = ("spec", "progresso", "resultado")
+
+
+def caminho_arquivo_job(job_id, nome):
+    """Caminho de um arquivo gerado pelo job (a pasta é criada se preciso)."""
+    pasta = os.path.join(ARQUIVOS_JOBS_DIR, job_id)
+    os.makedirs(pasta, exist_ok=True)
+    return os.path.join(pasta, nome)
+
+
+class FilaJobs:
+    """Fila de jobs gravada em um arquivo SQLite (modo WAL), segura entre threads e processos.
+
+    `chave` é a chave Fernet que cifra as credenciais dos jobs; deve ser a mesma em
+    todos os processos que dividem o banco. Sem ela, uma chave temporária é gerada:
+    os jobs deste processo funcionam, mas não podem ser retomados por outro processo.
+    """
+
+    def __init__(self, caminho=ARQUIVO_JOBS, chave=None):
+        self.caminho = caminho
+        if chave is None:
+            logger.warning("Fila de jobs sem chave para as credenciais: usando uma chave temporária "
+                           "(jobs interrompidos não poderão ser retomados por outro processo)")
+            chave = Fernet.generate_key()
+        self._fernet = Fernet(chave)
+        os.makedirs(os.path.dirname(caminho) or ".", exist_ok=True)
+        with self._conexao() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.executescript(_ESQUEMA)
+        # As credenciais (cifradas) dos jobs em andamento ficam no banco: apenas o dono do processo lê o arquivo
+        try:
+            os.chmod(caminho, 0o600)
+        except OSError:
+            pass
+
+    @contextlib.contextmanager
+    def _conexao(self):
+        con = sqlite3.connect(self.caminho, timeout=30, isolation_level=None)
+        con.row_factory = sqlite3.Row
+        try:
+            yield con
+        finally:
+            con.close()
+
+    @staticmethod
+    def _job(linha):
+        if linha is None:
+            return None
+        job = dict(linha)
+        # As credenciais só saem da fila decifradas, em `reservar`
+        job.pop("credenciais", None)
+        for campo in _CAMPOS_JSON:
+            job[campo] = json.loads(job[campo]) if job[campo] else None
+        return job
+
+    def enfileirar(self, spec, conta, credenciais=None):
+        """Grava um novo job pendente e retorna o seu id."""
+        job_id = uuid.uuid4().hex
+        agora = time.time()
+        with self._conexao() as con:
+            con.execute(
+                "INSERT INTO jobs (id, conta, estado, spec, credenciais, etapa, criado_em, atualizado_em) "
+                "VALUES (?, ?, 'pendente', ?, ?, 'Na fila', ?, ?)",
+                (job_id, conta, json.dumps(spec), self._cifrar(credenciais) if credenciais else None, agora, agora),
+            )
+        return job_id
+
+    def _cifrar(self, credenciais):
+        return self._fernet.encrypt(json.dumps(credenciais).encode("utf-8")).decode("ascii")
+
+    def _decifrar(self, texto):
+        return json.loads(self._fernet.decrypt(texto.encode("ascii")).decode("utf-8"))
+
+    def obter(self, job_id):
+        """O job (sem as credenciais), ou None."""
+        with self._conexao() as con:
+            return self._job(con.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def listar(self, conta, limite=10):
+        """Jobs mais recentes da conta (sem as credenciais)."""
+        with self._conexao() as con:
+            linhas = con.execute(
+                "SELECT * FROM jobs WHERE conta = ? ORDER BY criado_em DESC LIMIT ?", (conta, limite)
+            ).fetchall()
+        return [self._job(linha) for linha in linhas]
+
+    def reservar(self, worker):
+        """Reserva o job pendente mais antigo (ou um abandonado por um worker que parou).
+
+        Retorna o job, com as credenciais decifradas, ou None se a fila estiver vazia.
+        Jobs abandonados mais de MAX_TENTATIVAS_JOB vezes são marcados como falhos em
+        vez de reservados, assim como os jobs cujas credenciais não podem ser decifradas
+        (gravados com outra chave).
+        """
+        agora = time.time()
+        with self._conexao() as con:
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                con.execute(
+                    "UPDATE jobs SET estado = 'falhou', erro = 'Processamento interrompido repetidas vezes', "
+                    "credenciais = NULL, atualizado_em = ? WHERE estado = 'executando' AND heartbeat < ? AND tentativas >= ?",
+                    (agora, agora - TEMPO_HEARTBEAT_EXPIRADO, MAX_TENTATIVAS_JOB),
+                )
+                linha = con.execute(
+                    "SELECT id, credenciais FROM jobs WHERE estado = 'pendente' OR (estado = 'executando' AND heartbeat < ?) "
+                    "ORDER BY criado_em LIMIT 1",
+                    (agora - TEMPO_HEARTBEAT_EXPIRADO,),
+                ).fetchone()
+                if linha is not None:
+                    con.execute(
+                        "UPDATE jobs SET estado = 'executando', worker = ?, heartbeat = ?, atualizado_em = ?, "
+                        "tentativas = tentativas + 1 WHERE id = ?",
+                        (worker, agora, agora, linha["id"]),
+                    )
+                con.execute("COMMIT")
+            except Exception:
+                con.execute("ROLLBACK")
+                raise
+        if linha is None:
+            return None
+        job = self.obter(linha["id"])
+        try:
+            job["credenciais"] = self._decifrar(linha["credenciais"]) if linha["credenciais"] else None
+        except (InvalidToken, ValueError):
+            self.finalizar(job["id"], worker, "falhou",
+                           erro="Não foi possível ler as credenciais do job (chave diferente); processe de novo")
+            return None
+        return job
+
+    def atualizar(self, job_id, worker, etapa=None, progresso=None):
+        """Grava a etapa e/ou o progresso, se o job ainda estiver com este worker.
+
+        Retorna False se o job foi cancelado ou reservado por outro worker.
+        """
+        campos, valores = ["atualizado_em = ?", "heartbeat = ?"], [time.time(), time.time()]
+        if etapa is not None:
+            campos.append("etapa = ?")
+            valores.append(etapa)
+        if progresso is not None:
+            campos.append("progresso = ?")
+            valores.append(json.dumps(progresso))
+        with self._conexao() as con:
+            cursor = con.execute(
+                f"UPDATE jobs SET {', '.join(campos)} WHERE id = ? AND worker = ? AND estado = 'executando'",
+                (*valores, job_id, worker),
+            )
+        return cursor.rowcount == 1
+
+    def renovar(self, job_id, worker):
+        return self.atualizar(job_id, worker)
+
+    def finalizar(self, job_id, worker, estado, resultado=None, erro=None):
+        """Marca o job como concluído ou falho (apenas se ainda estiver com este worker)."""
+        with self._conexao() as con:
+            con.execute(
+                "UPDATE jobs SET estado = ?, resultado = ?, erro = ?, etapa = ?, credenciais = NULL, atualizado_em = ? "
+                "WHERE id = ? AND worker = ? AND estado = 'executando'",
+                (estado, json.dumps(resultado) if resultado is not None else None, erro,
+                 "Concluído" if estado == "concluido" else "Falhou", time.time(), job_id, worker),
+            )
+
+    def cancelar(self, job_id):
+        """Pede o cancelamento; o worker percebe na próxima atualização do progresso."""
+        with self._conexao() as con:
+            con.execute(
+                "UPDATE jobs SET estado = 'cancelado', etapa = 'Cancelado', credenciais = NULL, atualizado_em = ? "
+                "WHERE id = ? AND estado NOT IN ('concluido', 'falhou', 'cancelado')",
+                (time.time(), job_id),
+            )
+
+    def limpar(self, dias=DIAS_RETENCAO_JOBS):
+        """Apaga os jobs finalizados há mais de `dias` dias, com os seus arquivos.
+
+        Também zera as credenciais que tenham ficado em jobs já finalizados.
+        """
+        limite = time.time() - dias * 24 * 3600
+        with self._conexao() as con:
+            con.execute("UPDATE jobs SET credenciais = NULL WHERE estado IN ('concluido', 'falhou', 'cancelado') "
+                        "AND credenciais IS NOT NULL")
+            ids = [linha["id"] for linha in con.execute(
+                "SELECT id FROM jobs WHERE estado IN ('concluido', 'falhou', 'cancelado') AND atualizado_em < ?",
+                (limite,),
+            )]
+            con.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in ids])
+        for job_id in ids:
+            pasta = os.path.join(ARQUIVOS_JOBS_DIR, job_id)
+            if os.path.isdir(pasta):
+                for nome in os.listdir(pasta):
+                    with contextlib.suppress(OSError):
+                        os.remove(os.path.join(pasta, nome))
+                with contextlib.suppress(OSError):
+                    os.rmdir(pasta)
+        return len(ids)
+
+
+class ContextoJob:
+    """O que o executor usa para informar o andamento de um job e saber se foi cancelado."""
+
+    def __init__(self, fila, job, worker):
+        self.fila = fila
+        self.job_id = job["id"]
+        self.worker = worker
+        # Progresso salvo por uma execução anterior (job retomado), ou vazio
+        self.progresso = dict(job.get("progresso") or {})
+
+    def atualizar(self, etapa=None, **progresso):
+        """Grava a etapa e mescla `progresso` no dicionário salvo no banco.
+
+        Retorna False se o job não está mais com este worker (cancelado ou retomado
+        por outro): o executor deve parar.
+        """
+        self.progresso.update(progresso)
+        return self.fila.atualizar(self.job_id, self.worker, etapa, self.progresso if progresso else None)
+
+    def cancelado(self):
+        """True se o usuário cancelou o job."""
+        job = self.fila.obter(self.job_id)
+        return job is None or job["estado"] == "cancelado"
+
+
+class PoolWorkers:
+    """Threads que executam os jobs da fila, uma por vez cada.
+
+    `executar(job, contexto)` roda o job e retorna o resultado (serializável em
+    JSON); exceções marcam o job como falho. Uma thread à parte renova o heartbeat
+    dos jobs em execução.
+    """
+
+    def __init__(self, fila, executar, num_workers=MAX_WORKERS_JOBS):
+        self.fila = fila
+        self.executar = executar
+        self.num_workers = num_workers
+        self.nome = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._ativos = {}
+        self._lock = threading.Lock()
+        self._parar = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._trabalhar, args=(f"{self.nome}/{i}",), name=f"worker-jobs-{i}", daemon=True)
+            for i in range(num_workers)
+        ]
+        self._threads.append(threading.Thread(target=self._renovar_heartbeats, name="heartbeat-jobs", daemon=True))
+
+    def iniciar(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def parar(self):
+        self._parar.set()
+
+    def _trabalhar(self, worker):
+        while not self._parar.is_set():
+            try:
+                job = self.fila.reservar(worker)
+            except sqlite3.Error as e:
+                logger.warning("Erro ao consultar a fila de jobs: %s", e)
+                job = None
+            if job is None:
+                self._parar.wait(INTERVALO_FILA)
+                continue
+
+            with self._lock:
+                self._ativos[job["id"]] = worker
+            try:
+                resultado = self.executar(job, ContextoJob(self.fila, job, worker))
+                self.fila.finalizar(job["id"], worker, "concluido", resultado=resultado)
+            except Exception as e:
+                logger.exception("Erro no job %s", job["id"])
+                self.fila.finalizar(job["id"], worker, "falhou", erro=str(e))
+            finally:
+                with self._lock:
+                    self._ativos.pop(job["id"], None)
+
+    def _renovar_heartbeats(self):
+        while not self._parar.wait(INTERVALO_HEARTBEAT):
+            with self._lock:
+                ativos = list(self._ativos.items())
+            for job_id, worker in ativos:
+                try:
+                    self.fila.renovar(job_id, worker)
+                except sqlite3.Error as e:
+                    logger.warning("Erro ao renovar o job %s: %s", job_id, e)
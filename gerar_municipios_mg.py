@@ -0,0 +1,66 @@
+"""Gera a camada local dos municípios de MG (dados/mg_municipios.parquet) usada pelo app.
+
+A fonte é o mesmo asset que o cruzamento na Earth Engine usa
+(projects/ee-zapmg/assets/mg-municipios). Os municípios são lidos em páginas pela
+API de features (ee.data.listFeatures), sem simplificar as geometrias, e gravados
+com todas as propriedades do asset (geocodigo, nome, ...). As coordenadas vêm em
+EPSG:4326, como a Earth Engine as devolve; a diferença para o SIRGAS 2000 é
+submétrica e some nas áreas calculadas no Albers do app.
+
+Uso (depois de `earthengine authenticate`):
+    python gerar_municipios_mg.py --projeto PROJETO [--saida dados/mg_municipios.parquet]
+
+Depois de gerar, rode o app com ZAP_MUNICIPIOS_MODO=verificar em algumas bacias: os
+municípios e os percentuais são comparados com os da Earth Engine.
+"""
+import os
+import argparse
+
+import ee
+import geopandas as gpd
+
+ASSET_MUNICIPIOS = "projects/ee-zapmg/assets/mg-municipios"
+SAIDA_PADRAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dados", "mg_municipios.parquet")
+FEATURES_POR_PAGINA = 100
+MUNICIPIOS_MG = 853
+
+
+def ler_municipios(asset=ASSET_MUNICIPIOS):
+    """Todas as features do asset (GeoJSON), página por página."""
+    features, pagina = [], None
+    while True:
+        parametros = {"assetId": asset, "pageSize": FEATURES_POR_PAGINA}
+        if pagina:
+            parametros["pageToken"] = pagina
+        resposta = ee.data.listFeatures(parametros)
+        features.extend(resposta.get("features", []))
+        pagina = resposta.get("nextPageToken")
+        if not pagina:
+            return features
+
+
+def gerar_camada(saida=SAIDA_PADRAO, asset=ASSET_MUNICIPIOS):
+    gdf = gpd.GeoDataFrame.from_features(ler_municipios(asset), crs="EPSG:4326")
+    if "geocodigo" not in gdf.columns or "nome" not in gdf.columns:
+        raise ValueError(f"O asset {asset} não tem as colunas geocodigo e nome")
+    gdf["geocodigo"] = gdf["geocodigo"].astype(int)
+    gdf = gdf.sort_values("geocodigo").reset_index(drop=True)
+    if len(gdf) != MUNICIPIOS_MG:
+        print(f"Atenção: {len(gdf)} municípios lidos (MG tem {MUNICIPIOS_MG})")
+
+    os.makedirs(os.path.dirname(os.path.abspath(saida)), exist_ok=True)
+    temporario = f"{saida}.{os.getpid()}.tmp"
+    gdf.to_parquet(temporario)
+    os.replace(temporario, saida)
+    return gdf
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--projeto", required=True, help="projeto do Cloud com a Earth Engine ativada")
+    parser.add_argument("--saida", default=SAIDA_PADRAO, help="arquivo GeoParquet de saída")
+    parser.add_argument("--asset", default=ASSET_MUNICIPIOS, help="asset dos municípios na Earth Engine")
+    argumentos = parser.parse_args()
+    ee.Initialize(project=argumentos.projeto)
+    camada = gerar_camada(argumentos.saida, argumentos.asset)
+    print(f"{len(camada)} municípios gravados em {argumentos.saida}")
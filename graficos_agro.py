@@ -0,0 +1,554 @@
+"""Renderização dos gráficos agro (PAM/PPM/PEVS) fora da thread do Streamlit.
+
+Usa a API orientada a objetos do matplotlib, sem o estado global do pyplot, e
+devolve o arquivo já codificado em bytes: PNG direto do canvas Agg (padrão) ou SVG
+vetorial (FORMATO_GRAFICOS). Os gráficos de uma bacia são distribuídos em um pool
+de processos compartilhado pelo servidor, com tempo limite. O pool fica em um
+processo lançador à parte (lancador_graficos), que o cria a partir de um forkserver:
+os processos não herdam o estado das threads do Streamlit e o __main__ do servidor
+(o script do app) não é lido nem trocado. Rodar este módulo
+(`python graficos_agro.py`) compara o tempo e o tamanho dos dois formatos.
+
+Os gráficos ficam em um cache em disco endereçado pelo conteúdo (tabela, município,
+valores do dataframe, produtos resolvidos e parâmetros de estilo): um gráfico que
+não mudou desde a última exportação é lido do disco em vez de ser plotado de novo.
+"""
+import io
+import os
+import sys
+import time
+import logging
+import hashlib
+import threading
+import pickle
+import contextlib
+import subprocess
+from multiprocessing.connection import Client
+
+import numpy as np
+import pandas as pd
+import matplotlib
+from matplotlib.figure import Figure
+
+from config_zap import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+# Dicionário de títulos personalizados
+TITULOS_POR_TABELA = {
+    'PAM_Quantidade_produzida_14-23': 'PAM - Evolução da Quantidade Produzida',
+    'PAM_Valor_da_producao_14-23': 'PAM - Evolução do Valor da Produção',
+    'PPM_Efetivo_dos_rebanhos_14-23': 'PPM - Evolução do Efetivo dos Rebanhos',
+    'PPM_Prod_origem_animal_14-23': 'PPM - Evolução da Quantidade de Produtos de Origem Animal',
+    'PPM_Valor_da_producao_prod_anim': 'PPM - Evolução do Valor/Receita dos Produtos de Origem Animal',
+    'PPM_Producao_aquicultura_14-23': 'PPM - Evolução da Quantidade Produzida na Aquicultura',
+    'PPM_Valor_producao_aquicultura_': 'PPM - Evolução do Valor/Receita da Produção na Aquicultura',
+    'PEVS_Area_silv_14-23': 'PEVS - Evolução da Área de Silvicultura',
+    'PEVS_Qnt_prod_silv_14-23': 'PEVS - Evolução da Quantidade Produzida na Silvicultura',
+    'PEVS_Valor_prod_silv_14-23': 'PEVS - Evolução do Valor da Produção na Silvicultura'
+}
+
+# Dicionário de unidades e ajustes de escala
+UNIDADES_CONFIG = {
+    'PAM_Quantidade_produzida_14-23': {'unidade': 'Mil Toneladas', 'divisor': 1000},
+    'PAM_Valor_da_producao_14-23': {'unidade': 'Mil Reais', 'divisor': 1},
+    'PPM_Efetivo_dos_rebanhos_14-23': {'unidade': 'Cabeças', 'divisor': 1},
+    'PPM_Prod_origem_animal_14-23': {
+        'unidades_especificas': {
+            'leite': {'unidade': 'Mil Litros', 'divisor': 1},
+            'ovogal': {'unidade': 'Mil Dúzias', 'divisor': 1},
+            'ovocod': {'unidade': 'Mil Dúzias', 'divisor': 1},
+            'mel': {'unidade': 'Quilogramas', 'divisor': 1},
+            'bichsed': {'unidade': 'Quilogramas', 'divisor': 1}
+        },
+        'default': {'unidade': 'Unidade', 'divisor': 1}
+    },
+    'PPM_Valor_da_producao_prod_anim': {'unidade': 'Mil Reais', 'divisor': 1},
+    'PPM_Producao_aquicultura_14-23': {'unidade': 'Quilogramas', 'divisor': 1},
+    'PPM_Valor_producao_aquicultura_': {'unidade': 'Mil Reais', 'divisor': 1},
+    'PEVS_Area_silv_14-23': {'unidade': 'Hectares', 'divisor': 1, 'ylabel': 'Área'},
+    'PEVS_Qnt_prod_silv_14-23': {
+        'unidades_especificas': {
+            'carveg': {'unidade': 'Toneladas', 'divisor': 1},
+            'outprod': {'unidade': 'Toneladas', 'divisor': 1},
+            'lenha': {'unidade': 'Metros Cúbicos', 'divisor': 1},
+            'madtor': {'unidade': 'Metros Cúbicos', 'divisor': 1}
+        },
+        'default': {'unidade': 'Unidade', 'divisor': 1}
+    },
+    'PEVS_Valor_prod_silv_14-23': {'unidade': 'Mil Reais', 'divisor': 1}
+}
+
+# Lista de tabelas com gráficos únicos (que precisam de altura maior)
+TABELAS_COM_GRAFICO_UNICO = [
+    'PAM_Quantidade_produzida_14-23',
+    'PAM_Valor_da_producao_14-23',
+    'PPM_Efetivo_dos_rebanhos_14-23',
+    'PPM_Valor_da_producao_prod_anim',
+    'PPM_Producao_aquicultura_14-23',
+    'PPM_Valor_producao_aquicultura_',
+    'PEVS_Area_silv_14-23',
+    'PEVS_Valor_prod_silv_14-23'
+]
+
+COR_PADRAO = '#A9A9A9'
+
+
+def normalizar_chave_produto(nome):
+    return nome.lower().replace(' ', '').replace('-', '').replace('_', '')
+
+
+class IndiceProdutos:
+    """Índice dos produtos por tabela: produto -> (nome de exibição, cor, unidade, divisor).
+
+    O produto é o que aparece na coluna 'Produto' dos dados agro: a tupla (nome, cor)
+    do dicionário de produtos ou o código original, quando não há entrada no
+    dicionário. As tuplas do dicionário são indexadas na criação (uma vez, na
+    importação do app); os demais valores são resolvidos no primeiro uso e guardados.
+    """
+
+    def __init__(self, dicionario_produtos):
+        self._cores = {
+            chave: valor[1] if isinstance(valor, tuple) else COR_PADRAO
+            for chave, valor in dicionario_produtos.items()
+        }
+        self._por_tabela = {}
+        for tabela in UNIDADES_CONFIG:
+            for valor in dicionario_produtos.values():
+                self.produto(tabela, valor)
+
+    def _resolver(self, config, produto):
+        if isinstance(produto, tuple):
+            nome, cor = produto[0], produto[1]
+        else:
+            nome = produto
+            cor = self._cores.get(normalizar_chave_produto(nome), COR_PADRAO)
+        chave = normalizar_chave_produto(nome)
+
+        for prefixo, unidade in config.get('unidades_especificas', {}).items():
+            if chave.startswith(prefixo):
+                return nome, cor, unidade['unidade'], unidade['divisor']
+        return nome, cor, config.get('unidade', 'Unidade'), config.get('divisor', 1)
+
+    def produto(self, tabela, produto):
+        """(nome, cor, unidade, divisor) do produto na tabela."""
+        indice = self._por_tabela.get(tabela)
+        if indice is None:
+            indice = self._por_tabela.setdefault(tabela, {})
+        info = indice.get(produto)
+        if info is None:
+            config = UNIDADES_CONFIG.get(tabela, {'unidade': 'Unidade', 'divisor': 1})
+            info = indice[produto] = self._resolver(config, produto)
+        return info
+
+
+DPI_GRAFICOS = 150
+
+# Formatos de saída dos gráficos (extensão -> mimetype) e o formato padrão
+FORMATOS_GRAFICOS = {'png': 'image/png', 'svg': 'image/svg+xml'}
+FORMATO_GRAFICOS = os.environ.get("ZAP_GRAFICOS_FORMATO", "png").lower()
+if FORMATO_GRAFICOS not in FORMATOS_GRAFICOS:
+    FORMATO_GRAFICOS = "png"
+
+# Cache dos PNGs em disco (LRU por tamanho total)
+CACHE_GRAFICOS_DIR = os.path.join(CACHE_DIR, "graficos")
+CACHE_GRAFICOS_MAX_BYTES = int(os.environ.get("ZAP_CACHE_GRAFICOS_MAX_BYTES", 256 * 1024 * 1024))
+# Incrementar ao mudar o desenho dos gráficos (invalida o cache)
+VERSAO_ESTILO_GRAFICOS = 1
+
+# Máximo de processos para renderização (o Streamlit Cloud tem poucos núcleos e pouca memória)
+MAX_WORKERS_GRAFICOS = int(os.environ.get("ZAP_GRAFICOS_WORKERS", min(4, os.cpu_count() or 1)))
+# Tempo máximo (s) para o pool renderizar os gráficos de uma chamada; o que faltar é renderizado em série
+TIMEOUT_GRAFICOS = float(os.environ.get("ZAP_GRAFICOS_TIMEOUT", 300))
+# Tempo máximo (s) para o lançador do pool ficar pronto ou encerrar
+TIMEOUT_LANCADOR = 30
+
+# Índice de produtos entregue a cada processo do pool pelo inicializador
+_indice_produtos = IndiceProdutos({})
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def criar_grafico(df_municipio, municipio, tipo_dado, tabela_origem, indice_produtos=None, formato='png'):
+    """Cria gráficos com a evolução dos produtos para um município e retorna o arquivo (PNG ou SVG) em bytes."""
+    if indice_produtos is None:
+        indice_produtos = _indice_produtos
+    try:
+        if len(df_municipio) == 0:
+            return None
+
+        # Obter configurações da tabela
+        config = UNIDADES_CONFIG.get(tabela_origem, {'unidade': 'Unidade', 'divisor': 1})
+        titulo_base = TITULOS_POR_TABELA.get(tabela_origem, f"Evolução {tipo_dado}")
+
+        # Agrupar produtos por unidade de medida
+        grupos = {}
+        for _, row in df_municipio.iterrows():
+            _, _, unidade, divisor = indice_produtos.produto(tabela_origem, row['Produto'])
+
+            if unidade not in grupos:
+                grupos[unidade] = {
+                    'dados': [],
+                    'divisor': divisor
+                }
+            grupos[unidade]['dados'].append(row)
+
+        # Definir altura da figura baseado no tipo de gráfico
+        n_grupos = len(grupos)
+
+        # Ajustar altura para gráficos únicos (maior) e múltiplos (padrão)
+        if tabela_origem in TABELAS_COM_GRAFICO_UNICO:
+            figsize = (14, 10)  # Altura maior para gráficos únicos (1000px)
+        else:
+            figsize = (14, 6 * n_grupos)  # Altura padrão para múltiplos gráficos
+
+        # Criar figura com o tamanho apropriado (sem pyplot: a figura não entra no estado global)
+        fig = Figure(figsize=figsize)
+        axs = fig.subplots(n_grupos, 1)
+        if n_grupos == 1:
+            axs = [axs]  # Garantir que axs seja sempre uma lista
+
+        # Extrair anos uma única vez (assumindo que todos os produtos têm os mesmos anos)
+        anos_colunas = [col for col in df_municipio.columns if isinstance(col, str) and col.startswith('20')]
+        anos_colunas = sorted(anos_colunas, key=lambda x: int(x[-2:]))
+        anos_int = [int(ano[-2:]) for ano in anos_colunas]
+
+        # Plotar cada grupo em um subplot
+        for i, (unidade, grupo) in enumerate(grupos.items()):
+            ax = axs[i]
+            dados_grupo = grupo['dados']
+            divisor = grupo['divisor']
+
+            for row in dados_grupo:
+                produto_nome, cor, _, _ = indice_produtos.produto(tabela_origem, row['Produto'])
+
+                valores = [row[ano]/divisor if pd.notna(row[ano]) else None for ano in anos_colunas]
+
+                if all(pd.isna(valores)):
+                    continue
+
+                # Converter para arrays numpy
+                valores_arr = np.array(valores)
+                anos_arr = np.array(anos_int)
+                mask = ~pd.isna(valores_arr)
+
+                # Plotar linha
+                ax.plot(anos_arr[mask], valores_arr[mask],
+                        marker='o',
+                        linestyle='-',
+                        color=cor,
+                        label=produto_nome,
+                        linewidth=2.5,
+                        markersize=8,
+                        markeredgecolor='white',
+                        markeredgewidth=1)
+
+            # Configurações do gráfico
+            titulo_grupo = f"{titulo_base} - {municipio}" if i == 0 else ""
+            ax.set_title(titulo_grupo, fontsize=16, pad=20, fontweight='bold')
+
+            # Label do eixo Y personalizado
+            ylabel = config.get('ylabel', tipo_dado) if i == 0 and 'ylabel' in config else tipo_dado
+            ax.set_ylabel(f"{ylabel} ({unidade})", fontsize=12)
+
+            ax.set_xlabel('Ano', fontsize=12)
+            ax.set_xticks(anos_int)
+            ax.set_xticklabels([f"20{ano}" for ano in anos_int], rotation=45 if len(anos_int) > 5 else 0)
+
+            # Grid e fundo branco
+            ax.grid(True, linestyle=':', alpha=0.6)
+            ax.set_facecolor('white')
+
+            # Legenda na parte inferior
+            handles, labels = ax.get_legend_handles_labels()
+            ax.legend(handles, labels,
+                      loc='upper center',
+                      bbox_to_anchor=(0.5, -0.15),  # Ajustado para melhor posicionamento
+                      fontsize=10,
+                      framealpha=0.9,
+                      ncol=2)
+
+        # Ajustar layout para acomodar a legenda
+        fig.tight_layout()
+        if tabela_origem in TABELAS_COM_GRAFICO_UNICO:
+            fig.subplots_adjust(bottom=0.25)  # Mais espaço para legenda em gráficos únicos
+        else:
+            fig.subplots_adjust(bottom=0.1 + 0.05 * n_grupos)  # Espaço proporcional para múltiplos gráficos
+
+        fig.patch.set_facecolor('white')
+
+        # Salvar direto em bytes, sem passar pelo PIL (SVG sem data, para o mesmo gráfico gerar o mesmo arquivo)
+        buf = io.BytesIO()
+        if formato == 'svg':
+            fig.savefig(buf, format='svg', bbox_inches='tight', facecolor=fig.get_facecolor(), metadata={'Date': None})
+        else:
+            fig.savefig(buf, format='png', dpi=DPI_GRAFICOS, bbox_inches='tight', facecolor=fig.get_facecolor())
+        return buf.getvalue()
+
+    except Exception:
+        logger.exception("Erro ao criar gráfico para %s", municipio)
+        return None
+
+
+def _inicializar_worker(indice_produtos):
+    global _indice_produtos
+    _indice_produtos = indice_produtos
+
+
+def _renderizar_tarefa(tarefa, formato='png'):
+    chave, df_municipio, municipio, tipo_dado, tabela_origem = tarefa
+    return chave, criar_grafico(df_municipio, municipio, tipo_dado, tabela_origem, formato=formato)
+
+
+class _LancadorPool:
+    """Cliente do processo lançador (lancador_graficos), que mantém o pool de processos.
+
+    O lançador é iniciado com subprocess, não com o multiprocessing: o processo
+    novo tem o seu próprio __main__ e não executa de novo o script do app.
+    """
+
+    def __init__(self, indice_produtos):
+        self._authkey = os.urandom(32)
+        diretorio = os.path.dirname(os.path.abspath(__file__))
+        ambiente = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            filter(None, [diretorio, os.environ.get("PYTHONPATH")])))
+        self._processo = subprocess.Popen(
+            [sys.executable, "-m", "lancador_graficos"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=ambiente,
+        )
+        try:
+            pickle.dump({"authkey": self._authkey, "indice_produtos": indice_produtos,
+                         "max_workers": MAX_WORKERS_GRAFICOS}, self._processo.stdin)
+            self._processo.stdin.flush()
+            # A entrada padrão fica aberta: o lançador encerra o pool quando ela fecha
+            self._endereco = self._processo.stdout.readline().decode().strip()
+            if not self._endereco:
+                raise OSError(f"Lançador de gráficos terminou ao iniciar (código {self._processo.poll()})")
+        except Exception:
+            self.encerrar()
+            raise
+
+    def renderizar(self, tarefas, formato, timeout):
+        """Gera (chave, bytes) de cada gráfico à medida que ficam prontos.
+
+        TimeoutError se o pool não terminar em `timeout` segundos; EOFError/OSError
+        se o lançador ou um processo do pool morrer.
+        """
+        prazo = time.monotonic() + timeout
+        with Client(self._endereco, authkey=self._authkey) as conexao:
+            conexao.send((tarefas, formato))
+            while True:
+                restante = prazo - time.monotonic()
+                if restante <= 0 or not conexao.poll(restante):
+                    raise TimeoutError(f"Pool de gráficos sem resposta em {timeout:.0f} s")
+                resultado = conexao.recv()
+                if resultado is None:
+                    return
+                yield resultado
+
+    def encerrar(self):
+        """Encerra o lançador; ele encerra os processos do pool (inclusive os travados)."""
+        if self._processo.poll() is None:
+            self._processo.terminate()
+            try:
+                self._processo.wait(TIMEOUT_LANCADOR)
+            except subprocess.TimeoutExpired:
+                self._processo.kill()
+        for arquivo in (self._processo.stdin, self._processo.stdout):
+            with contextlib.suppress(OSError):
+                arquivo.close()
+
+
+def _obter_pool(indice_produtos):
+    """Pool de processos compartilhado por todas as sessões do servidor (criado sob demanda)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            if MAX_WORKERS_GRAFICOS < 2:
+                return None
+            _pool = _LancadorPool(indice_produtos)
+        return _pool
+
+
+def _descartar_pool(pool):
+    """Tira o pool de uso e encerra o lançador e os seus processos."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.encerrar()
+
+
+def chave_cache_grafico(df_municipio, municipio, tipo_dado, tabela_origem, indice_produtos, formato='png'):
+    """Hash do conteúdo do gráfico: dados, produtos resolvidos, formato e parâmetros de estilo."""
+    conteudo = repr((
+        VERSAO_ESTILO_GRAFICOS, matplotlib.__version__, DPI_GRAFICOS, formato,
+        tabela_origem, municipio, tipo_dado,
+        TITULOS_POR_TABELA.get(tabela_origem), UNIDADES_CONFIG.get(tabela_origem),
+        list(df_municipio.columns),
+        df_municipio.to_numpy(dtype=object).tolist(),
+        [indice_produtos.produto(tabela_origem, produto) for produto in df_municipio['Produto']],
+    ))
+    return hashlib.sha256(conteudo.encode('utf-8')).hexdigest()
+
+
+def _caminho_cache_grafico(chave_cache, formato='png'):
+    return os.path.join(CACHE_GRAFICOS_DIR, chave_cache[:2], f"{chave_cache}.{formato}")
+
+
+def _ler_cache_grafico(chave_cache, formato='png'):
+    caminho = _caminho_cache_grafico(chave_cache, formato)
+    try:
+        with open(caminho, 'rb') as f:
+            png = f.read()
+        os.utime(caminho)  # Marca o uso para o LRU
+        return png
+    except OSError:
+        return None
+
+
+def _gravar_cache_grafico(chave_cache, png, formato='png'):
+    caminho = _caminho_cache_grafico(chave_cache, formato)
+    try:
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        temporario = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporario, 'wb') as f:
+            f.write(png)
+        os.replace(temporario, caminho)
+    except OSError:
+        logger.warning("Erro ao gravar gráfico no cache em %s", caminho, exc_info=True)
+
+
+def _aplicar_limite_cache_graficos():
+    """Remove os gráficos usados há mais tempo até o cache caber em CACHE_GRAFICOS_MAX_BYTES."""
+    entradas = []
+    for raiz, _, arquivos in os.walk(CACHE_GRAFICOS_DIR):
+        for nome in arquivos:
+            caminho = os.path.join(raiz, nome)
+            try:
+                info = os.stat(caminho)
+            except OSError:
+                continue
+            entradas.append((info.st_mtime, info.st_size, caminho))
+
+    total = sum(tamanho for _, tamanho, _ in entradas)
+    for _, tamanho, caminho in sorted(entradas):
+        if total <= CACHE_GRAFICOS_MAX_BYTES:
+            break
+        try:
+            os.remove(caminho)
+        except OSError:
+            pass
+        total -= tamanho
+
+
+def renderizar_graficos(tarefas, indice_produtos, formato=FORMATO_GRAFICOS):
+    """Renderiza vários gráficos em paralelo, no formato pedido ('png' ou 'svg').
+
+    `tarefas` é uma lista de (chave, df_municipio, municipio, tipo_dado, tabela_origem).
+    Retorna {chave: bytes} apenas para os gráficos gerados com sucesso. Gráficos
+    já presentes no cache em disco não são renderizados de novo.
+    """
+    graficos = {}
+    chaves_cache = {}
+    pendentes = []
+    for tarefa in tarefas:
+        chave, df_municipio, municipio, tipo_dado, tabela_origem = tarefa
+        chaves_cache[chave] = chave_cache_grafico(df_municipio, municipio, tipo_dado, tabela_origem, indice_produtos, formato)
+        png = _ler_cache_grafico(chaves_cache[chave], formato)
+        if png:
+            graficos[chave] = png
+        else:
+            pendentes.append(tarefa)
+
+    if pendentes:
+        for chave, png in _renderizar_pendentes(pendentes, indice_produtos, formato).items():
+            graficos[chave] = png
+            _gravar_cache_grafico(chaves_cache[chave], png, formato)
+        _aplicar_limite_cache_graficos()
+    return {tarefa[0]: graficos[tarefa[0]] for tarefa in tarefas if tarefa[0] in graficos}
+
+
+def _renderizar_pendentes(tarefas, indice_produtos, formato):
+    graficos = {}
+    pool = None
+    if len(tarefas) > 1:
+        try:
+            pool = _obter_pool(indice_produtos)
+        except Exception:
+            logger.exception("Não foi possível iniciar o pool de gráficos, renderizando em série")
+
+    if pool is not None:
+        renderizadas = set()
+        try:
+            for chave, png in pool.renderizar(tarefas, formato, TIMEOUT_GRAFICOS):
+                renderizadas.add(chave)
+                if png:
+                    graficos[chave] = png
+            return graficos
+        except TimeoutError:
+            # Processo travado: encerrar o pool e renderizar o que faltou em série
+            logger.error("Pool de gráficos sem resposta em %.0f s; renderizando %d gráfico(s) em série",
+                         TIMEOUT_GRAFICOS, len(tarefas) - len(renderizadas))
+            _descartar_pool(pool)
+        except (EOFError, OSError):
+            # Um processo morreu (ex.: falta de memória) ou o pool foi descartado por outra chamada
+            logger.exception("Pool de gráficos indisponível, renderizando em série")
+            _descartar_pool(pool)
+        tarefas = [tarefa for tarefa in tarefas if tarefa[0] not in renderizadas]
+
+    for tarefa in tarefas:
+        chave, df_municipio, municipio, tipo_dado, tabela_origem = tarefa
+        png = criar_grafico(df_municipio, municipio, tipo_dado, tabela_origem, indice_produtos, formato)
+        if png:
+            graficos[chave] = png
+    return graficos
+
+
+def comparar_formatos(tarefas, indice_produtos, formatos=tuple(FORMATOS_GRAFICOS), repeticoes=3):
+    """Benchmark em série (sem cache e sem pool) de cada formato sobre as mesmas tarefas.
+
+    Retorna {formato: (segundos por gráfico, bytes por gráfico)}, com o melhor tempo
+    entre as repetições.
+    """
+    resultados = {}
+    for formato in formatos:
+        melhor, tamanho = None, 0
+        for _ in range(repeticoes):
+            inicio = time.perf_counter()
+            arquivos = [
+                criar_grafico(df_municipio, municipio, tipo_dado, tabela_origem, indice_produtos, formato)
+                for _, df_municipio, municipio, tipo_dado, tabela_origem in tarefas
+            ]
+            duracao = time.perf_counter() - inicio
+            melhor = duracao if melhor is None else min(melhor, duracao)
+            tamanho = sum(len(arquivo) for arquivo in arquivos if arquivo)
+        resultados[formato] = (melhor / len(tarefas), tamanho / len(tarefas))
+    return resultados
+
+
+def _tarefas_representativas(num_municipios=12, seed=0):
+    """Municípios sintéticos com o formato dos dados reais: top 10 produtos x 10 anos por tabela."""
+    gerador = np.random.default_rng(seed)
+    anos = [str(ano) for ano in range(2014, 2024)]
+    produtos = {
+        'PAM_Quantidade_produzida_14-23': ['milho', 'soja', 'cafeara', 'cana', 'feijao', 'banana', 'laranja', 'mandioc', 'arroz', 'tomate'],
+        'PPM_Prod_origem_animal_14-23': ['leite', 'ovogal', 'ovocod', 'mel', 'bichsed'],
+        'PEVS_Qnt_prod_silv_14-23': ['carveg', 'lenha', 'madtor', 'outprod'],
+    }
+    tarefas = []
+    for i in range(num_municipios):
+        for tabela, codigos in produtos.items():
+            df = pd.DataFrame(gerador.gamma(2.0, 5000.0, (len(codigos), len(anos))), columns=anos)
+            df.insert(0, 'Produto', codigos)
+            tarefas.append(((tabela, f"Município {i}"), df, f"Município {i}", "Quantidade Produzida", tabela))
+    return tarefas
+
+
+if __name__ == "__main__":
+    num_municipios = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    tarefas = _tarefas_representativas(num_municipios)
+    print(f"{len(tarefas)} gráficos ({num_municipios} municípios x 3 tabelas)")
+    for formato, (segundos, tamanho) in comparar_formatos(tarefas, IndiceProdutos({})).items():
+        print(f"{formato}: {segundos * 1000:.0f} ms/gráfico, {tamanho / 1024:.0f} KB/gráfico")
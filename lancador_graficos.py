@@ -0,0 +1,93 @@
+"""Processo lançador do pool de gráficos (iniciado pelo graficos_agro com subprocess).
+
+O Streamlit registra o script do app como __main__, e todo processo que o
+multiprocessing inicia por 'forkserver' ou 'spawn' a partir do servidor executaria
+de novo esse arquivo, ou seja, o app inteiro. Este lançador é um processo Python à
+parte, com o seu próprio __main__ (este módulo): é ele que cria o pool de processos
+(forkserver com graficos_agro pré-carregado), sem que o __main__ do servidor seja
+lido ou trocado.
+
+Protocolo: a configuração (chave de autenticação, índice de produtos, número de
+processos) chega pickled pela entrada padrão, e o endereço da conexão local sai na
+primeira linha da saída padrão. Cada pedido é uma conexão nova: o servidor envia
+(tarefas, formato), e o lançador devolve (chave, bytes) de cada gráfico assim que
+fica pronto e None no fim. Quando a entrada padrão fecha (o servidor morreu) ou o
+processo recebe SIGTERM, os processos do pool são encerrados junto.
+"""
+import os
+import sys
+import pickle
+import signal
+import logging
+import functools
+import threading
+import multiprocessing
+from multiprocessing.connection import Listener
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import graficos_agro
+
+logger = logging.getLogger(__name__)
+
+
+def _encerrar(pool):
+    """Encerra os processos do pool (inclusive os travados) e sai."""
+    if hasattr(pool, 'terminate_workers'):
+        pool.terminate_workers()
+    else:
+        # Antes do Python 3.14 o executor não expõe os processos
+        for processo in list((getattr(pool, '_processes', None) or {}).values()):
+            processo.terminate()
+    os._exit(0)
+
+
+def _vigiar_servidor(pool):
+    # A entrada padrão só fecha quando o servidor fecha o pipe ou morre
+    sys.stdin.buffer.read()
+    _encerrar(pool)
+
+
+def _atender(conexao, pool):
+    with conexao:
+        try:
+            tarefas, formato = conexao.recv()
+            funcao = functools.partial(graficos_agro._renderizar_tarefa, formato=formato)
+            for futuro in as_completed([pool.submit(funcao, tarefa) for tarefa in tarefas]):
+                conexao.send(futuro.result())
+            conexao.send(None)
+        except Exception:
+            # Conexão fechada pelo servidor (tempo limite) ou pool quebrado: o servidor
+            # percebe pela conexão fechada e renderiza o que faltou em série
+            logger.exception("Erro ao atender um pedido de gráficos")
+
+
+def main():
+    config = pickle.load(sys.stdin.buffer)
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        contexto = multiprocessing.get_context('forkserver')
+        contexto.set_forkserver_preload(['graficos_agro'])
+    else:
+        contexto = multiprocessing.get_context('spawn')
+    pool = ProcessPoolExecutor(
+        max_workers=config['max_workers'],
+        mp_context=contexto,
+        initializer=graficos_agro._inicializar_worker,
+        initargs=(config['indice_produtos'],),
+    )
+    signal.signal(signal.SIGTERM, lambda *_: _encerrar(pool))
+    threading.Thread(target=_vigiar_servidor, args=(pool,), name="vigia-servidor", daemon=True).start()
+
+    with Listener(authkey=config['authkey']) as listener:
+        print(listener.address, flush=True)
+        while True:
+            try:
+                conexao = listener.accept()
+            except Exception:
+                # Conexão que não autenticou: ignorar e continuar aceitando
+                logger.exception("Conexão recusada pelo lançador de gráficos")
+                continue
+            threading.Thread(target=_atender, args=(conexao, pool), name="pedido-graficos", daemon=True).start()
+
+
+if __name__ == "__main__":
+    main()
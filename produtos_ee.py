@@ -0,0 +1,379 @@
+"""Registro declarativo das camadas da Earth Engine e planejamento das dependências.
+
+Cada camada tem uma função que monta o seu grafo na Earth Engine a partir das
+camadas (ou entradas) de que depende. Os produtos exportáveis apontam para a
+camada de origem e descrevem a opção do formulário, o nome do arquivo, a escala,
+a política de tipo de dado (TIPOS_DADO) e as bandas.
+
+planejar() parte dos produtos selecionados e inclui apenas os intermediários de
+que eles precisam, em ordem topológica. O Avaliador monta cada camada uma única
+vez, sob demanda, e todos os produtos que dependem dela usam o mesmo objeto (ex.:
+uma única mediana do Sentinel-2 para NDVI, GNDVI, NDWI, NDMI e a composição).
+Um produto novo é uma entrada em PRODUTOS, mais as camadas que ainda não existirem.
+
+A composição do Sentinel-2 lê apenas as bandas que as camadas do plano usam
+(Camada.bandas_sentinel), mascara nuvens pixel a pixel (SCL ou probabilidade de
+nuvem) em vez de descartar cenas inteiras, e tem janela de datas e redutor
+configuráveis (COMPOSICAO_SENTINEL, com variáveis de ambiente ZAP_S2_*).
+"""
+import os
+
+import ee
+
+# Entradas fornecidas por quem avalia o plano (não são calculadas pelo registro)
+ENTRADAS = ("geometria", "data_atual", "bandas_sentinel", "composicao")
+
+BANDAS_SENTINEL = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B8A', 'B9', 'B11', 'B12']
+
+MASCARAS_NUVEM = {"scl", "probabilidade", "nenhuma"}
+
+COMPOSICAO_SENTINEL = {
+    # scl: classes de nuvem/sombra da Scene Classification; probabilidade: COPERNICUS/S2_CLOUD_PROBABILITY;
+    # nenhuma: sem máscara por pixel (apenas cenas com menos de 10% de nuvens, como antes)
+    "mascara": os.environ.get("ZAP_S2_MASCARA", "scl").lower(),
+    "dias": int(os.environ.get("ZAP_S2_DIAS", 365)),
+    # mediana, media ou pNN (percentil NN)
+    "redutor": os.environ.get("ZAP_S2_REDUTOR", "mediana").lower(),
+    # Com máscara por pixel, cenas mais nubladas ainda contribuem com os pixels limpos
+    "max_nuvens_cena": float(os.environ.get("ZAP_S2_MAX_NUVENS", 60)),
+    "limite_probabilidade": int(os.environ.get("ZAP_S2_LIMITE_PROBABILIDADE", 40)),
+}
+if COMPOSICAO_SENTINEL["mascara"] not in MASCARAS_NUVEM:
+    COMPOSICAO_SENTINEL["mascara"] = "scl"
+
+# Classes da SCL descartadas: sombra de nuvem, nuvem (média e alta probabilidade) e cirrus
+CLASSES_SCL_NUVEM = [3, 8, 9, 10]
+
+
+class Camada:
+    """Nó do grafo: `calcular` recebe os valores das `dependencias`, na ordem.
+
+    `bandas_sentinel` são as bandas do Sentinel-2 que a camada lê da composição.
+    """
+
+    def __init__(self, nome, calcular, dependencias=(), bandas_sentinel=()):
+        self.nome = nome
+        self.calcular = calcular
+        self.dependencias = tuple(dependencias)
+        self.bandas_sentinel = tuple(bandas_sentinel)
+
+
+class Produto:
+    """Camada exportável: `fonte` é a camada de origem, reprojetada para `escala` na exportação.
+
+    `tipo` é a política de tipo de dado da exportação (chave de TIPOS_DADO, ou None
+    para manter o da fonte); `grupo` identifica os produtos que podem ser
+    empilhados juntos (desde que o tipo comum não os alargue, ver separar_por_tipo).
+    """
+
+    def __init__(self, nome, opcao, fonte, prefixo, sufixo, escala, bandas, tipo=None, grupo=None):
+        self.nome = nome
+        self.opcao = opcao
+        self.fonte = fonte
+        self.prefixo = prefixo
+        self.sufixo = sufixo
+        self.escala = escala
+        self.bandas = bandas
+        self.tipo = tipo
+        self.grupo = grupo
+
+
+def _bacia(geometria):
+    return geometria.bounds().buffer(1000)  # 1000 metros = 1 km
+
+
+def _periodo(data_atual, composicao):
+    periodo_fim = ee.Date(data_atual.strftime("%Y-%m-%d"))
+    return periodo_fim.advance(-composicao["dias"], 'day'), periodo_fim
+
+
+def _mascara_scl(bandas):
+    def mascarar(imagem):
+        limpo = imagem.select('SCL').remap(CLASSES_SCL_NUVEM, [0] * len(CLASSES_SCL_NUVEM), 1)
+        return imagem.select(bandas).updateMask(limpo)
+    return mascarar
+
+
+def _mascara_probabilidade(bandas, limite):
+    def mascarar(imagem):
+        limpo = ee.Image(imagem.get('probabilidade_nuvem')).select('probability').lt(limite)
+        return imagem.select(bandas).updateMask(limpo)
+    return mascarar
+
+
+def _sentinel(bacia, periodo, bandas_sentinel, composicao):
+    """Coleção do período, só com as bandas usadas e com as nuvens mascaradas pixel a pixel."""
+    periodo_inicio, periodo_fim = periodo
+    bandas = list(bandas_sentinel)
+    mascara = composicao["mascara"]
+    colecao = ee.ImageCollection("COPERNICUS/S2_SR_HARMONIZED") \
+        .filterBounds(bacia) \
+        .filterDate(periodo_inicio, periodo_fim)
+
+    if mascara == "nenhuma":
+        return colecao.filterMetadata('CLOUDY_PIXEL_PERCENTAGE', 'less_than', 10).select(bandas)
+
+    colecao = colecao.filterMetadata('CLOUDY_PIXEL_PERCENTAGE', 'less_than', composicao["max_nuvens_cena"])
+    if mascara == "scl":
+        return colecao.select(bandas + ['SCL']).map(_mascara_scl(bandas))
+
+    probabilidade = ee.ImageCollection("COPERNICUS/S2_CLOUD_PROBABILITY") \
+        .filterBounds(bacia) \
+        .filterDate(periodo_inicio, periodo_fim)
+    colecao = ee.ImageCollection(ee.Join.saveFirst('probabilidade_nuvem').apply(
+        primary=colecao.select(bandas),
+        secondary=probabilidade,
+        condition=ee.Filter.equals(leftField='system:index', rightField='system:index'),
+    ))
+    return colecao.map(_mascara_probabilidade(bandas, composicao["limite_probabilidade"]))
+
+
+def _composicao_sentinel(sentinel, bacia, bandas_sentinel, composicao):
+    """Redução da coleção (mediana, média ou percentil) recortada na bacia."""
+    redutor = composicao["redutor"]
+    if redutor == "media":
+        imagem = sentinel.mean()
+    elif redutor.startswith("p") and redutor[1:].isdigit():
+        imagem = sentinel.reduce(ee.Reducer.percentile([int(redutor[1:])])).rename(list(bandas_sentinel))
+    else:
+        imagem = sentinel.median()
+    return imagem.clip(bacia)
+
+
+def _mde(bacia):
+    colecao = ee.ImageCollection("JAXA/ALOS/AW3D30/V3_2").filterBounds(bacia)
+    mde_proj = colecao.first().select(0).projection()
+    return colecao.mosaic().clip(bacia).setDefaultProjection(mde_proj)
+
+
+def _declividade(elevation):
+    declividade_graus = ee.Terrain.slope(elevation)
+    declividade = declividade_graus.divide(180).multiply(3.14159).tan().multiply(100)
+    return declividade.expression(
+        "b(0) == 0 ? 1 : " +
+        "b(0) <= 3 ? 1 : " +
+        "(b(0) > 3 && b(0) <= 8) ? 2 : " +
+        "(b(0) > 8 && b(0) <= 20) ? 3 : " +
+        "(b(0) > 20 && b(0) <= 45) ? 4 : " +
+        "(b(0) > 45 && b(0) <= 75) ? 5 : " +
+        "(b(0) > 75) ? 6 : -1"
+    )
+
+
+def _indice(banda_a, banda_b):
+    return lambda sentinel_median: sentinel_median.normalizedDifference([banda_a, banda_b])
+
+
+def _imagem(asset, banda):
+    return lambda bacia: ee.Image(asset).select(banda).clip(bacia)
+
+
+def _mosaico(asset):
+    return lambda bacia: ee.ImageCollection(asset).filterBounds(bacia).mosaic().clip(bacia)
+
+
+CAMADAS = {camada.nome: camada for camada in [
+    Camada("bacia", _bacia, ["geometria"]),
+    Camada("periodo", _periodo, ["data_atual", "composicao"]),
+    # Sentinel-2: uma única composição (mediana de um ano, por padrão), compartilhada
+    # por todos os índices e pela composição B2/B3/B4/B8
+    Camada("sentinel", _sentinel, ["bacia", "periodo", "bandas_sentinel", "composicao"]),
+    Camada("sentinel_median", _composicao_sentinel, ["sentinel", "bacia", "bandas_sentinel", "composicao"]),
+    Camada("ndvi", _indice('B8', 'B4'), ["sentinel_median"], bandas_sentinel=['B8', 'B4']),
+    Camada("gndvi", _indice('B8', 'B3'), ["sentinel_median"], bandas_sentinel=['B8', 'B3']),
+    Camada("ndwi", _indice('B3', 'B8'), ["sentinel_median"], bandas_sentinel=['B3', 'B8']),
+    Camada("ndmi", _indice('B8', 'B11'), ["sentinel_median"], bandas_sentinel=['B8', 'B11']),
+    Camada("sentinel_composite",
+           lambda sentinel_median: sentinel_median.select(['B2', 'B3', 'B4', 'B8']).rename(['B2', 'B3', 'B4', 'B8']),
+           ["sentinel_median"], bandas_sentinel=['B2', 'B3', 'B4', 'B8']),
+    # Terreno: MDE do ALOS, compartilhado pela elevação e pela declividade
+    Camada("mde", _mde, ["bacia"]),
+    Camada("elevation", lambda mde: mde.select('DSM'), ["mde"]),
+    Camada("declividade", _declividade, ["elevation"]),
+    # Camadas independentes
+    Camada("mapbiomas", _imagem("projects/mapbiomas-public/assets/brazil/lulc/collection9/mapbiomas_collection90_integration_v1",
+                                'classification_2023'), ["bacia"]),
+    Camada("pasture_quality", _imagem("projects/mapbiomas-public/assets/brazil/lulc/collection9/mapbiomas_collection90_pasture_quality_v1",
+                                      'pasture_quality_2023'), ["bacia"]),
+    Camada("landforms", lambda bacia: ee.Image('CSP/ERGo/1_0/Global/SRTM_landforms').clip(bacia), ["bacia"]),
+    Camada("puc_ufv", _mosaico('users/zap/puc_ufv'), ["bacia"]),
+    Camada("puc_ibge", _mosaico('users/zap/puc_ibge'), ["bacia"]),
+    Camada("puc_embrapa", _mosaico('users/zap/puc_embrapa'), ["bacia"]),
+]}
+
+# Na ordem de exportação
+PRODUTOS = [
+    Produto("utm_elevation", "exportar_srtm_mde", "elevation", "06_", "_SRTM_MDE", 30, ["MDE"],
+            tipo="int16", grupo="terreno"),
+    Produto("utm_declividade", "exportar_declividade", "declividade", "02_", "_Declividade", 30, ["Declividade"],
+            tipo="uint8", grupo="terreno"),
+    Produto("utm_ndvi", "exportar_ndvi", "ndvi", "06_", "_NDVImediana_{periodo}", 10, ["NDVI"],
+            tipo="int16_x10000", grupo="sentinel2"),
+    Produto("utm_gndvi", "exportar_gndvi", "gndvi", "06_", "_GNDVI_{periodo}", 10, ["GNDVI"],
+            tipo="int16_x10000", grupo="sentinel2"),
+    Produto("utm_ndwi", "exportar_ndwi", "ndwi", "06_", "_NDWI_{periodo}", 10, ["NDWI"],
+            tipo="int16_x10000", grupo="sentinel2"),
+    Produto("utm_ndmi", "exportar_ndmi", "ndmi", "06_", "_NDMI_{periodo}", 10, ["NDMI"],
+            tipo="int16_x10000", grupo="sentinel2"),
+    Produto("utm_sentinel2", "exportar_sentinel_composite", "sentinel_composite", "06_", "_S2_B2B3B4B8_{periodo}", 10,
+            ["B2", "B3", "B4", "B8"], tipo="uint16", grupo="sentinel2"),
+    Produto("utm_mapbiomas", "exportar_mapbiomas", "mapbiomas", "06_", "_MapBiomas_col9_2023", 30, ["MapBiomas"],
+            tipo="uint8"),
+    Produto("utm_pasture_quality", "exportar_pasture_quality", "pasture_quality", "06_", "_Vigor_Pastagem_col9_2023", 30,
+            ["Vigor_Pastagem"], tipo="uint8"),
+    Produto("utm_landforms", "exportar_landforms", "landforms", "06_", "_Landforms", 30, ["Landforms"], tipo="uint8"),
+    Produto("utm_puc_ufv", "exportar_puc_ufv", "puc_ufv", "02_", "_PUC_UFV", 30, ["PUC_UFV"], tipo="uint8"),
+    Produto("utm_puc_ibge", "exportar_puc_ibge", "puc_ibge", "02_", "_PUC_IBGE", 30, ["PUC_IBGE"], tipo="uint8"),
+    Produto("utm_puc_embrapa", "exportar_puc_embrapa", "puc_embrapa", "02_", "_PUC_Embrapa", 30, ["PUC_Embrapa"], tipo="uint8"),
+]
+
+# Políticas de tipo de dado da exportação: tipo gravado no GeoTIFF, fator aplicado aos
+# valores, nodata (gravado nos pixels sem dado) e faixa representável. As classes
+# começam em 1, então o 0 fica livre para nodata nos rasters uint8.
+TIPOS_DADO = {
+    "uint8": {"base": "uint8", "fator": 1, "nodata": 0, "faixa": (0, 255)},
+    "uint16": {"base": "uint16", "fator": 1, "nodata": 0, "faixa": (0, 65535)},
+    "int16": {"base": "int16", "fator": 1, "nodata": -32768, "faixa": (-32768, 32767)},
+    # Índices de diferença normalizada (-1 a 1) com 4 casas decimais
+    "int16_x10000": {"base": "int16", "fator": 10000, "nodata": -32768, "faixa": (-32768, 32767)},
+    "int32": {"base": "int32", "fator": 1, "nodata": -2147483648, "faixa": (-2147483648, 2147483647)},
+    "float": {"base": "float", "fator": 1, "nodata": None, "faixa": None},
+}
+
+_CONVERSOES = {"uint8": "toUint8", "uint16": "toUint16", "int16": "toInt16", "int32": "toInt32", "float": "toFloat"}
+
+
+def converter_tipo(imagem, tipo):
+    """Aplica a política `tipo` de TIPOS_DADO (None mantém a imagem como está)."""
+    if tipo is None:
+        return imagem
+    politica = TIPOS_DADO[tipo]
+    if politica["fator"] != 1:
+        imagem = imagem.multiply(politica["fator"])
+    if politica["base"] != "float":
+        imagem = imagem.round()
+    return getattr(imagem, _CONVERSOES[politica["base"]])()
+
+
+def tipo_comum(tipos):
+    """Menor tipo inteiro que comporta os valores (já convertidos) de todos os `tipos`.
+
+    Usado no empilhamento, em que todas as bandas do GeoTIFF têm o mesmo tipo;
+    'float' quando algum dos tipos não é inteiro.
+    """
+    faixas = [TIPOS_DADO[tipo]["faixa"] if tipo else None for tipo in tipos]
+    if None in faixas:
+        return "float"
+    minimo, maximo = min(faixa[0] for faixa in faixas), max(faixa[1] for faixa in faixas)
+    for candidato in ("uint8", "int16", "uint16", "int32"):
+        inicio, fim = TIPOS_DADO[candidato]["faixa"]
+        if inicio <= minimo and maximo <= fim:
+            return candidato
+    return "float"
+
+
+def separar_por_tipo(produtos):
+    """Divide os produtos de um grupo em pilhas que não alargam o tipo de dado.
+
+    Um produto entra na primeira pilha cujo tipo comum, com ele, continua sendo o
+    tipo de um dos membros (ex.: uint8 + int16 -> int16); senão, abre outra pilha.
+    Assim os índices (int16) e as bandas do Sentinel-2 (uint16) não viram int32, que
+    dobraria o tamanho do arquivo. A ordem dos produtos é mantida em cada pilha.
+    """
+    pilhas = []
+    for produto in produtos:
+        for pilha in pilhas:
+            tipos = [membro.tipo for membro in pilha] + [produto.tipo]
+            bases = {TIPOS_DADO[tipo]["base"] if tipo else "float" for tipo in tipos}
+            if tipo_comum(tipos) in bases:
+                pilha.append(produto)
+                break
+        else:
+            pilhas.append([produto])
+    return pilhas
+
+
+def grade_exportacao(escala):
+    """crsTransform da grade de exportação: pixels de `escala` metros com origem em múltiplos da escala.
+
+    No fuso UTM da bacia, coincide com os pixels nativos do Sentinel-2 (os blocos
+    MGRS começam em múltiplos de 20 m). Os produtos de 30 m vêm de fontes em
+    coordenadas geográficas (ALOS, MapBiomas), sem grade UTM nativa; para eles é a
+    mesma grade que o reproject(scale=...) usava.
+    """
+    return [escala, 0, 0, 0, -escala, 0]
+
+
+class Plano:
+    """Produtos selecionados e as camadas de que precisam, em ordem topológica."""
+
+    def __init__(self, produtos, camadas):
+        self.produtos = produtos
+        self.camadas = camadas
+
+    def usa(self, camada):
+        return camada in self.camadas
+
+    def bandas_sentinel(self):
+        """Bandas do Sentinel-2 lidas pelas camadas do plano, na ordem do sensor."""
+        usadas = {banda for nome in self.camadas for banda in CAMADAS[nome].bandas_sentinel}
+        return [banda for banda in BANDAS_SENTINEL if banda in usadas]
+
+    def sem_dependentes(self, camada):
+        """Novo plano sem os produtos que dependem da camada (ex.: coleção vazia)."""
+        return planejar_produtos([p for p in self.produtos if camada not in dependencias(p.fonte)])
+
+
+def dependencias(nome):
+    """A camada e todas as camadas de que ela depende, em ordem topológica (sem as entradas)."""
+    ordem, visitando = [], set()
+
+    def visitar(atual):
+        if atual in ENTRADAS or atual in ordem:
+            return
+        if atual not in CAMADAS:
+            raise KeyError(f"Camada desconhecida: {atual}")
+        if atual in visitando:
+            raise ValueError(f"Dependência circular na camada {atual}")
+        visitando.add(atual)
+        for dependencia in CAMADAS[atual].dependencias:
+            visitar(dependencia)
+        visitando.discard(atual)
+        ordem.append(atual)
+
+    visitar(nome)
+    return ordem
+
+
+def planejar_produtos(produtos):
+    camadas = []
+    for produto in produtos:
+        camadas.extend(c for c in dependencias(produto.fonte) if c not in camadas)
+    return Plano(produtos, camadas)
+
+
+def planejar(selecao):
+    """Plano mínimo para as opções exportar_* marcadas em `selecao`."""
+    return planejar_produtos([produto for produto in PRODUTOS if selecao.get(produto.opcao)])
+
+
+class Avaliador:
+    """Monta as camadas do plano sob demanda, cada uma uma única vez, a partir das ENTRADAS.
+
+    As bandas do Sentinel-2 vêm do plano; a composição, de COMPOSICAO_SENTINEL se
+    não for informada.
+    """
+
+    def __init__(self, plano, geometria, data_atual, composicao=None):
+        self._valores = {
+            "geometria": geometria,
+            "data_atual": data_atual,
+            "bandas_sentinel": plano.bandas_sentinel(),
+            "composicao": composicao or COMPOSICAO_SENTINEL,
+        }
+
+    def obter(self, nome):
+        if nome not in self._valores:
+            camada = CAMADAS[nome]
+            self._valores[nome] = camada.calcular(*[self.obter(dependencia) for dependencia in camada.dependencias])
+        return self._valores[nome]